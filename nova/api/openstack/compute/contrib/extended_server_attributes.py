@@ -35,17 +35,18 @@ class ExtendedServerAttributesController(wsgi.Controller):
                                                                  **kwargs)
         self.compute_api = compute.API()
 
-    def _get_hypervisor_hostname(self, context, instance):
-        compute_node = db.compute_node_get_by_host(context, instance["host"])
-
-        try:
-            return compute_node["hypervisor_hostname"]
-        except TypeError:
-            return
-
-    def _extend_server(self, context, server, instance):
+    def _get_hypervisor_hostnames(self, context, instances):
+        """Return the hypervisor hostnames of the hosts of the instances,
+        read with one query for the whole page."""
+        hosts = set(instance["host"] for instance in instances
+                    if instance["host"])
+        compute_nodes = db.compute_node_get_by_hosts(context, list(hosts))
+        return dict((host, compute_node["hypervisor_hostname"])
+                    for host, compute_node in compute_nodes.items())
+
+    def _extend_server(self, server, instance, hypervisor_hostnames):
         key = "%s:hypervisor_hostname" % Extended_server_attributes.alias
-        server[key] = self._get_hypervisor_hostname(context, instance)
+        server[key] = hypervisor_hostnames.get(instance["host"])
 
         for attr in ['host', 'name']:
             if attr == 'name':
@@ -65,7 +66,9 @@ class ExtendedServerAttributesController(wsgi.Controller):
             db_instance = req.get_db_instance(server['id'])
             # server['id'] is guaranteed to be in the cache due to
             # the core API adding it in its 'show' method.
-            self._extend_server(context, server, db_instance)
+            hypervisor_hostnames = self._get_hypervisor_hostnames(
+                    context, [db_instance])
+            self._extend_server(server, db_instance, hypervisor_hostnames)
 
     @wsgi.extends
     def detail(self, req, resp_obj):
@@ -75,11 +78,15 @@ class ExtendedServerAttributesController(wsgi.Controller):
             resp_obj.attach(xml=ExtendedServerAttributesTemplate())
 
             servers = list(resp_obj.obj['servers'])
-            for server in servers:
-                db_instance = req.get_db_instance(server['id'])
-                # server['id'] is guaranteed to be in the cache due to
-                # the core API adding it in its 'detail' method.
-                self._extend_server(context, server, db_instance)
+            # server['id'] is guaranteed to be in the cache due to
+            # the core API adding it in its 'detail' method.
+            db_instances = [req.get_db_instance(server['id'])
+                            for server in servers]
+            hypervisor_hostnames = self._get_hypervisor_hostnames(
+                    context, db_instances)
+            for server, db_instance in zip(servers, db_instances):
+                self._extend_server(server, db_instance,
+                                    hypervisor_hostnames)
 
 
 class Extended_server_attributes(extensions.ExtensionDescriptor):
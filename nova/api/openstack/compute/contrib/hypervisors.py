@@ -165,14 +165,16 @@ class HypervisorsController(object):
         context = req.environ['nova.context']
         authorize(context)
         return dict(hypervisors=[self._view_hypervisor(hyp, False)
-                                 for hyp in db.compute_node_get_all(context)])
+                                 for hyp in db.compute_node_get_all(context,
+                                                            use_slave=True)])
 
     @wsgi.serializers(xml=HypervisorDetailTemplate)
     def detail(self, req):
         context = req.environ['nova.context']
         authorize(context)
         return dict(hypervisors=[self._view_hypervisor(hyp, True)
-                                 for hyp in db.compute_node_get_all(context)])
+                                 for hyp in db.compute_node_get_all(context,
+                                                            use_slave=True)])
 
     @wsgi.serializers(xml=HypervisorTemplate)
     def show(self, req, id):
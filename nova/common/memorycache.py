@@ -18,34 +18,84 @@
 
 """Super simple fake memcache client."""
 
+import heapq
+
+from nova import flags
+from nova.openstack.common import cfg
 from nova.openstack.common import timeutils
 
+memorycache_opts = [
+    cfg.IntOpt('memorycache_max_keys',
+               default=100000,
+               help='number of keys the in-memory cache, used when no '
+                    'memcached_servers are set, keeps at most; the least '
+                    'recently used keys are dropped first, 0 for no limit'),
+    ]
+
+FLAGS = flags.FLAGS
+FLAGS.register_opts(memorycache_opts)
+
+# fields of the [prev, next, key, timeout, value] links of the keys
+_PREV, _NEXT, _KEY, _TIMEOUT, _VALUE = range(5)
+
 
 class Client(object):
-    """Replicates a tiny subset of memcached client interface."""
+    """Replicates a tiny subset of memcached client interface.
+
+    Keys are kept in least recently used order.  A key that has expired
+    is dropped when it is read, and expired keys are dropped in order of
+    expiry when keys are set, so that no call has to go over all the keys.
+    """
 
     def __init__(self, *args, **kwargs):
         """Ignores the passed in args."""
+        # the links of the keys, chained from the least to the most
+        # recently used around the root link
         self.cache = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, None]
+        # (timeout, key) of the keys set with a timeout; keys that were
+        # set again or dropped since are still in there
+        self.timeouts = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
 
     def get(self, key):
-        """Retrieves the value for a key or None.
-
-        this expunges expired keys during each get"""
+        """Retrieves the value for a key or None."""
+        link = self.cache.get(key)
+        if link is None:
+            self.misses += 1
+            return None
 
-        for k in self.cache.keys():
-            (timeout, _value) = self.cache[k]
-            if timeout and timeutils.utcnow_ts() >= timeout:
-                del self.cache[k]
+        timeout = link[_TIMEOUT]
+        if timeout and timeutils.utcnow_ts() >= timeout:
+            self._drop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
 
-        return self.cache.get(key, (0, None))[1]
+        # move the key to the most recently used end
+        self._unlink(link)
+        self._append(link)
+        self.hits += 1
+        return link[_VALUE]
 
     def set(self, key, value, time=0, min_compress_len=0):
         """Sets the value for a key."""
         timeout = 0
         if time != 0:
             timeout = timeutils.utcnow_ts() + time
-        self.cache[key] = (timeout, value)
+        self._drop(key)
+        link = [None, None, key, timeout, value]
+        self.cache[key] = link
+        self._append(link)
+        if timeout:
+            heapq.heappush(self.timeouts, (timeout, key))
+
+        self._expire()
+        self._evict()
         return True
 
     def add(self, key, value, time=0, min_compress_len=0):
@@ -60,5 +110,60 @@ class Client(object):
         if value is None:
             return None
         new_value = int(value) + delta
-        self.cache[key] = (self.cache[key][0], str(new_value))
+        self.cache[key][_VALUE] = str(new_value)
         return new_value
+
+    def delete(self, key, time=0):
+        """Deletes the value for a key."""
+        return self._drop(key)
+
+    def get_stats(self):
+        """Returns the hits, misses, evictions and expirations so far, and
+        the number of keys."""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'keys': len(self.cache)}
+
+    def _expire(self):
+        now = timeutils.utcnow_ts()
+        while self.timeouts and self.timeouts[0][0] <= now:
+            timeout, key = heapq.heappop(self.timeouts)
+            link = self.cache.get(key)
+            if link is not None and link[_TIMEOUT] == timeout:
+                self._drop(key)
+                self.expirations += 1
+
+        # NOTE: rebuild the timeouts once most of them are for keys that
+        # were set again or dropped, that is after as many sets as keys
+        if len(self.timeouts) > 2 * len(self.cache) + 64:
+            self.timeouts = [(link[_TIMEOUT], key)
+                             for key, link in self.cache.iteritems()
+                             if link[_TIMEOUT]]
+            heapq.heapify(self.timeouts)
+
+    def _evict(self):
+        max_keys = FLAGS.memorycache_max_keys
+        while max_keys and len(self.cache) > max_keys:
+            self._drop(self.root[_NEXT][_KEY])
+            self.evictions += 1
+
+    def _append(self, link):
+        last = self.root[_PREV]
+        link[_PREV] = last
+        link[_NEXT] = self.root
+        last[_NEXT] = link
+        self.root[_PREV] = link
+
+    def _unlink(self, link):
+        link[_PREV][_NEXT] = link[_NEXT]
+        link[_NEXT][_PREV] = link[_PREV]
+
+    def _drop(self, key):
+        """Forget a key, returns whether it was there."""
+        link = self.cache.pop(key, None)
+        if link is None:
+            return False
+        self._unlink(link)
+        return True
@@ -122,6 +122,16 @@ def paginate_query(query, model, limit, sort_keys, marker=None,
         f = sqlalchemy.sql.or_(*criteria_list)
         query = query.filter(f)
 
+        # NOTE: the criteria above are not a range an index can seek to,
+        # bound the first sort key too so that the next page is read from
+        # the marker on, and not from the first row
+        if marker_values[0] is not None:
+            model_attr = getattr(model, sort_keys[0])
+            if sort_dirs[0] == 'desc':
+                query = query.filter(model_attr <= marker_values[0])
+            else:
+                query = query.filter(model_attr >= marker_values[0])
+
     if limit is not None:
         query = query.limit(limit)
 
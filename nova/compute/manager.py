@@ -50,6 +50,7 @@ from nova.compute import power_state
 from nova.compute import resource_tracker
 from nova.compute import rpcapi as compute_rpcapi
 from nova.compute import task_states
+from nova.compute import timing
 from nova.compute import utils as compute_utils
 from nova.compute import vm_states
 import nova.context
@@ -72,6 +73,7 @@ from nova import quota
 from nova.scheduler import rpcapi as scheduler_rpcapi
 from nova import utils
 from nova.virt import driver
+from nova.virt import event as virtevent
 from nova import volume
 
 
@@ -142,6 +144,11 @@ compute_opts = [
     cfg.BoolOpt('instance_usage_audit',
                default=False,
                help="Generate periodic compute.instance.exists notifications"),
+    cfg.IntOpt("sync_power_state_event_interval",
+               default=600,
+               help="Number of seconds between power state polls when the "
+                    "hypervisor reports instance lifecycle events.  The "
+                    "polls then only catch the events that got lost"),
     ]
 
 FLAGS = flags.FLAGS
@@ -211,7 +218,7 @@ def _get_image_meta(context, image_ref):
 class ComputeManager(manager.SchedulerDependentManager):
     """Manages the running instances from creation to destruction."""
 
-    RPC_API_VERSION = '2.2'
+    RPC_API_VERSION = '2.3'
 
     def __init__(self, compute_driver=None, *args, **kwargs):
         """Load configuration options and connect to the hypervisor."""
@@ -236,6 +243,8 @@ class ComputeManager(manager.SchedulerDependentManager):
         self._last_host_check = 0
         self._last_bw_usage_poll = 0
         self._last_info_cache_heal = 0
+        self._last_power_state_sync = 0
+        self._lifecycle_events = False
         self.compute_api = compute.API()
         self.compute_rpcapi = compute_rpcapi.ComputeAPI()
         self.scheduler_rpcapi = scheduler_rpcapi.SchedulerAPI()
@@ -268,6 +277,8 @@ class ComputeManager(manager.SchedulerDependentManager):
     def init_host(self):
         """Initialization for a standalone compute service."""
         self.driver.init_host(host=self.host)
+        self._lifecycle_events = self.driver.register_event_listener(
+                self.handle_events)
         context = nova.context.get_admin_context()
         instances = self.db.instance_get_all_by_host(context, self.host)
 
@@ -334,6 +345,51 @@ class ComputeManager(manager.SchedulerDependentManager):
             if FLAGS.defer_iptables_apply:
                 self.driver.filter_defer_apply_off()
 
+    def handle_events(self, event):
+        """Called by the virt driver with the events of the hypervisor."""
+        if isinstance(event, virtevent.LifecycleEvent):
+            self.handle_lifecycle_event(event)
+        else:
+            LOG.debug(_("Ignoring event %s"), str(event))
+
+    def handle_lifecycle_event(self, event):
+        """Bring the power state of an instance up to date right when it
+        starts, stops, pauses or resumes, instead of at the next
+        _sync_power_states run.
+        """
+        LOG.info(_("Lifecycle event %s"), str(event))
+        context = nova.context.get_admin_context()
+        try:
+            instance = self.db.instance_get_by_uuid(context, event.uuid)
+        except exception.InstanceNotFound:
+            # not an instance of ours, or already deleted
+            return
+
+        if instance['host'] != self.host:
+            return
+        if instance['task_state'] is not None:
+            # the task in progress sets the power state when it is done
+            LOG.debug(_("Instance has a pending task, ignoring the event"),
+                      instance=instance)
+            return
+
+        # events can arrive late, e.g. a STOPPED event after the instance
+        # was started again, so only act on what the hypervisor still says:
+        vm_power_state, instance = self._query_power_state(context, instance)
+        if vm_power_state != event.power_state:
+            LOG.debug(_("Instance is no longer in the state of the event, "
+                        "ignoring it"), instance=instance)
+            return
+        if instance['task_state'] is not None:
+            # a task started while the hypervisor was asked
+            return
+
+        if vm_power_state != instance['power_state']:
+            instance = self._instance_update(context, instance['uuid'],
+                                             power_state=vm_power_state)
+        self._sync_vm_state(context, instance, instance['vm_state'],
+                            vm_power_state)
+
     def _get_power_state(self, context, instance):
         """Retrieve the power state for the given instance."""
         LOG.debug(_('Checking state'), instance=instance)
@@ -474,6 +530,7 @@ class ComputeManager(manager.SchedulerDependentManager):
                       admin_password, is_first_time, instance):
         """Launch a new instance with specified options."""
         context = context.elevated()
+        timing.start()
 
         try:
             self._check_instance_not_already_created(context, instance)
@@ -483,8 +540,9 @@ class ComputeManager(manager.SchedulerDependentManager):
             self._notify_about_instance_usage(
                     context, instance, "create.start",
                     extra_usage_info=extra_usage_info)
-            network_info = self._allocate_network(context, instance,
-                                                  requested_networks)
+            with timing.span('network'):
+                network_info = self._allocate_network(context, instance,
+                                                      requested_networks)
             try:
                 limits = filter_properties.get('limits', {})
                 with self.resource_tracker.resource_claim(context, instance,
@@ -494,11 +552,13 @@ class ComputeManager(manager.SchedulerDependentManager):
                     self._instance_update(context, instance['uuid'],
                             host=self.host, launched_on=self.host)
 
-                    block_device_info = self._prep_block_device(context,
-                            instance)
-                    instance = self._spawn(context, instance, image_meta,
-                                           network_info, block_device_info,
-                                           injected_files, admin_password)
+                    with timing.span('block_device'):
+                        block_device_info = self._prep_block_device(context,
+                                instance)
+                    with timing.span('spawn'):
+                        instance = self._spawn(context, instance, image_meta,
+                                network_info, block_device_info,
+                                injected_files, admin_password)
 
             except exception.InstanceNotFound:
                 raise  # the instance got deleted during the spawn
@@ -513,6 +573,7 @@ class ComputeManager(manager.SchedulerDependentManager):
                                   and not instance['access_ip_v6']):
                     self._update_access_ip(context, instance, network_info)
 
+                extra_usage_info['build_timing'] = timing.stop()
                 self._notify_about_instance_usage(context, instance,
                         "create.end", network_info=network_info,
                         extra_usage_info=extra_usage_info)
@@ -1783,6 +1844,11 @@ class ComputeManager(manager.SchedulerDependentManager):
         """Returns the result of calling "uptime" on the target host."""
         return self.driver.get_host_uptime(host)
 
+    def get_build_timings(self, context):
+        """Returns the histograms of how long each phase of the instance
+        builds on this host took."""
+        return timing.summary()
+
     @exception.wrap_exception(notifier=notifier, publisher_id=publisher_id())
     @wrap_instance_fault
     def get_diagnostics(self, context, instance):
@@ -2488,7 +2554,8 @@ class ComputeManager(manager.SchedulerDependentManager):
                                                             context,
                                                             begin,
                                                             end,
-                                                            host=self.host)
+                                                            host=self.host,
+                                                            use_slave=True)
                 num_instances = len(instances)
                 errors = 0
                 successes = 0
@@ -2609,15 +2676,32 @@ class ComputeManager(manager.SchedulerDependentManager):
     def _sync_power_states(self, context):
         """Align power states between the database and the hypervisor.
 
-        To sync power state data we make a DB call to get the number of
-        virtual machines known by the hypervisor and if the number matches the
-        number of virtual machines known by the database, we proceed in a lazy
-        loop, one database record at a time, checking if the hypervisor has the
-        same power state as is in the database.
+        To sync power state data we ask the hypervisor for the state of all
+        of its virtual machines at once and compare it with the database
+        records of the instances of this host.  Drivers that can only look
+        instances up one at a time are asked lazily, one database record at
+        a time.  The power states that differ are written in one go.
 
         If the instance is not found on the hypervisor, but is in the database,
         then a stop() API will be called on the instance.
+
+        When the driver reports lifecycle events, the states are already
+        kept in sync by handle_lifecycle_event() and this only runs every
+        sync_power_state_event_interval seconds, to catch lost events.
         """
+        curr_time = time.time()
+        if (self._lifecycle_events and
+            self._last_power_state_sync +
+                FLAGS.sync_power_state_event_interval > curr_time):
+            return
+        self._last_power_state_sync = curr_time
+
+        try:
+            vm_infos = self.driver.get_info_all()
+        except NotImplementedError:
+            vm_infos = None
+        # Note(maoy): the hypervisor is read before the DB, so that the DB
+        # info is the latest, to minimize (not eliminate) race condition.
         db_instances = self.db.instance_get_all_by_host(context, self.host)
 
         num_vm_instances = self.driver.get_num_instances()
@@ -2627,24 +2711,23 @@ class ComputeManager(manager.SchedulerDependentManager):
             LOG.warn(_("Found %(num_db_instances)s in the database and "
                        "%(num_vm_instances)s on the hypervisor.") % locals())
 
+        to_sync = []
+        power_states = {}
         for db_instance in db_instances:
-            db_power_state = db_instance['power_state']
             if db_instance['task_state'] is not None:
                 LOG.info(_("During sync_power_state the instance has a "
                            "pending task. Skip."), instance=db_instance)
                 continue
-            # No pending tasks. Now try to figure out the real vm_power_state.
-            try:
-                vm_instance = self.driver.get_info(db_instance)
-                vm_power_state = vm_instance['state']
-            except exception.InstanceNotFound:
-                vm_power_state = power_state.NOSTATE
-            # Note(maoy): the above get_info call might take a long time,
-            # for example, because of a broken libvirt driver.
-            # We re-query the DB to get the latest instance info to minimize
-            # (not eliminate) race condition.
-            u = self.db.instance_get_by_uuid(context,
-                                             db_instance['uuid'])
+            if vm_infos is not None:
+                vm_info = vm_infos.get(db_instance['name'])
+                if vm_info:
+                    vm_power_state = vm_info['state']
+                else:
+                    vm_power_state = power_state.NOSTATE
+                u = db_instance
+            else:
+                vm_power_state, u = self._query_power_state(context,
+                                                            db_instance)
             db_power_state = u["power_state"]
             vm_state = u['vm_state']
             if self.host != u['host']:
@@ -2673,73 +2756,103 @@ class ComputeManager(manager.SchedulerDependentManager):
                 continue
             if vm_power_state != db_power_state:
                 # power_state is always updated from hypervisor to db
-                self._instance_update(context,
-                                      db_instance['uuid'],
-                                      power_state=vm_power_state)
-                db_power_state = vm_power_state
-            # Note(maoy): Now resolve the discrepancy between vm_state and
-            # vm_power_state. We go through all possible vm_states.
-            if vm_state in (vm_states.BUILDING,
-                            vm_states.RESCUED,
-                            vm_states.RESIZED,
-                            vm_states.SUSPENDED,
-                            vm_states.PAUSED,
-                            vm_states.ERROR):
-                # TODO(maoy): we ignore these vm_state for now.
-                pass
-            elif vm_state == vm_states.ACTIVE:
-                # The only rational power state should be RUNNING
-                if vm_power_state in (power_state.NOSTATE,
-                                       power_state.SHUTDOWN,
-                                       power_state.CRASHED):
-                    LOG.warn(_("Instance shutdown by itself. Calling "
-                               "the stop API."), instance=db_instance)
-                    try:
-                        # Note(maoy): here we call the API instead of
-                        # brutally updating the vm_state in the database
-                        # to allow all the hooks and checks to be performed.
-                        self.compute_api.stop(context, db_instance)
-                    except Exception:
-                        # Note(maoy): there is no need to propagate the error
-                        # because the same power_state will be retrieved next
-                        # time and retried.
-                        # For example, there might be another task scheduled.
-                        LOG.exception(_("error during stop() in "
-                                        "sync_power_state."),
-                                      instance=db_instance)
-                elif vm_power_state in (power_state.PAUSED,
-                                        power_state.SUSPENDED):
-                    LOG.warn(_("Instance is paused or suspended "
-                               "unexpectedly. Calling "
-                               "the stop API."), instance=db_instance)
-                    try:
-                        self.compute_api.stop(context, db_instance)
-                    except Exception:
-                        LOG.exception(_("error during stop() in "
-                                        "sync_power_state."),
-                                      instance=db_instance)
-            elif vm_state == vm_states.STOPPED:
-                if vm_power_state not in (power_state.NOSTATE,
-                                          power_state.SHUTDOWN,
-                                          power_state.CRASHED):
-                    LOG.warn(_("Instance is not stopped. Calling "
-                               "the stop API."), instance=db_instance)
-                    try:
-                        # Note(maoy): this assumes that the stop API is
-                        # idempotent.
-                        self.compute_api.stop(context, db_instance)
-                    except Exception:
-                        LOG.exception(_("error during stop() in "
-                                        "sync_power_state."),
-                                      instance=db_instance)
-            elif vm_state in (vm_states.SOFT_DELETED,
-                              vm_states.DELETED):
-                if vm_power_state not in (power_state.NOSTATE,
-                                          power_state.SHUTDOWN):
-                    # Note(maoy): this should be taken care of periodically in
-                    # _cleanup_running_deleted_instances().
-                    LOG.warn(_("Instance is not (soft-)deleted."),
-                             instance=db_instance)
+                power_states[db_instance['uuid']] = vm_power_state
+            to_sync.append((db_instance, vm_state, vm_power_state))
+
+        if power_states:
+            self.db.instance_update_power_states(context, power_states)
+            for db_instance, vm_state, vm_power_state in to_sync:
+                if db_instance['uuid'] in power_states:
+                    old_instance = dict(db_instance.iteritems())
+                    db_instance['power_state'] = vm_power_state
+                    notifications.send_update(context, old_instance,
+                                              db_instance)
+
+        for db_instance, vm_state, vm_power_state in to_sync:
+            self._sync_vm_state(context, db_instance, vm_state,
+                                vm_power_state)
+
+    def _query_power_state(self, context, db_instance):
+        """Look the power state of an instance up on the hypervisor, and
+        re-query the instance from the DB after it.
+        """
+        try:
+            vm_instance = self.driver.get_info(db_instance)
+            vm_power_state = vm_instance['state']
+        except exception.InstanceNotFound:
+            vm_power_state = power_state.NOSTATE
+        # Note(maoy): the above get_info call might take a long time,
+        # for example, because of a broken libvirt driver.
+        # We re-query the DB to get the latest instance info to minimize
+        # (not eliminate) race condition.
+        u = self.db.instance_get_by_uuid(context, db_instance['uuid'])
+        return vm_power_state, u
+
+    def _sync_vm_state(self, context, db_instance, vm_state, vm_power_state):
+        """Resolve the discrepancy between vm_state and vm_power_state."""
+        # Note(maoy): Now resolve the discrepancy between vm_state and
+        # vm_power_state. We go through all possible vm_states.
+        if vm_state in (vm_states.BUILDING,
+                        vm_states.RESCUED,
+                        vm_states.RESIZED,
+                        vm_states.SUSPENDED,
+                        vm_states.PAUSED,
+                        vm_states.ERROR):
+            # TODO(maoy): we ignore these vm_state for now.
+            pass
+        elif vm_state == vm_states.ACTIVE:
+            # The only rational power state should be RUNNING
+            if vm_power_state in (power_state.NOSTATE,
+                                   power_state.SHUTDOWN,
+                                   power_state.CRASHED):
+                LOG.warn(_("Instance shutdown by itself. Calling "
+                           "the stop API."), instance=db_instance)
+                try:
+                    # Note(maoy): here we call the API instead of
+                    # brutally updating the vm_state in the database
+                    # to allow all the hooks and checks to be performed.
+                    self.compute_api.stop(context, db_instance)
+                except Exception:
+                    # Note(maoy): there is no need to propagate the error
+                    # because the same power_state will be retrieved next
+                    # time and retried.
+                    # For example, there might be another task scheduled.
+                    LOG.exception(_("error during stop() in "
+                                    "sync_power_state."),
+                                  instance=db_instance)
+            elif vm_power_state in (power_state.PAUSED,
+                                    power_state.SUSPENDED):
+                LOG.warn(_("Instance is paused or suspended "
+                           "unexpectedly. Calling "
+                           "the stop API."), instance=db_instance)
+                try:
+                    self.compute_api.stop(context, db_instance)
+                except Exception:
+                    LOG.exception(_("error during stop() in "
+                                    "sync_power_state."),
+                                  instance=db_instance)
+        elif vm_state == vm_states.STOPPED:
+            if vm_power_state not in (power_state.NOSTATE,
+                                      power_state.SHUTDOWN,
+                                      power_state.CRASHED):
+                LOG.warn(_("Instance is not stopped. Calling "
+                           "the stop API."), instance=db_instance)
+                try:
+                    # Note(maoy): this assumes that the stop API is
+                    # idempotent.
+                    self.compute_api.stop(context, db_instance)
+                except Exception:
+                    LOG.exception(_("error during stop() in "
+                                    "sync_power_state."),
+                                  instance=db_instance)
+        elif vm_state in (vm_states.SOFT_DELETED,
+                          vm_states.DELETED):
+            if vm_power_state not in (power_state.NOSTATE,
+                                      power_state.SHUTDOWN):
+                # Note(maoy): this should be taken care of periodically in
+                # _cleanup_running_deleted_instances().
+                LOG.warn(_("Instance is not (soft-)deleted."),
+                         instance=db_instance)
 
     @manager.periodic_task
     def _reclaim_queued_deletes(self, context):
@@ -19,6 +19,8 @@ scheduler with useful information about availability through the ComputeNode
 model.
 """
 
+from eventlet import greenthread
+
 from nova.compute import vm_states
 from nova import db
 from nova import exception
@@ -37,6 +39,19 @@ resource_tracker_opts = [
                help='Amount of memory in MB to reserve for the host'),
     cfg.IntOpt('claim_timeout_seconds', default=600,
                help='How long, in seconds, before a resource claim times out'),
+    cfg.IntOpt('compute_node_flush_interval', default=2,
+               help='Longest time, in seconds, resource usage changes from '
+                    'claims are held back before being written to the '
+                    'compute node record.  Changes made in the meantime are '
+                    'coalesced into a single write.  0 writes them right '
+                    'after every claim'),
+    cfg.IntOpt('resource_audit_interval', default=600,
+               help='How often, in seconds, the usage of the host is '
+                    'recounted from all of its instances in the DB.  In '
+                    'between, update_available_resource only refreshes the '
+                    'hypervisor totals and takes the usage from the claims '
+                    'and instance updates seen by the tracker.  0 recounts '
+                    'on every run'),
     cfg.StrOpt('compute_stats_class',
                default='nova.compute.stats.Stats',
                help='Class that will manage stats for the local compute host')
@@ -47,6 +62,7 @@ FLAGS.register_opts(resource_tracker_opts)
 
 LOG = logging.getLogger(__name__)
 COMPUTE_RESOURCE_SEMAPHORE = "compute_resources"
+COMPUTE_NODE_WRITE_SEMAPHORE = "compute_node_write"
 
 
 class Claim(object):
@@ -122,13 +138,25 @@ class ResourceTracker(object):
         self.next_claim_id = 1
         self.claims = {}
         self.stats = importutils.import_object(FLAGS.compute_stats_class)
+        # usage counted for each instance: { <uuid> : {'memory_mb': ...,
+        # 'local_gb': ...} }
         self.tracked_instances = {}
+        self.last_audit = None
+        # room held back for the host when usage was last counted:
+        self.reserved = {'memory_mb': 0, 'local_gb': 0}
+        # write-behind of the compute node record:
+        self.dirty = False
+        self._flush_timer = None
+        self._flushing = False
+        # each view of the compute node taken for a write gets the next
+        # generation; writes older than the last one done are dropped:
+        self._generation = 0
+        self._written_generation = 0
 
     def resource_claim(self, context, instance_ref, limits=None):
         claim = self.begin_resource_claim(context, instance_ref, limits)
         return ResourceContextManager(context, claim, self)
 
-    @utils.synchronized(COMPUTE_RESOURCE_SEMAPHORE)
     def begin_resource_claim(self, context, instance_ref, limits=None,
                              timeout=None):
         """Indicate that some resources are needed for an upcoming compute
@@ -151,6 +179,16 @@ class ResourceTracker(object):
                   compute operation is finished. Returns None if the claim
                   failed.
         """
+        claim = self._claim_resources(instance_ref, limits, timeout)
+        if claim:
+            self._write_behind(context)
+        return claim
+
+    @utils.synchronized(COMPUTE_RESOURCE_SEMAPHORE)
+    def _claim_resources(self, instance_ref, limits, timeout):
+        """Decide a claim against the in-memory usage of the host.  The
+        compute node record is written later, out of the semaphore.
+        """
         if self.disabled:
             return
 
@@ -191,9 +229,7 @@ class ResourceTracker(object):
 
         # Mark resources in-use and update stats
         self._update_usage_from_instance(self.compute_node, instance_ref)
-
-        # persist changes to the compute node:
-        self._update(context, self.compute_node)
+        self.dirty = True
         return claim
 
     def _can_claim_memory(self, memory_mb, memory_mb_limit):
@@ -308,7 +344,6 @@ class ResourceTracker(object):
             LOG.info(_("Can't find claim %s.  It may have been 'finished' "
                        "twice, or it has already timed out."), claim.claim_id)
 
-    @utils.synchronized(COMPUTE_RESOURCE_SEMAPHORE)
     def abort_resource_claim(self, context, claim):
         """Indicate that the operation that claimed the resources identified by
         'claim_id' has either failed or been aborted and the resources are no
@@ -317,8 +352,16 @@ class ResourceTracker(object):
         :param claim: A claim ticket indicating a set of resources that were
                       previously claimed.
         """
+        if self._release_claim(claim):
+            self._write_behind(context)
+
+    @utils.synchronized(COMPUTE_RESOURCE_SEMAPHORE)
+    def _release_claim(self, claim):
+        """Give back the resources of an aborted claim in memory.  Returns
+        whether the usage changed.
+        """
         if self.disabled:
-            return
+            return False
 
         # un-claim the resources:
         if self.claims.pop(claim.claim_id, None):
@@ -327,28 +370,89 @@ class ResourceTracker(object):
             # and associated stats:
             claim.instance['vm_state'] = vm_states.DELETED
             self._update_usage_from_instance(self.compute_node, claim.instance)
-            self._update(context, self.compute_node)
+            self.dirty = True
+            return True
 
-        else:
-            # can't find the claim.  this may mean the claim already timed
-            # out or it was already explicitly finished/aborted.
-            LOG.audit(_("Claim %s not found.  It either timed out or was "
-                        "already explicitly finished/aborted"), claim.claim_id)
+        # can't find the claim.  this may mean the claim already timed
+        # out or it was already explicitly finished/aborted.
+        LOG.audit(_("Claim %s not found.  It either timed out or was "
+                    "already explicitly finished/aborted"), claim.claim_id)
+        return False
 
-    @utils.synchronized(COMPUTE_RESOURCE_SEMAPHORE)
     def update_usage(self, context, instance):
         """Update the resource usage and stats after a change in an
         instance
         """
+        if self._update_instance_usage(instance):
+            self._write_behind(context.elevated())
+
+    @utils.synchronized(COMPUTE_RESOURCE_SEMAPHORE)
+    def _update_instance_usage(self, instance):
         if self.disabled:
-            return
+            return False
 
         # don't update usage for this instance unless it submitted a resource
         # claim first:
         uuid = instance['uuid']
-        if uuid in self.tracked_instances:
-            self._update_usage_from_instance(self.compute_node, instance)
-            self._update(context.elevated(), self.compute_node)
+        if uuid not in self.tracked_instances:
+            return False
+        self._update_usage_from_instance(self.compute_node, instance)
+        self.dirty = True
+        return True
+
+    def _write_behind(self, context):
+        """Get the in-memory usage written to the compute node record,
+        right away or at the latest compute_node_flush_interval seconds
+        from now, along with every change made until then.
+        """
+        interval = FLAGS.compute_node_flush_interval
+        if interval <= 0:
+            self.flush(context)
+        elif not self._flush_timer:
+            self._flush_timer = greenthread.spawn_after(interval, self.flush,
+                                                        context)
+
+    def flush(self, context):
+        """Write pending resource usage changes to the compute node record.
+
+        Only one flush writes at a time; changes made while it waits on
+        the DB are written by the same flush before it returns.  A
+        snapshot older than the last view written, e.g. by an audit that
+        ran meanwhile, is dropped rather than written over it.
+        """
+        self._flush_timer = None
+        if self._flushing:
+            return
+        self._flushing = True
+        try:
+            while True:
+                changes = self._take_changes()
+                if changes is None:
+                    break
+                generation, values = changes
+                try:
+                    self._write(context, values, generation)
+                except Exception:
+                    LOG.exception(_("Failed to write the resource usage of "
+                                    "compute node %s"), self.host)
+                    self.dirty = True
+                    break
+        finally:
+            self._flushing = False
+
+    @utils.synchronized(COMPUTE_RESOURCE_SEMAPHORE)
+    def _take_changes(self):
+        """Snapshot the compute node for a flush, if it has changed.
+        Returns the generation of the snapshot and its values.
+        """
+        if not self.dirty or self.disabled:
+            return None
+        self.dirty = False
+        values = dict(self.compute_node)
+        if 'stats' in values:
+            values['stats'] = dict(values['stats'])
+        self._generation += 1
+        return self._generation, values
 
     @property
     def disabled(self):
@@ -370,6 +474,7 @@ class ResourceTracker(object):
                 "'get_available_resource'  Compute tracking is disabled."))
             self.compute_node = None
             self.claims = {}
+            self.last_audit = None
             return
 
         self._verify_resources(resources)
@@ -378,6 +483,14 @@ class ResourceTracker(object):
 
         self._purge_expired_claims()
 
+        if not self._audit_due():
+            # usage is up to date from the claims and instance updates,
+            # only the hypervisor view needs to be brought in:
+            self._update_usage_from_tracked(resources)
+            self._report_final_resource_view(resources)
+            self._update_changes(context, resources)
+            return
+
         # Grab all instances assigned to this host:
         filters = {'host': self.host, 'deleted': False}
         instances = db.instance_get_all_by_filters(context, filters)
@@ -387,6 +500,32 @@ class ResourceTracker(object):
         self._report_final_resource_view(resources)
 
         self._sync_compute_node(context, resources)
+        if self.compute_node:
+            self.last_audit = timeutils.utcnow()
+
+    def _audit_due(self):
+        """Whether the usage has to be recounted from the DB instances."""
+        if not self.compute_node or not self.last_audit:
+            return True
+        interval = FLAGS.resource_audit_interval
+        return (interval <= 0 or
+                timeutils.is_older_than(self.last_audit, interval))
+
+    def _update_changes(self, context, resources):
+        """Write the compute node fields that differ from the last write,
+        if any.
+        """
+        if self.dirty or self._flushing:
+            # claims not written yet, or about to be dropped by the
+            # flush in progress, write everything:
+            self._update(context, resources)
+            return
+
+        values = dict((key, value) for key, value in resources.iteritems()
+                      if key != 'stats' and
+                         self.compute_node.get(key) != value)
+        if values:
+            self._update(context, values)
 
     def _sync_compute_node(self, context, resources):
         """Create or update the compute node DB record"""
@@ -428,6 +567,7 @@ class ResourceTracker(object):
         # initialize load stats from existing instances:
         compute_node = db.compute_node_create(context, values)
         self.compute_node = dict(compute_node)
+        self.dirty = False
 
     def _get_service(self, context):
         try:
@@ -469,35 +609,53 @@ class ResourceTracker(object):
         else:
             LOG.audit(_("Free VCPU information unavailable"))
 
+    @utils.synchronized(COMPUTE_NODE_WRITE_SEMAPHORE)
+    def _write(self, context, values, generation):
+        """Persist a snapshot of the compute node to the DB, leaving the
+        in-memory compute node alone.  Nothing is written if a newer view
+        was written since the snapshot was taken."""
+        if generation < self._written_generation:
+            LOG.debug(_("Dropping outdated resource usage of compute node "
+                        "%s"), self.host)
+            return
+        db.compute_node_update(context, self.compute_node['id'], values)
+        self._written_generation = generation
+
     def _update(self, context, values, prune_stats=False):
         """Persist the compute node updates to the DB"""
+        self._generation += 1
+        compute_node = self._write_update(context, values, prune_stats,
+                                          self._generation)
+        self.compute_node = dict(compute_node)
+        self.dirty = False
+
+    @utils.synchronized(COMPUTE_NODE_WRITE_SEMAPHORE)
+    def _write_update(self, context, values, prune_stats, generation):
         compute_node = db.compute_node_update(context,
                 self.compute_node['id'], values, prune_stats)
-        self.compute_node = dict(compute_node)
+        self._written_generation = generation
+        return compute_node
 
     def _update_usage_from_instance(self, resources, instance):
-        """Update usage for a single instance."""
+        """Update usage for a single instance, by the difference between
+        its current size and what was last counted for it.  This covers
+        new, resized and deleted instances alike.
+        """
 
         uuid = instance['uuid']
-        is_new_instance = uuid not in self.tracked_instances
-        is_deleted_instance = instance['vm_state'] == vm_states.DELETED
-
-        if is_new_instance:
-            self.tracked_instances[uuid] = 1
-            sign = 1
-
-        if instance['vm_state'] == vm_states.DELETED:
-            self.tracked_instances.pop(uuid)
-            sign = -1
+        old = self.tracked_instances.pop(uuid, {})
+        new = {}
+        if instance['vm_state'] != vm_states.DELETED:
+            new = {'memory_mb': instance['memory_mb'],
+                   'local_gb': (instance['root_gb'] +
+                                instance['ephemeral_gb'])}
+            self.tracked_instances[uuid] = new
 
         self.stats.update_stats_for_instance(instance)
 
-        # if it's a new or deleted instance:
-        if is_new_instance or is_deleted_instance:
-            # new instance, update compute node resource usage:
-            resources['memory_mb_used'] += sign * instance['memory_mb']
-            resources['local_gb_used'] += sign * instance['root_gb']
-            resources['local_gb_used'] += sign * instance['ephemeral_gb']
+        if new != old:
+            for key in ('memory_mb', 'local_gb'):
+                resources[key + '_used'] += new.get(key, 0) - old.get(key, 0)
 
             # free ram and disk may be negative, depending on policy:
             resources['free_ram_mb'] = (resources['memory_mb'] -
@@ -505,12 +663,44 @@ class ResourceTracker(object):
             resources['free_disk_gb'] = (resources['local_gb'] -
                                          resources['local_gb_used'])
 
-            resources['running_vms'] = self.stats.num_instances
-            resources['vcpus_used'] = self.stats.num_vcpus_used
-
+        resources['running_vms'] = self.stats.num_instances
+        resources['vcpus_used'] = self.stats.num_vcpus_used
         resources['current_workload'] = self.stats.calculate_workload()
         resources['stats'] = self.stats
 
+    def _update_usage_from_tracked(self, resources):
+        """Take the usage of the tracked instances, kept up to date by the
+        claims and instance updates, over the hypervisor totals.
+        """
+        for key in ('memory_mb_used', 'local_gb_used', 'vcpus_used',
+                    'running_vms', 'current_workload'):
+            resources[key] = self.compute_node[key]
+        reserved = self._get_reserved()
+        for key in reserved:
+            resources[key + '_used'] += reserved[key] - self.reserved[key]
+        self.reserved = reserved
+        resources['free_ram_mb'] = (resources['memory_mb'] -
+                                    resources['memory_mb_used'])
+        resources['free_disk_gb'] = (resources['local_gb'] -
+                                     resources['local_gb_used'])
+        self._update_stats_from_hypervisor(resources)
+
+    def _get_reserved(self):
+        return {'memory_mb': FLAGS.reserved_host_memory_mb,
+                'local_gb': FLAGS.reserved_host_disk_mb / 1024}
+
+    def _update_stats_from_hypervisor(self, resources):
+        """Devices the virt driver keeps track of itself, like gpus, reach
+        the scheduler as compute node stats.
+        """
+        for key in ('gpus', 'gpus_used', 'gpu_slots', 'gpu_slots_used'):
+            if key in resources:
+                value = resources.pop(key)
+                if self.stats.get(key) != value:
+                    self.stats[key] = value
+                    self.dirty = True
+        resources['stats'] = self.stats
+
     def _update_usage_from_instances(self, resources, instances):
         """Calculate resource usage based on instance utilization.  This is
         different than the hypervisor's view as it will account for all
@@ -523,8 +713,9 @@ class ResourceTracker(object):
         self.stats.clear()
 
         # set some intiial values, reserve room for host/hypervisor:
-        resources['local_gb_used'] = FLAGS.reserved_host_disk_mb / 1024
-        resources['memory_mb_used'] = FLAGS.reserved_host_memory_mb
+        self.reserved = self._get_reserved()
+        resources['local_gb_used'] = self.reserved['local_gb']
+        resources['memory_mb_used'] = self.reserved['memory_mb']
         resources['vcpus_used'] = 0
         resources['free_ram_mb'] = (resources['memory_mb'] -
                                     resources['memory_mb_used'])
@@ -536,6 +727,8 @@ class ResourceTracker(object):
         for instance in instances:
             self._update_usage_from_instance(resources, instance)
 
+        self._update_stats_from_hypervisor(resources)
+
     def _verify_resources(self, resources):
         resource_keys = ["vcpus", "memory_mb", "local_gb", "cpu_info",
                          "vcpus_used", "memory_mb_used", "local_gb_used"]
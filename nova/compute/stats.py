@@ -94,6 +94,8 @@ class Stats(dict):
         else:
             # new instance
             self._increment("num_instances")
+            # reported so the scheduler can tell it has been counted:
+            self["instance_%s" % uuid] = 1
 
         # Now update stats from the new instance state:
         (vm_state, task_state, os_type, project_id, vcpus) = \
@@ -102,6 +104,7 @@ class Stats(dict):
         if vm_state == vm_states.DELETED:
             self._decrement("num_instances")
             self.states.pop(uuid)
+            self.pop("instance_%s" % uuid, None)
 
         else:
             self._increment("num_vm_%s" % vm_state)
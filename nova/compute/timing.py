@@ -0,0 +1,131 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 University of Southern California
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Timing of the phases of building an instance.
+
+The compute manager starts a build with start() and the code it calls, down
+to the virt driver and the image helpers, times its phases with span().
+Spans are kept for the build running in the current greenthread, so that
+they can be sent in a notification when the build ends, and are added to a
+histogram per phase for the whole life of the compute service.
+"""
+
+import bisect
+import contextlib
+import time
+
+from eventlet import corolocal
+
+
+# upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_local = corolocal.local()
+_histograms = {}
+
+
+class Histogram(object):
+    """Number of times a phase took up to each of BUCKETS seconds."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket the percentile falls in."""
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': [[bound, count] for bound, count
+                            in zip(BUCKETS + (None,), self.counts)]}
+
+
+def start():
+    """Start collecting the spans of the build in this greenthread."""
+    _local.started_at = time.time()
+    _local.spans = []
+
+
+def stop():
+    """Stop collecting spans and return the ones of this build, ordered
+    by when they started, with a 'build' span for the whole build.
+    """
+    spans = getattr(_local, 'spans', None)
+    if spans is None:
+        return []
+    _local.spans = None
+    _add(spans, 'build', _local.started_at, False)
+    return sorted(spans, key=lambda span: span['start'])
+
+
+def _add(spans, phase, started_at, failed):
+    seconds = time.time() - started_at
+    if not failed:
+        _histograms.setdefault(phase, Histogram()).add(seconds)
+    if spans is not None:
+        spans.append({'phase': phase,
+                      'start': started_at - _local.started_at,
+                      'seconds': seconds,
+                      'failed': failed})
+
+
+@contextlib.contextmanager
+def span(phase):
+    """Time the with block as the given build phase.
+
+    Phases that raise are kept in the build spans, with failed set, but
+    not in the histograms, so that fast failures do not hide regressions.
+    """
+    started_at = time.time()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        _add(getattr(_local, 'spans', None), phase, started_at, failed)
+
+
+def summary():
+    """Histogram summary of every phase timed so far."""
+    return dict((phase, histogram.summary())
+                for phase, histogram in _histograms.iteritems())
+
+
+def reset():
+    _histograms.clear()
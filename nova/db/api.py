@@ -41,11 +41,21 @@ these objects be simple dictionaries.
 :enable_new_services:  when adding a new service to the database, is it in the
                        pool of available hardware (Default: True)
 
+:db_use_tpool:  run the calls to the backend in native threads, so that the
+                blocking database driver does not stop the other
+                greenthreads of the service (Default: False)
+
 """
 
+import functools
+import time
+
+from eventlet import tpool
+
 from nova import exception
 from nova import flags
 from nova.openstack.common import cfg
+from nova.openstack.common import log as logging
 from nova import utils
 
 
@@ -65,13 +75,60 @@ db_opts = [
     cfg.StrOpt('snapshot_name_template',
                default='snapshot-%s',
                help='Template string to be used to generate snapshot names'),
+    cfg.BoolOpt('db_use_tpool',
+                default=False,
+                help='Run the db calls in a pool of native threads, so that '
+                     'a slow query does not block the whole service'),
+    cfg.IntOpt('db_tpool_size',
+               default=10,
+               help='Number of db calls that run in native threads at the '
+                    'same time when db_use_tpool is set. The sql connection '
+                    'pool is sized to match'),
+    cfg.FloatOpt('db_slow_call_time',
+                 default=1.0,
+                 help='Log the db calls that take longer than this many '
+                      'seconds. 0 does not log any'),
     ]
 
 FLAGS = flags.FLAGS
 FLAGS.register_opts(db_opts)
 
-IMPL = utils.LazyPluggable('db_backend',
-                           sqlalchemy='nova.db.sqlalchemy.api')
+LOG = logging.getLogger(__name__)
+
+
+class DbapiWrapper(object):
+    """Calls the functions of the db backend, logging the slow ones and,
+    when db_use_tpool is set, running them in eventlet's native threads.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def _call(self, name, fn, *args, **kwargs):
+        start = time.time()
+        try:
+            if not FLAGS.db_use_tpool:
+                return fn(*args, **kwargs)
+            # NOTE: the native threads are shared with the virt drivers,
+            # only db_tpool_size of them wait on the database at once
+            with utils.concurrency_limit('db', FLAGS.db_tpool_size):
+                return tpool.execute(fn, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            if FLAGS.db_slow_call_time and \
+                    elapsed > FLAGS.db_slow_call_time:
+                LOG.warn(_('db call %(name)s took %(elapsed).2f seconds'),
+                         locals())
+
+    def __getattr__(self, key):
+        attr = getattr(self._backend, key)
+        if not callable(attr):
+            return attr
+        return functools.partial(self._call, key, attr)
+
+
+IMPL = DbapiWrapper(utils.LazyPluggable('db_backend',
+                                        sqlalchemy='nova.db.sqlalchemy.api'))
 
 
 class NoMoreNetworks(exception.NovaException):
@@ -193,9 +250,15 @@ def compute_node_get(context, compute_id):
     return IMPL.compute_node_get(context, compute_id)
 
 
-def compute_node_get_all(context):
-    """Get all computeNodes."""
-    return IMPL.compute_node_get_all(context)
+def compute_node_get_all(context, updated_since=None, use_slave=False):
+    """Get all computeNodes.
+
+    If updated_since is given, only return the computeNodes created,
+    updated or deleted since then.  If use_slave is set, they may be read
+    from the slave database.
+    """
+    return IMPL.compute_node_get_all(context, updated_since=updated_since,
+                                     use_slave=use_slave)
 
 
 def compute_node_get_all_by_arch(context, cpu_arch, xpu_arch, session=None):
@@ -241,6 +304,11 @@ def compute_node_get_by_host(context, host):
     return IMPL.compute_node_get_by_host(context, host)
 
 
+def compute_node_get_by_hosts(context, hosts):
+    """Get the capacity entries of the given hosts, in a dict by host."""
+    return IMPL.compute_node_get_by_hosts(context, hosts)
+
+
 def compute_node_statistics(context):
     return IMPL.compute_node_statistics(context)
 
@@ -608,33 +676,43 @@ def instance_get_all(context, columns_to_join=None):
 
 
 def instance_get_all_by_filters(context, filters, sort_key='created_at',
-                                sort_dir='desc', limit=None, marker=None):
-    """Get all instances that match all filters."""
+                                sort_dir='desc', limit=None, marker=None,
+                                use_slave=False):
+    """Get all instances that match all filters.
+
+    If use_slave is set, they may be read from the slave database.
+    """
     return IMPL.instance_get_all_by_filters(context, filters, sort_key,
                                             sort_dir, limit=limit,
-                                            marker=marker)
+                                            marker=marker,
+                                            use_slave=use_slave)
 
 
 def instance_get_active_by_window(context, begin, end=None, project_id=None,
-                                  host=None):
+                                  host=None, use_slave=False):
     """Get instances active during a certain time window.
 
     Specifying a project_id will filter for a certain project.
     Specifying a host will filter for instances on a given compute host.
+    Specifying use_slave allows reading them from the slave database.
     """
     return IMPL.instance_get_active_by_window(context, begin, end,
-                                              project_id, host)
+                                              project_id, host,
+                                              use_slave=use_slave)
 
 
 def instance_get_active_by_window_joined(context, begin, end=None,
-                                         project_id=None, host=None):
+                                         project_id=None, host=None,
+                                         use_slave=False):
     """Get instances and joins active during a certain time window.
 
     Specifying a project_id will filter for a certain project.
     Specifying a host will filter for instances on a given compute host.
+    Specifying use_slave allows reading them from the slave database.
     """
     return IMPL.instance_get_active_by_window_joined(context, begin, end,
-                                              project_id, host)
+                                              project_id, host,
+                                              use_slave=use_slave)
 
 
 def instance_get_all_by_project(context, project_id):
@@ -702,6 +780,14 @@ def instance_update_and_get_original(context, instance_uuid, values):
                                                  values)
 
 
+def instance_update_power_states(context, power_states):
+    """Set the power_state of many instances at once.
+
+    :param power_states: = dict of instance uuid to power state
+    """
+    return IMPL.instance_update_power_states(context, power_states)
+
+
 def instance_add_security_group(context, instance_id, security_group_id):
     """Associate the given security group with the given instance."""
     return IMPL.instance_add_security_group(context, instance_id,
@@ -1057,6 +1143,25 @@ def quota_reserve(context, resources, quotas, deltas, expire,
                               until_refresh, max_age)
 
 
+def quota_reserve_by_update(context, resources, quotas, deltas, expire,
+                            until_refresh):
+    """Check quotas and create reservations, without locking or syncing
+    all the usages of the project."""
+    return IMPL.quota_reserve_by_update(context, resources, quotas, deltas,
+                                        expire, until_refresh)
+
+
+def quota_usage_get_stale_projects(context, max_age):
+    """Get the ids of the projects with usages to refresh."""
+    return IMPL.quota_usage_get_stale_projects(context, max_age)
+
+
+def quota_usage_refresh(context, resources, project_id, until_refresh):
+    """Sync the in_use counts of the usages of a project."""
+    return IMPL.quota_usage_refresh(context, resources, project_id,
+                                    until_refresh)
+
+
 def reservation_commit(context, reservations):
     """Commit quota reservations."""
     return IMPL.reservation_commit(context, reservations)
@@ -1288,9 +1393,10 @@ def security_group_get_by_project(context, project_id):
     return IMPL.security_group_get_by_project(context, project_id)
 
 
-def security_group_get_by_instance(context, instance_id):
+def security_group_get_by_instance(context, instance_id, use_slave=False):
     """Get security groups to which the instance is assigned."""
-    return IMPL.security_group_get_by_instance(context, instance_id)
+    return IMPL.security_group_get_by_instance(context, instance_id,
+                                               use_slave=use_slave)
 
 
 def security_group_exists(context, project_id, group_name):
@@ -1569,9 +1675,10 @@ def bw_usage_get(context, uuid, start_period, mac):
     return IMPL.bw_usage_get(context, uuid, start_period, mac)
 
 
-def bw_usage_get_by_uuids(context, uuids, start_period):
+def bw_usage_get_by_uuids(context, uuids, start_period, use_slave=False):
     """Return bw usages for instance(s) in a given audit period."""
-    return IMPL.bw_usage_get_by_uuids(context, uuids, start_period)
+    return IMPL.bw_usage_get_by_uuids(context, uuids, start_period,
+                                      use_slave=use_slave)
 
 
 def bw_usage_update(context, uuid, mac, start_period, bw_in, bw_out,
@@ -1941,3 +2048,18 @@ def task_log_get(context, task_name, period_beginning,
                  period_ending, host, state=None, session=None):
     return IMPL.task_log_get(context, task_name, period_beginning,
                  period_ending, host, state, session)
+
+
+####################
+
+
+def archive_deleted_rows(context, max_rows):
+    """Move up to max_rows deleted rows from the tables to their shadow
+    tables, and return how many were moved."""
+    return IMPL.archive_deleted_rows(context, max_rows)
+
+
+def archive_deleted_rows_for_table(context, tablename, max_rows):
+    """Move up to max_rows deleted rows from a table to its shadow
+    table, and return how many were moved."""
+    return IMPL.archive_deleted_rows_for_table(context, tablename, max_rows)
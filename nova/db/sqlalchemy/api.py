@@ -23,6 +23,7 @@ import collections
 import copy
 import datetime
 import functools
+import re
 import warnings
 
 from nova import block_device
@@ -38,13 +39,18 @@ from nova.openstack.common import timeutils
 from nova import utils
 from sqlalchemy import and_
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import NoSuchTableError
+from sqlalchemy import MetaData
 from sqlalchemy import or_
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm import joinedload_all
-from sqlalchemy.sql.expression import asc
+from sqlalchemy.orm import subqueryload
+from sqlalchemy.sql import exists
 from sqlalchemy.sql.expression import desc
 from sqlalchemy.sql.expression import literal_column
 from sqlalchemy.sql import func
+from sqlalchemy.sql import select
+from sqlalchemy import Table
 
 FLAGS = flags.FLAGS
 
@@ -195,8 +201,11 @@ def model_query(context, model, *args, **kwargs):
     :param project_only: if present and context is user-type, then restrict
             query to match the context's project_id. If set to 'allow_none',
             restriction includes project_id = None.
+    :param use_slave: if present and no session is given, read from the
+            slave database when there is one.
     """
-    session = kwargs.get('session') or get_session()
+    session = kwargs.get('session') or \
+            get_session(slave_session=kwargs.get('use_slave', False))
     read_deleted = kwargs.get('read_deleted') or context.read_deleted
     project_only = kwargs.get('project_only', False)
 
@@ -500,23 +509,28 @@ def compute_node_get(context, compute_id, session=None):
 
 
 @require_admin_context
-def compute_node_get_all(context, session=None):
-    return model_query(context, models.ComputeNode, session=session).\
-            options(joinedload('service')).\
-            options(joinedload('stats')).\
-            all()
+def compute_node_get_all(context, updated_since=None, session=None,
+                         use_slave=False):
+    if updated_since is None:
+        query = model_query(context, models.ComputeNode, session=session,
+                            use_slave=use_slave)
+    else:
+        # Deleted nodes are returned as well, so that callers keeping a
+        # copy of the compute nodes can forget about them.
+        query = model_query(context, models.ComputeNode, session=session,
+                            read_deleted="yes", use_slave=use_slave).\
+                filter(or_(models.ComputeNode.updated_at >= updated_since,
+                           models.ComputeNode.created_at >= updated_since))
+    return query.options(joinedload('service')).\
+                 options(joinedload('stats')).\
+                 all()
 
 
 @require_admin_context
 def compute_node_get_all_by_arch(context, cpu_arch, xpu_arch, session=None):
-    if not session:
-        session = get_session()
-
-                     #add if available=True?
-    result = session.query(models.ComputeNode).\
+    result = model_query(context, models.ComputeNode, session=session).\
                      filter_by(cpu_arch=cpu_arch).\
                      filter_by(xpu_arch=xpu_arch).\
-                     filter_by(deleted=can_read_deleted(context)).\
                      all()
 
     if not result:
@@ -528,12 +542,8 @@ def compute_node_get_all_by_arch(context, cpu_arch, xpu_arch, session=None):
 
 @require_admin_context
 def compute_node_get_by_cpu_arch(context, cpu_arch, session=None):
-    if not session:
-        session = get_session()
-
-    result = session.query(models.ComputeNode).\
+    result = model_query(context, models.ComputeNode, session=session).\
                      filter_by(cpu_arch=cpu_arch).\
-                     filter_by(deleted=can_read_deleted(context)).\
                      first()
 
     if not result:
@@ -545,12 +555,8 @@ def compute_node_get_by_cpu_arch(context, cpu_arch, session=None):
 
 @require_admin_context
 def compute_node_get_by_xpu_arch(context, xpu_arch, session=None):
-    if not session:
-        session = get_session()
-
-    result = session.query(models.ComputeNode).\
+    result = model_query(context, models.ComputeNode, session=session).\
                      filter_by(xpu_arch=xpu_arch).\
-                     filter_by(deleted=can_read_deleted(context)).\
                      first()
 
     if not result:
@@ -647,7 +653,9 @@ def compute_node_update(context, compute_id, values, prune_stats=False):
     with session.begin(subtransactions=True):
         _update_stats(context, stats, compute_id, session, prune_stats)
         compute_ref = compute_node_get(context, compute_id, session=session)
-        compute_ref.update(values)
+        # Always bump updated_at, even when only the stats changed, so
+        # that compute_node_get_all(updated_since=...) sees the update.
+        compute_ref.update(dict(values, updated_at=timeutils.utcnow()))
     return compute_ref
 
 
@@ -662,6 +670,24 @@ def compute_node_get_by_host(context, host):
         return node.first()
 
 
+def compute_node_get_by_hosts(context, hosts):
+    """Get the capacity entries of the given hosts, by host."""
+    if not hosts:
+        return {}
+
+    rows = model_query(context, models.Service.host, models.ComputeNode,
+                       read_deleted="no").\
+                   join(models.ComputeNode.service).\
+                   filter(models.Service.host.in_(hosts)).\
+                   filter(models.ComputeNode.deleted == False).\
+                   all()
+
+    output = {}
+    for host, node in rows:
+        output.setdefault(host, node)
+    return output
+
+
 def compute_node_statistics(context):
     """Compute statistics over all compute nodes."""
     result = model_query(context,
@@ -1620,20 +1646,13 @@ def instance_get_all(context, columns_to_join=None):
 
 @require_context
 def instance_get_all_by_filters(context, filters, sort_key, sort_dir,
-                                limit=None, marker=None):
+                                limit=None, marker=None, use_slave=False):
     """Return instances that match all filters.  Deleted instances
     will be returned by default, unless there's a filter that says
     otherwise"""
 
-    sort_fn = {'desc': desc, 'asc': asc}
-
-    session = get_session()
-    query_prefix = session.query(models.Instance).\
-            options(joinedload('info_cache')).\
-            options(joinedload('security_groups')).\
-            options(joinedload('metadata')).\
-            options(joinedload('instance_type')).\
-            order_by(sort_fn[sort_dir](getattr(models.Instance, sort_key)))
+    session = get_session(slave_session=use_slave)
+    query_prefix = session.query(models.Instance)
 
     # Make a copy of the filters dictionary to use going forward, as we'll
     # be modifying it and we shouldn't affect the caller's use of it.
@@ -1681,19 +1700,99 @@ def instance_get_all_by_filters(context, filters, sort_key, sort_dir,
             marker = instance_get_by_uuid(context, marker, session=session)
         except exception.InstanceNotFound as e:
             raise exception.MarkerNotFound(marker)
+    sort_keys = [sort_key]
+    for key in ('created_at', 'id'):
+        if key not in sort_keys:
+            sort_keys.append(key)
     query_prefix = paginate_query(query_prefix, models.Instance, limit,
-                           [sort_key, 'created_at', 'id'],
+                           sort_keys,
                            marker=marker,
                            sort_dir=sort_dir)
 
+    # NOTE: the related rows are not joined to the query, the joins would
+    # multiply the rows the database sorts and pages through, they are
+    # loaded for the instances of the page only
     instances = query_prefix.all()
+    _instances_load_related(session, instances)
     return instances
 
 
+def _instances_load_related(session, instances):
+    """Load the info_cache, security_groups, metadata and instance_type of
+    the instances, with a few queries over their ids.
+    """
+    if not instances:
+        return
+    # NOTE: the instances are in the session already, this fills in
+    # their relations that are not loaded yet. The join condition of
+    # security_groups refers to instances, so it can not be subquery loaded
+    session.query(models.Instance).\
+            filter(models.Instance.id.in_([i.id for i in instances])).\
+            options(subqueryload('info_cache')).\
+            options(joinedload('security_groups')).\
+            options(subqueryload('metadata')).\
+            options(subqueryload('instance_type')).\
+            all()
+
+
+_REGEX_SPECIAL = frozenset('.^$*+?{}[]|()\\')
+_LIKE_SPECIAL = re.compile(r'([%_!])')
+
+
+def _regex_literal(regex):
+    """Return the text a regular expression matches literally, None if it
+    is not a literal.  Metacharacters escaped with a backslash are literal.
+    """
+    literal = []
+    chars = iter(regex)
+    for char in chars:
+        if char == '\\':
+            char = next(chars, None)
+            if char is None or char.isalnum() or char == '_':
+                # \d, \w, \b, ... or a trailing backslash
+                return None
+        elif char in _REGEX_SPECIAL:
+            return None
+        literal.append(char)
+    return ''.join(literal)
+
+
+def regex_clause(column_attr, regex):
+    """Return an equality or LIKE clause matching the same values as the
+    regular expression, or None if it cannot be written as one.
+
+    A regular expression is a search, so only the anchored ones become
+    clauses that can use an index: '^abc$' an equality and '^abc' a
+    LIKE 'abc%'.  Other literals become a LIKE '%abc%', which at least
+    skips evaluating a regular expression for every row.
+    """
+    starts = regex.startswith('^')
+    if starts:
+        regex = regex[1:]
+    ends = regex.endswith('$') and not regex.endswith('\\$')
+    if ends:
+        regex = regex[:-1]
+
+    literal = _regex_literal(regex)
+    if literal is None:
+        return None
+    if starts and ends:
+        return column_attr == literal
+
+    # NOTE: backslash is an escape in the string literals of some dbs
+    pattern = _LIKE_SPECIAL.sub(r'!\1', literal)
+    if not starts:
+        pattern = '%' + pattern
+    if not ends:
+        pattern = pattern + '%'
+    return column_attr.like(pattern, escape='!')
+
+
 def regex_filter(query, model, filters):
     """Applies regular expression filtering to a query.
 
-    Returns the updated query.
+    Returns the updated query.  The regular expressions that are literals
+    are matched with equality or LIKE clauses, see regex_clause().
 
     :param query: query to apply filters to
     :param model: model object the query applies to
@@ -1715,16 +1814,24 @@ def regex_filter(query, model, filters):
             continue
         if 'property' == type(column_attr).__name__:
             continue
-        query = query.filter(column_attr.op(db_regexp_op)(
-                                    str(filters[filter_name])))
+        value = filters[filter_name]
+        if not isinstance(value, basestring):
+            value = str(value)
+        clause = None
+        if db_regexp_op != 'LIKE':
+            clause = regex_clause(column_attr, value)
+        if clause is None:
+            clause = column_attr.op(db_regexp_op)(value)
+        query = query.filter(clause)
     return query
 
 
 @require_context
 def instance_get_active_by_window(context, begin, end=None,
-                                  project_id=None, host=None):
+                                  project_id=None, host=None,
+                                  use_slave=False):
     """Return instances that were active during window."""
-    session = get_session()
+    session = get_session(slave_session=use_slave)
     query = session.query(models.Instance)
 
     query = query.filter(or_(models.Instance.terminated_at == None,
@@ -1741,9 +1848,10 @@ def instance_get_active_by_window(context, begin, end=None,
 
 @require_admin_context
 def instance_get_active_by_window_joined(context, begin, end=None,
-                                         project_id=None, host=None):
+                                         project_id=None, host=None,
+                                         use_slave=False):
     """Return instances and joins that were active during window."""
-    session = get_session()
+    session = get_session(slave_session=use_slave)
     query = session.query(models.Instance)
 
     query = query.options(joinedload('info_cache')).\
@@ -1897,6 +2005,21 @@ def instance_update_and_get_original(context, instance_uuid, values):
                             copy_old_instance=True)
 
 
+@require_context
+def instance_update_power_states(context, power_states):
+    uuids_by_state = {}
+    for instance_uuid, state in power_states.iteritems():
+        uuids_by_state.setdefault(state, []).append(instance_uuid)
+
+    session = get_session()
+    with session.begin():
+        for state, uuids in uuids_by_state.iteritems():
+            model_query(context, models.Instance, session=session).\
+                    filter(models.Instance.uuid.in_(uuids)).\
+                    update({'power_state': state},
+                           synchronize_session=False)
+
+
 def _instance_update(context, instance_uuid, values, copy_old_instance=False):
     session = get_session()
 
@@ -2867,6 +2990,163 @@ def quota_reserve(context, resources, quotas, deltas, expire,
     return reservations
 
 
+def _quota_usages_get_or_create(context, project_id, resources, names,
+                                until_refresh):
+    """Return the usages of the project, without locking them.
+
+    Usages of the named resources that do not exist yet are created, with
+    in_use counted by the sync routine of their resource.
+    """
+    session = get_session()
+    rows = model_query(context, models.QuotaUsage, session=session,
+                       read_deleted="no").\
+                   filter_by(project_id=project_id).\
+                   all()
+    usages = dict((row.resource, row) for row in rows)
+
+    work = set(name for name in names if name not in usages)
+    if work:
+        with session.begin():
+            while work:
+                resource = work.pop()
+                updates = resources[resource].sync(context, project_id,
+                                                   session)
+                updates.setdefault(resource, 0)
+                for res, in_use in updates.items():
+                    if res in usages:
+                        continue
+                    usages[res] = quota_usage_create(context, project_id,
+                                                     res, in_use, 0,
+                                                     until_refresh or None,
+                                                     session=session)
+                    work.discard(res)
+    return usages
+
+
+@require_context
+def quota_reserve_by_update(context, resources, quotas, deltas, expire,
+                            until_refresh):
+    """Check quotas and create reservations with conditional updates.
+
+    Unlike quota_reserve, this neither locks all the usages of the project
+    nor syncs them: each positive delta is added to the reserved count of
+    its usage with a single UPDATE that only matches when the new total
+    is within the quota.  Usages are synced by quota_usage_refresh.
+    """
+    elevated = context.elevated()
+    usages = _quota_usages_get_or_create(elevated, context.project_id,
+                                         resources, deltas.keys(),
+                                         until_refresh)
+
+    unders = [resource for resource, delta in deltas.items()
+              if delta < 0 and
+              delta + usages[resource].in_use < 0]
+
+    session = get_session()
+    with session.begin():
+        # NOTE: the usages are updated in the order of their ids, the one
+        # the other quota functions lock them in, so that they can not
+        # deadlock with each other
+        overs = []
+        for resource in sorted(deltas, key=lambda res: usages[res].id):
+            delta = deltas[resource]
+            # NOTE: like quota_reserve, only positive increments are
+            # checked and reserved
+            if delta <= 0:
+                continue
+
+            query = model_query(elevated, models.QuotaUsage,
+                                session=session, read_deleted="no").\
+                            filter_by(id=usages[resource].id)
+            if quotas[resource] >= 0:
+                query = query.filter(models.QuotaUsage.in_use +
+                                     models.QuotaUsage.reserved + delta <=
+                                     quotas[resource])
+            updated = query.update(
+                    {'reserved': models.QuotaUsage.reserved + delta,
+                     'until_refresh': models.QuotaUsage.until_refresh - 1},
+                    synchronize_session=False)
+            if not updated:
+                overs.append(resource)
+
+        # NOTE: raising in the transaction rolls back the reserved
+        # counts already added for the other resources
+        if overs:
+            usages = dict((k, dict(in_use=v['in_use'],
+                                   reserved=v['reserved']))
+                          for k, v in usages.items())
+            raise exception.OverQuota(overs=sorted(overs), quotas=quotas,
+                                      usages=usages)
+
+        reservations = []
+        for resource, delta in deltas.items():
+            reservation = reservation_create(elevated,
+                                             str(utils.gen_uuid()),
+                                             usages[resource],
+                                             context.project_id,
+                                             resource, delta, expire,
+                                             session=session)
+            reservations.append(reservation.uuid)
+
+    if unders:
+        LOG.warning(_("Change will make usage less than 0 for the following "
+                      "resources: %(unders)s") % locals())
+
+    return reservations
+
+
+@require_admin_context
+def quota_usage_get_stale_projects(context, max_age):
+    """Return the ids of the projects with usages to refresh."""
+    criteria = [models.QuotaUsage.in_use < 0,
+                models.QuotaUsage.until_refresh <= 0]
+    if max_age:
+        refreshed_before = timeutils.utcnow() - \
+                datetime.timedelta(seconds=max_age)
+        criteria.append(or_(
+                models.QuotaUsage.updated_at < refreshed_before,
+                and_(models.QuotaUsage.updated_at == None,
+                     models.QuotaUsage.created_at < refreshed_before)))
+
+    rows = model_query(context, models.QuotaUsage.project_id,
+                       read_deleted="no").\
+                   filter(or_(*criteria)).\
+                   distinct().\
+                   all()
+    return [row[0] for row in rows]
+
+
+@require_admin_context
+def quota_usage_refresh(context, resources, project_id, until_refresh):
+    """Set the in_use count of the usages of the project to the one
+    counted by the sync routine of their resource.
+    """
+    session = get_session()
+    with session.begin():
+        rows = model_query(context, models.QuotaUsage, session=session,
+                           read_deleted="no").\
+                       filter_by(project_id=project_id).\
+                       order_by(models.QuotaUsage.id).\
+                       with_lockmode('update').\
+                       all()
+        usages = dict((row.resource, row) for row in rows)
+
+        work = set(usages.keys())
+        while work:
+            resource = work.pop()
+            sync = getattr(resources.get(resource), 'sync', None)
+            if sync is None:
+                continue
+
+            updates = sync(context, project_id, session)
+            for res, in_use in updates.items():
+                if res in usages:
+                    usages[res].in_use = in_use
+                    usages[res].until_refresh = until_refresh or None
+                    usages[res].save(session=session)
+                work.discard(res)
+
+
 def _quota_reservations(session, context, reservations):
     """Return the relevant reservations."""
 
@@ -3479,9 +3759,11 @@ def block_device_mapping_destroy_by_instance_and_device(context, instance_uuid,
 ###################
 
 def _security_group_get_query(context, session=None, read_deleted=None,
-                              project_only=False, join_rules=True):
+                              project_only=False, join_rules=True,
+                              use_slave=False):
     query = model_query(context, models.SecurityGroup, session=session,
-            read_deleted=read_deleted, project_only=project_only)
+            read_deleted=read_deleted, project_only=project_only,
+            use_slave=use_slave)
     if join_rules:
         query = query.options(joinedload_all('rules'))
     return query
@@ -3561,8 +3843,9 @@ def security_group_get_by_project(context, project_id):
 
 
 @require_context
-def security_group_get_by_instance(context, instance_id):
-    return _security_group_get_query(context, read_deleted="no").\
+def security_group_get_by_instance(context, instance_id, use_slave=False):
+    return _security_group_get_query(context, read_deleted="no",
+                                     use_slave=use_slave).\
                    join(models.SecurityGroup.instances).\
                    filter_by(id=instance_id).\
                    all()
@@ -4400,8 +4683,9 @@ def bw_usage_get(context, uuid, start_period, mac):
 
 
 @require_context
-def bw_usage_get_by_uuids(context, uuids, start_period):
-    return model_query(context, models.BandwidthUsage, read_deleted="yes").\
+def bw_usage_get_by_uuids(context, uuids, start_period, use_slave=False):
+    return model_query(context, models.BandwidthUsage, read_deleted="yes",
+                       use_slave=use_slave).\
                    filter(models.BandwidthUsage.uuid.in_(uuids)).\
                    filter_by(start_period=start_period).\
                    all()
@@ -5353,3 +5637,75 @@ def task_log_end_task(context, task_name,
         task.errors = errors
         task.save(session=session)
     return task
+
+
+##################
+
+
+# NOTE: the tables deleted rows are archived to, created by migration 138
+_SHADOW_TABLE_PREFIX = 'shadow_'
+
+
+@require_admin_context
+def archive_deleted_rows_for_table(context, tablename, max_rows):
+    """Move up to max_rows deleted rows from a table to its shadow table.
+    Rows other rows still refer to, deleted or not, are left in place.
+
+    :returns: the number of rows archived.
+    """
+    session = get_session()
+    meta = MetaData(bind=session.get_bind())
+    try:
+        table = Table(tablename, meta, autoload=True)
+        shadow_table = Table(_SHADOW_TABLE_PREFIX + tablename, meta,
+                             autoload=True)
+        conditions = [table.c.deleted != False]
+        for model_table in models.BASE.metadata.sorted_tables:
+            for fk in model_table.foreign_keys:
+                target_table, target_column = fk.target_fullname.split('.')
+                if target_table != tablename:
+                    continue
+                referring = Table(model_table.name, meta, autoload=True)
+                conditions.append(~exists().where(
+                        referring.c[fk.parent.name] ==
+                        table.c[target_column]))
+    except NoSuchTableError:
+        return 0
+
+    column = list(table.primary_key.columns)[0]
+    query = select([table], and_(*conditions)).\
+            order_by(column).\
+            limit(max_rows)
+    try:
+        with session.begin():
+            rows = session.execute(query).fetchall()
+            if rows:
+                session.execute(shadow_table.insert(),
+                                [dict(row) for row in rows])
+                session.execute(table.delete().where(
+                        column.in_([row[column.name] for row in rows])))
+    except IntegrityError:
+        # NOTE: foreign keys of the DB unknown to the models may still
+        # refer to deleted rows
+        LOG.warn(_("Deleted rows of %(tablename)s are still referred to, "
+                   "they were not archived") % locals())
+        return 0
+    return len(rows)
+
+
+@require_admin_context
+def archive_deleted_rows(context, max_rows):
+    """Move up to max_rows deleted rows from the tables to their shadow
+    tables, those of the tables that refer to others first.
+
+    :returns: the number of rows archived.
+    """
+    rows_archived = 0
+    for table in reversed(models.BASE.metadata.sorted_tables):
+        if 'deleted' not in table.c:
+            continue
+        rows_archived += archive_deleted_rows_for_table(
+                context, table.name, max_rows - rows_archived)
+        if rows_archived >= max_rows:
+            break
+    return rows_archived
@@ -0,0 +1,39 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 University of Southern California
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import Column, MetaData, String, Table
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    # add columns:
+    compute_nodes = Table('compute_nodes', meta, autoload=True)
+    cpu_arch = Column('cpu_arch', String(255))
+    xpu_arch = Column('xpu_arch', String(255))
+    compute_nodes.create_column(cpu_arch)
+    compute_nodes.create_column(xpu_arch)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    compute_nodes = Table('compute_nodes', meta, autoload=True)
+    compute_nodes.drop_column('cpu_arch')
+    compute_nodes.drop_column('xpu_arch')
@@ -0,0 +1,77 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 University of Southern California
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import BigInteger, Column, MetaData, Table
+from sqlalchemy.types import NullType
+
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+# NOTE: the rows that archive_deleted_rows moves out of a table are kept
+# in the table of the same name with this prefix. Migrations that add or
+# drop columns of a table should do the same to its shadow table.
+SHADOW_TABLE_PREFIX = 'shadow_'
+
+
+def _soft_deleted_tables(meta):
+    return [table for table in meta.sorted_tables
+            if 'deleted' in table.c and
+            not table.name.startswith(SHADOW_TABLE_PREFIX)]
+
+
+def _column_type(column):
+    # NOTE: sqlite does not reflect BIGINT columns, the only ones it
+    # does not know the type of
+    if isinstance(column.type, NullType):
+        return BigInteger()
+    return column.type
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+    meta.reflect(migrate_engine)
+
+    for table in _soft_deleted_tables(meta):
+        # only the columns: shadow tables have no foreign keys, unique
+        # constraints or indexes, and ids are copied from the rows
+        columns = [Column(column.name, _column_type(column),
+                          primary_key=column.primary_key,
+                          nullable=column.nullable,
+                          autoincrement=False)
+                   for column in table.columns]
+        shadow_table = Table(SHADOW_TABLE_PREFIX + table.name, meta,
+                             *columns,
+                             mysql_engine='InnoDB',
+                             mysql_charset='utf8')
+        try:
+            shadow_table.create()
+        except Exception:
+            LOG.info(repr(shadow_table))
+            LOG.exception('Exception while creating table.')
+            raise
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+    meta.reflect(migrate_engine)
+
+    for table in meta.sorted_tables:
+        if table.name.startswith(SHADOW_TABLE_PREFIX):
+            table.drop()
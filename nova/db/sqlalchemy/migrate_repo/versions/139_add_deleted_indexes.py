@@ -0,0 +1,60 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 University of Southern California
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import Index, MetaData, Table
+from sqlalchemy.exc import IntegrityError
+
+
+# Based on the lookups of live rows by instance or by security group of
+# instance_metadata_get, fixed_ip_get_by_instance,
+# virtual_interface_get_by_instance and
+# security_group_rule_get_by_security_group
+# from: nova/db/sqlalchemy/api.py
+INDEXES = [
+    ('instance_metadata', 'instance_metadata_instance_uuid_deleted_idx',
+     ('instance_uuid', 'deleted')),
+    ('fixed_ips', 'fixed_ips_instance_uuid_deleted_idx',
+     ('instance_uuid', 'deleted')),
+    ('virtual_interfaces', 'virtual_interfaces_instance_uuid_deleted_idx',
+     ('instance_uuid', 'deleted')),
+    ('security_group_rules',
+     'security_group_rules_parent_group_id_deleted_idx',
+     ('parent_group_id', 'deleted')),
+]
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    for table_name, index_name, column_names in INDEXES:
+        t = Table(table_name, meta, autoload=True)
+        i = Index(index_name, *[t.c[name] for name in column_names])
+        try:
+            i.create(migrate_engine)
+        except IntegrityError:
+            pass
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    for table_name, index_name, column_names in INDEXES:
+        t = Table(table_name, meta, autoload=True)
+        i = Index(index_name, *[t.c[name] for name in column_names])
+        i.drop(migrate_engine)
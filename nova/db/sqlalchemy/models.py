@@ -162,6 +162,11 @@ class ComputeNode(BASE, NovaBase):
     cpu_info = Column(Text, nullable=True)
     disk_available_least = Column(Integer)
 
+    # Architecture of the host cpus (e.g. x86_64, tilepro64) and of its
+    # accelerators (e.g. fermi), as reported by the virt driver
+    cpu_arch = Column(String(255))
+    xpu_arch = Column(String(255))
+
 
 class ComputeNodeStat(BASE, NovaBase):
     """Stats related to the current workload of a compute host that are
@@ -33,21 +33,38 @@ import nova.openstack.common.log as logging
 
 
 FLAGS = flags.FLAGS
+flags.DECLARE('db_use_tpool', 'nova.db.api')
+flags.DECLARE('db_tpool_size', 'nova.db.api')
 LOG = logging.getLogger(__name__)
 
 _ENGINE = None
 _MAKER = None
+_SLAVE_ENGINE = None
+_SLAVE_MAKER = None
+_SLAVE_LAG = None  # (<seconds behind>, <when it was checked>)
 
 
-def get_session(autocommit=True, expire_on_commit=False):
-    """Return a SQLAlchemy session."""
-    global _MAKER
+def get_session(autocommit=True, expire_on_commit=False, slave_session=False):
+    """Return a SQLAlchemy session.
 
-    if _MAKER is None:
-        engine = get_engine()
-        _MAKER = get_maker(engine, autocommit, expire_on_commit)
-
-    session = _MAKER()
+    A slave session reads from sql_slave_connection, when there is one and
+    it is no more than sql_slave_max_lag seconds behind the database, so
+    it must only be asked for by queries that can be slightly out of date.
+    """
+    global _MAKER, _SLAVE_MAKER
+
+    if slave_session and FLAGS.sql_slave_connection and _slave_usable():
+        if _SLAVE_MAKER is None:
+            engine = get_engine(slave_engine=True)
+            _SLAVE_MAKER = get_maker(engine, autocommit, expire_on_commit)
+        maker = _SLAVE_MAKER
+    else:
+        if _MAKER is None:
+            engine = get_engine()
+            _MAKER = get_maker(engine, autocommit, expire_on_commit)
+        maker = _MAKER
+
+    session = maker()
     session.query = nova.exception.wrap_db_error(session.query)
     session.flush = nova.exception.wrap_db_error(session.flush)
     return session
@@ -106,74 +123,132 @@ def is_db_connection_error(args):
     return False
 
 
-def get_engine():
-    """Return a SQLAlchemy engine."""
-    global _ENGINE
+def _slave_usable():
+    """Whether the slave is at most sql_slave_max_lag seconds behind.
+
+    The lag is checked again once it may have grown too big, at most every
+    sql_slave_max_lag seconds.
+    """
+    global _SLAVE_LAG
+    max_lag = FLAGS.sql_slave_max_lag
+    if not max_lag:
+        return True
+
+    now = time.time()
+    if _SLAVE_LAG is None or now - _SLAVE_LAG[1] > max_lag:
+        _SLAVE_LAG = (get_slave_lag(get_engine(slave_engine=True)), now)
+        if _SLAVE_LAG[0] is None:
+            LOG.warn(_('SQL slave is not replicating, reading from the '
+                       'database instead'))
+
+    lag, checked_at = _SLAVE_LAG
+    return lag is not None and lag + now - checked_at <= max_lag
+
+
+def get_slave_lag(engine):
+    """Return the number of seconds the slave is behind, None if unknown."""
+    if 'mysql' not in engine.url.drivername:
+        # other databases do not tell, count them as up to date
+        return 0
+    try:
+        status = engine.execute('SHOW SLAVE STATUS').first()
+    except Exception:
+        LOG.exception(_('Could not get the SQL slave status'))
+        return None
+    if status is None:
+        # not a replica, the slave connection is the database itself
+        return 0
+    return status['Seconds_Behind_Master']
+
+
+def get_engine(slave_engine=False):
+    """Return a SQLAlchemy engine, of sql_slave_connection if slave_engine
+    is set.
+    """
+    global _ENGINE, _SLAVE_ENGINE
+    if slave_engine:
+        if _SLAVE_ENGINE is None:
+            _SLAVE_ENGINE = create_engine(FLAGS.sql_slave_connection)
+        return _SLAVE_ENGINE
+
     if _ENGINE is None:
-        connection_dict = sqlalchemy.engine.url.make_url(FLAGS.sql_connection)
-
-        engine_args = {
-            "pool_recycle": FLAGS.sql_idle_timeout,
-            "echo": False,
-            'convert_unicode': True,
-        }
-
-        # Map our SQL debug level to SQLAlchemy's options
-        if FLAGS.sql_connection_debug >= 100:
-            engine_args['echo'] = 'debug'
-        elif FLAGS.sql_connection_debug >= 50:
-            engine_args['echo'] = True
-
-        if "sqlite" in connection_dict.drivername:
-            engine_args["poolclass"] = NullPool
-
-            if FLAGS.sql_connection == "sqlite://":
-                engine_args["poolclass"] = StaticPool
-                engine_args["connect_args"] = {'check_same_thread': False}
-
-        _ENGINE = sqlalchemy.create_engine(FLAGS.sql_connection, **engine_args)
-
-        sqlalchemy.event.listen(_ENGINE, 'checkin', greenthread_yield)
-
-        if 'mysql' in connection_dict.drivername:
-            sqlalchemy.event.listen(_ENGINE, 'checkout', ping_listener)
-        elif 'sqlite' in connection_dict.drivername:
-            if not FLAGS.sqlite_synchronous:
-                sqlalchemy.event.listen(_ENGINE, 'connect',
-                                        synchronous_switch_listener)
-            sqlalchemy.event.listen(_ENGINE, 'connect', add_regexp_listener)
-
-        if (FLAGS.sql_connection_trace and
-                _ENGINE.dialect.dbapi.__name__ == 'MySQLdb'):
-            import MySQLdb.cursors
-            _do_query = debug_mysql_do_query()
-            setattr(MySQLdb.cursors.BaseCursor, '_do_query', _do_query)
-
-        try:
-            _ENGINE.connect()
-        except OperationalError, e:
-            if not is_db_connection_error(e.args[0]):
-                raise
-
-            remaining = FLAGS.sql_max_retries
-            if remaining == -1:
-                remaining = 'infinite'
-            while True:
-                msg = _('SQL connection failed. %s attempts left.')
-                LOG.warn(msg % remaining)
-                if remaining != 'infinite':
-                    remaining -= 1
-                time.sleep(FLAGS.sql_retry_interval)
-                try:
-                    _ENGINE.connect()
-                    break
-                except OperationalError, e:
-                    if (remaining != 'infinite' and remaining == 0) or \
-                       not is_db_connection_error(e.args[0]):
-                        raise
+        _ENGINE = create_engine(FLAGS.sql_connection)
     return _ENGINE
 
 
+def create_engine(sql_connection):
+    """Return a new SQLAlchemy engine for sql_connection."""
+    connection_dict = sqlalchemy.engine.url.make_url(sql_connection)
+
+    engine_args = {
+        "pool_recycle": FLAGS.sql_idle_timeout,
+        "echo": False,
+        'convert_unicode': True,
+    }
+
+    # Map our SQL debug level to SQLAlchemy's options
+    if FLAGS.sql_connection_debug >= 100:
+        engine_args['echo'] = 'debug'
+    elif FLAGS.sql_connection_debug >= 50:
+        engine_args['echo'] = True
+
+    if "sqlite" in connection_dict.drivername:
+        engine_args["poolclass"] = NullPool
+
+        if sql_connection == "sqlite://":
+            engine_args["poolclass"] = StaticPool
+            engine_args["connect_args"] = {'check_same_thread': False}
+    elif FLAGS.db_use_tpool:
+        # NOTE: the locks of the pool are green, keep a connection for
+        # every db call that runs in a native thread, so that they
+        # never wait on them
+        engine_args['pool_size'] = FLAGS.db_tpool_size
+
+    engine = sqlalchemy.create_engine(sql_connection, **engine_args)
+
+    if not FLAGS.db_use_tpool:
+        # the db calls already leave the hub alone in native threads
+        sqlalchemy.event.listen(engine, 'checkin', greenthread_yield)
+
+    if 'mysql' in connection_dict.drivername:
+        sqlalchemy.event.listen(engine, 'checkout', ping_listener)
+    elif 'sqlite' in connection_dict.drivername:
+        if not FLAGS.sqlite_synchronous:
+            sqlalchemy.event.listen(engine, 'connect',
+                                    synchronous_switch_listener)
+        sqlalchemy.event.listen(engine, 'connect', add_regexp_listener)
+
+    if (FLAGS.sql_connection_trace and
+            engine.dialect.dbapi.__name__ == 'MySQLdb'):
+        import MySQLdb.cursors
+        _do_query = debug_mysql_do_query()
+        setattr(MySQLdb.cursors.BaseCursor, '_do_query', _do_query)
+
+    try:
+        engine.connect()
+    except OperationalError, e:
+        if not is_db_connection_error(e.args[0]):
+            raise
+
+        remaining = FLAGS.sql_max_retries
+        if remaining == -1:
+            remaining = 'infinite'
+        while True:
+            msg = _('SQL connection failed. %s attempts left.')
+            LOG.warn(msg % remaining)
+            if remaining != 'infinite':
+                remaining -= 1
+            time.sleep(FLAGS.sql_retry_interval)
+            try:
+                engine.connect()
+                break
+            except OperationalError, e:
+                if (remaining != 'infinite' and remaining == 0) or \
+                   not is_db_connection_error(e.args[0]):
+                    raise
+    return engine
+
+
 def get_maker(engine, autocommit=True, expire_on_commit=False):
     """Return a SQLAlchemy sessionmaker using the given engine."""
     return sqlalchemy.orm.sessionmaker(bind=engine,
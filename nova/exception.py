@@ -942,6 +942,11 @@ class InsufficientFreeMemory(NovaException):
     message = _("Insufficient free memory on compute node to start %(uuid)s.")
 
 
+class InsufficientFreeGPUs(NovaException):
+    message = _("Insufficient free gpus on compute node to start "
+                "%(instance_name)s.")
+
+
 class CouldNotFetchMetrics(NovaException):
     message = _("Could not fetch bandwidth/cpu/disk metrics for this host.")
 
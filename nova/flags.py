@@ -82,6 +82,16 @@ core_opts = [
                default='sqlite:///$state_path/$sqlite_db',
                help='The SQLAlchemy connection string used to connect to the '
                     'database'),
+    cfg.StrOpt('sql_slave_connection',
+               default='',
+               help='The SQLAlchemy connection string of a read-only replica '
+                    'of the database, used by the read-heavy queries that '
+                    'can be served slightly out of date'),
+    cfg.IntOpt('sql_slave_max_lag',
+               default=30,
+               help='Maximum number of seconds the replica may be behind '
+                    'the database, read from the database instead when it '
+                    'is further behind. 0 does not check the replica lag'),
     cfg.StrOpt('api_paste_config',
                default="api-paste.ini",
                help='File name for the paste.deploy config for nova-api'),
@@ -80,6 +80,16 @@ quota_opts = [
     cfg.IntOpt('max_age',
                default=0,
                help='number of seconds between subsequent usage refreshes'),
+    cfg.BoolOpt('quota_reserve_by_update',
+                default=False,
+                help='reserve each resource with a conditional update of its '
+                     'usage, instead of locking all the usages of the '
+                     'project; usages are then refreshed by the scheduler '
+                     'in the background, per until_refresh and max_age'),
+    cfg.IntOpt('quota_cache_ttl',
+               default=60,
+               help='number of seconds the quota limits of a project or a '
+                    'quota class are cached for, 0 to not cache them'),
     cfg.StrOpt('quota_driver',
                default='nova.quota.DbQuotaDriver',
                help='default driver to use for quota checks'),
@@ -89,6 +99,43 @@ FLAGS = flags.FLAGS
 FLAGS.register_opts(quota_opts)
 
 
+class LimitCache(object):
+    """Quota limits read from the database, kept for --quota_cache_ttl
+    seconds or until they are invalidated."""
+
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, fetch):
+        """Return the cached value for key, or the one fetch() returns."""
+        ttl = FLAGS.quota_cache_ttl
+        now = timeutils.utcnow_ts()
+        entry = self._entries.get(key)
+        if ttl > 0 and entry is not None and now < entry[0]:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        value = fetch()
+        if ttl > 0:
+            self._entries[key] = (now + ttl, value)
+        return value
+
+    def invalidate(self, key=None):
+        """Forget the value for key, or all the values if key is None."""
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries)}
+
+
 class DbQuotaDriver(object):
     """
     Driver to perform necessary checks to enforce quotas and obtain
@@ -96,6 +143,46 @@ class DbQuotaDriver(object):
     database.
     """
 
+    def __init__(self):
+        self._cache = LimitCache()
+
+    def _get_class_limits(self, context, quota_class):
+        # NOTE: the database checks that the context may read the quota
+        # class, so only the quota class of the context is cached
+        if quota_class != getattr(context, 'quota_class', None):
+            return db.quota_class_get_all_by_name(context, quota_class)
+        return self._cache.get(('quota_class', quota_class),
+                lambda: db.quota_class_get_all_by_name(context, quota_class))
+
+    def _get_project_limits(self, context, project_id):
+        # NOTE: the database checks that the context may read the
+        # project, so only the project of the context is cached
+        if project_id != getattr(context, 'project_id', None):
+            return db.quota_get_all_by_project(context, project_id)
+        return self._cache.get(('project', project_id),
+                lambda: db.quota_get_all_by_project(context, project_id))
+
+    def invalidate(self, context, project_id=None, quota_class=None):
+        """Forget the cached limits of a project or a quota class, or all
+        of them if neither is given.
+
+        :param context: The request context, for access checks.
+        :param project_id: The ID of the project whose quotas changed.
+        :param quota_class: The name of the quota class that changed.
+        """
+
+        if project_id is None and quota_class is None:
+            self._cache.invalidate()
+        if project_id is not None:
+            self._cache.invalidate(('project', project_id))
+        if quota_class is not None:
+            self._cache.invalidate(('quota_class', quota_class))
+
+    def get_cache_stats(self, context):
+        """Return the hits, misses and size of the limit cache."""
+
+        return self._cache.stats()
+
     def get_by_project(self, context, project_id, resource):
         """Get a specific quota by project."""
 
@@ -135,7 +222,7 @@ class DbQuotaDriver(object):
         """
 
         quotas = {}
-        class_quotas = db.quota_class_get_all_by_name(context, quota_class)
+        class_quotas = self._get_class_limits(context, quota_class)
         for resource in resources.values():
             if defaults or resource.name in class_quotas:
                 quotas[resource.name] = class_quotas.get(resource.name,
@@ -167,7 +254,7 @@ class DbQuotaDriver(object):
         """
 
         quotas = {}
-        project_quotas = db.quota_get_all_by_project(context, project_id)
+        project_quotas = self._get_project_limits(context, project_id)
         if usages:
             project_usages = db.quota_usage_get_all_by_project(context,
                                                                project_id)
@@ -179,7 +266,7 @@ class DbQuotaDriver(object):
         if project_id == context.project_id:
             quota_class = context.quota_class
         if quota_class:
-            class_quotas = db.quota_class_get_all_by_name(context, quota_class)
+            class_quotas = self._get_class_limits(context, quota_class)
         else:
             class_quotas = {}
 
@@ -334,6 +421,10 @@ class DbQuotaDriver(object):
         #            which means access to the session.  Since the
         #            session isn't available outside the DBAPI, we
         #            have to do the work there.
+        if FLAGS.quota_reserve_by_update:
+            return db.quota_reserve_by_update(context, resources, quotas,
+                                              deltas, expire,
+                                              FLAGS.until_refresh)
         return db.quota_reserve(context, resources, quotas, deltas, expire,
                                 FLAGS.until_refresh, FLAGS.max_age)
 
@@ -367,6 +458,7 @@ class DbQuotaDriver(object):
         """
 
         db.quota_destroy_all_by_project(context, project_id)
+        self.invalidate(context, project_id=project_id)
 
     def expire(self, context):
         """Expire reservations.
@@ -379,6 +471,25 @@ class DbQuotaDriver(object):
 
         db.reservation_expire(context)
 
+    def refresh(self, context, resources):
+        """Refresh usages.
+
+        Syncs the usages that are negative, that are due per
+        --until_refresh or that are older than --max_age.  Only done
+        when reservations do not refresh usages themselves.
+
+        :param context: The request context, for access checks.
+        :param resources: A dictionary of the registered resources.
+        """
+
+        if not FLAGS.quota_reserve_by_update:
+            return
+
+        for project_id in db.quota_usage_get_stale_projects(context,
+                                                            FLAGS.max_age):
+            db.quota_usage_refresh(context, resources, project_id,
+                                   FLAGS.until_refresh)
+
 
 class BaseResource(object):
     """Describe a single resource for quota checking."""
@@ -756,6 +867,37 @@ class QuotaEngine(object):
 
         self._driver.expire(context)
 
+    def refresh(self, context):
+        """Refresh usages.
+
+        Resynchronizes the usages that are out of date with the
+        resources actually in use.
+
+        :param context: The request context, for access checks.
+        """
+
+        self._driver.refresh(context, self._resources)
+
+    def invalidate(self, context, project_id=None, quota_class=None):
+        """Forget cached quota limits.
+
+        To be called when the quotas of a project or a quota class
+        change, with the ID of the project or the name of the class.
+        All the cached limits are forgotten if neither is given.
+
+        :param context: The request context, for access checks.
+        :param project_id: The ID of the project whose quotas changed.
+        :param quota_class: The name of the quota class that changed.
+        """
+
+        self._driver.invalidate(context, project_id=project_id,
+                                quota_class=quota_class)
+
+    def get_cache_stats(self, context):
+        """Return the hits, misses and size of the quota limit cache."""
+
+        return self._driver.get_cache_stats(context)
+
     @property
     def resources(self):
         return sorted(self._resources.keys())
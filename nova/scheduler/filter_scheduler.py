@@ -260,36 +260,50 @@ class FilterScheduler(driver.Scheduler):
         # are being scanned in a filter or weighing function.
         hosts = unfiltered_hosts_dict.itervalues()
 
+        # Filter local hosts based on requirements ...
+        hosts = self.host_manager.filter_hosts(hosts, filter_properties)
+        LOG.debug(_("Filtered %(hosts)s") % locals())
+
+        # ... and weigh them once.  Consuming resources below only
+        # changes the chosen host, so only that one is filtered and
+        # weighed again for the next instance.
+        # TODO(comstud): filter_properties will also be used for
+        # weighing and I plan fold weighing into the host manager
+        # in a future patch.  I'll address the naming of this
+        # variable at that time.
+        weighted_hosts = least_cost.WeightedHostQueue(cost_functions,
+                hosts, filter_properties)
+
         selected_hosts = []
         if instance_uuids:
             num_instances = len(instance_uuids)
         else:
             num_instances = request_spec.get('num_instances', 1)
         for num in xrange(num_instances):
-            # Filter local hosts based on requirements ...
-            hosts = self.host_manager.filter_hosts(hosts,
-                    filter_properties)
-            if not hosts:
+            # weighted_host = WeightedHost() ... the best
+            # host for the job.
+            weighted_host = weighted_hosts.best()
+            if not weighted_host:
                 # Can't get any more locally.
                 break
 
-            LOG.debug(_("Filtered %(hosts)s") % locals())
-
-            # weighted_host = WeightedHost() ... the best
-            # host for the job.
-            # TODO(comstud): filter_properties will also be used for
-            # weighing and I plan fold weighing into the host manager
-            # in a future patch.  I'll address the naming of this
-            # variable at that time.
-            weighted_host = least_cost.weighted_sum(cost_functions,
-                    hosts, filter_properties)
             LOG.debug(_("Weighted %(weighted_host)s") % locals())
             selected_hosts.append(weighted_host)
 
             # Now consume the resources so the filter/weights
             # will change for the next instance.
-            weighted_host.host_state.consume_from_instance(
-                    instance_properties)
+            host_state = weighted_host.host_state
+            if instance_uuids:
+                # for the compute node to confirm it by uuid
+                instance_properties = dict(instance_properties,
+                                           uuid=instance_uuids[num])
+            host_state.consume_from_instance(instance_properties,
+                                             instance_type)
+            if self.host_manager.filter_hosts([host_state],
+                                              filter_properties):
+                weighted_hosts.push(host_state)
+            else:
+                weighted_hosts.remove(host_state)
 
         selected_hosts.sort(key=operator.attrgetter('weight'))
         return selected_hosts
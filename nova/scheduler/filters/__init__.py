@@ -30,6 +30,17 @@ class BaseHostFilter(object):
     def host_passes(self, host_state, filter_properties):
         raise NotImplementedError()
 
+    def filter_all(self, host_states, filter_properties):
+        """Yield the host states that pass this filter.
+
+        HostManager.filter_hosts() runs each filter over all the hosts
+        left at once.  Filters may override this when part of their
+        check can be worked out once for all hosts.
+        """
+        for host_state in host_states:
+            if self.host_passes(host_state, filter_properties):
+                yield host_state
+
     def _full_name(self):
         """module.classname of the filter."""
         return "%s.%s" % (self.__module__, self.__class__.__name__)
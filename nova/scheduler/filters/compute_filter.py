@@ -28,18 +28,26 @@ class ComputeFilter(filters.BaseHostFilter):
 
     def host_passes(self, host_state, filter_properties):
         """Returns True for only active compute nodes"""
+        return any(self.filter_all([host_state], filter_properties))
+
+    def filter_all(self, host_states, filter_properties):
+        """Only yield active compute nodes, reading the request once for
+        all of them.
+        """
         instance_type = filter_properties.get('instance_type')
-        if host_state.topic != 'compute' or not instance_type:
-            return True
-        capabilities = host_state.capabilities
-        service = host_state.service
-
-        if not utils.service_is_up(service) or service['disabled']:
-            LOG.debug(_("%(host_state)s is disabled or has not been "
-                    "heard from in a while"), locals())
-            return False
-        if not capabilities.get("enabled", True):
-            LOG.debug(_("%(host_state)s is disabled via capabilities"),
-                    locals())
-            return False
-        return True
+        for host_state in host_states:
+            if host_state.topic != 'compute' or not instance_type:
+                yield host_state
+                continue
+            capabilities = host_state.capabilities
+            service = host_state.service
+
+            if not utils.service_is_up(service) or service['disabled']:
+                LOG.debug(_("%(host_state)s is disabled or has not been "
+                        "heard from in a while"), locals())
+                continue
+            if not capabilities.get("enabled", True):
+                LOG.debug(_("%(host_state)s is disabled via capabilities"),
+                        locals())
+                continue
+            yield host_state
@@ -36,21 +36,48 @@ class CoreFilter(filters.BaseHostFilter):
 
     def host_passes(self, host_state, filter_properties):
         """Return True if host has sufficient CPU cores."""
-        instance_type = filter_properties.get('instance_type')
-        if host_state.topic != 'compute' or not instance_type:
-            return True
+        return any(self.filter_all([host_state], filter_properties))
+
+    def filter_all(self, host_states, filter_properties):
+        """Only yield hosts with sufficient CPU cores.
 
-        if not host_state.vcpus_total:
-            # Fail safe
-            LOG.warning(_("VCPUs not set; assuming CPU collection broken"))
-            return True
+        The request and the allocation ratio are read once, then the
+        VCPUs of all the hosts are checked in one pass over plain lists.
+        """
+        instance_type = filter_properties.get('instance_type')
+        if not instance_type:
+            for host_state in host_states:
+                yield host_state
+            return
 
         instance_vcpus = instance_type['vcpus']
-        vcpus_total = host_state.vcpus_total * FLAGS.cpu_allocation_ratio
+        cpu_allocation_ratio = FLAGS.cpu_allocation_ratio
+
+        host_states = list(host_states)
+        topics = [host_state.topic for host_state in host_states]
+        vcpus_total = [host_state.vcpus_total for host_state in host_states]
+        vcpus_used = [host_state.vcpus_used for host_state in host_states]
+
+        for host_state, topic, total, used in zip(host_states, topics,
+                                                  vcpus_total, vcpus_used):
+            if topic != 'compute':
+                yield host_state
+                continue
+
+            if not total:
+                # Fail safe
+                LOG.warning(_("VCPUs not set; assuming CPU collection "
+                              "broken"))
+                yield host_state
+                continue
+
+            limit = total * cpu_allocation_ratio
 
-        # Only provide a VCPU limit to compute if the virt driver is reporting
-        # an accurate count of installed VCPUs. (XenServer driver does not)
-        if vcpus_total > 0:
-            host_state.limits['vcpu'] = vcpus_total
+            # Only provide a VCPU limit to compute if the virt driver is
+            # reporting an accurate count of installed VCPUs. (XenServer
+            # driver does not)
+            if limit > 0:
+                host_state.limits['vcpu'] = limit
 
-        return (vcpus_total - host_state.vcpus_used) >= instance_vcpus
+            if (limit - used) >= instance_vcpus:
+                yield host_state
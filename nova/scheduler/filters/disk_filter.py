@@ -32,23 +32,38 @@ class DiskFilter(filters.BaseHostFilter):
 
     def host_passes(self, host_state, filter_properties):
         """Filter based on disk usage"""
+        return any(self.filter_all([host_state], filter_properties))
+
+    def filter_all(self, host_states, filter_properties):
+        """Only yield hosts with sufficient usable disk.
+
+        The request and the allocation ratio are read once, then the
+        disk of all the hosts is checked in one pass over plain lists.
+        """
         instance_type = filter_properties.get('instance_type')
         requested_disk = 1024 * (instance_type['root_gb'] +
                                  instance_type['ephemeral_gb'])
+        disk_allocation_ratio = FLAGS.disk_allocation_ratio
 
-        free_disk_mb = host_state.free_disk_mb
-        total_usable_disk_mb = host_state.total_usable_disk_gb * 1024
-
-        disk_mb_limit = total_usable_disk_mb * FLAGS.disk_allocation_ratio
-        used_disk_mb = total_usable_disk_mb - free_disk_mb
-        usable_disk_mb = disk_mb_limit - used_disk_mb
+        host_states = list(host_states)
+        free_disk = [host_state.free_disk_mb for host_state in host_states]
+        total_disk = [host_state.total_usable_disk_gb * 1024
+                      for host_state in host_states]
+        limits = [total_disk_mb * disk_allocation_ratio
+                  for total_disk_mb in total_disk]
+        # usable disk is the limit less the disk in use:
+        usable = [limit - total_disk_mb + free_disk_mb for
+                  limit, total_disk_mb, free_disk_mb in
+                  zip(limits, total_disk, free_disk)]
 
-        if not usable_disk_mb >= requested_disk:
-            LOG.debug(_("%(host_state)s does not have %(requested_disk)s MB "
-                    "usable disk, it only has %(usable_disk_mb)s MB usable "
-                    "disk."), locals())
-            return False
+        for host_state, disk_mb_limit, usable_disk_mb in zip(host_states,
+                                                             limits, usable):
+            if not usable_disk_mb >= requested_disk:
+                LOG.debug(_("%(host_state)s does not have %(requested_disk)s "
+                        "MB usable disk, it only has %(usable_disk_mb)s MB "
+                        "usable disk."), locals())
+                continue
 
-        disk_gb_limit = disk_mb_limit / 1024
-        host_state.limits['disk_gb'] = disk_gb_limit
-        return True
+            disk_gb_limit = disk_mb_limit / 1024
+            host_state.limits['disk_gb'] = disk_gb_limit
+            yield host_state
@@ -0,0 +1,49 @@
+# Copyright (c) 2012 OpenStack, LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from nova.openstack.common import log as logging
+from nova.scheduler import filters
+from nova.scheduler import host_manager
+
+LOG = logging.getLogger(__name__)
+
+
+class GpuFilter(filters.BaseHostFilter):
+    """Filter out hosts without enough free gpus, or slots of shared
+    gpus, for the instance.
+    """
+
+    def host_passes(self, host_state, filter_properties):
+        """Return True if host has the gpus the instance asks for."""
+        request_spec = filter_properties.get('request_spec') or {}
+        instance_type = filter_properties.get('instance_type')
+        instance_properties = request_spec.get('instance_properties')
+        requested_gpus = host_manager.get_requested_gpus(
+                instance_type, instance_properties)
+        requested_slots = host_manager.get_requested_gpu_slots(
+                instance_type, instance_properties)
+
+        free_gpus = host_state.free_gpus
+        if free_gpus < requested_gpus:
+            LOG.debug(_("%(host_state)s does not have %(requested_gpus)d "
+                        "free gpus, it only has %(free_gpus)d."), locals())
+            return False
+        free_slots = host_state.free_gpu_slots
+        if free_slots < requested_slots:
+            LOG.debug(_("%(host_state)s does not have %(requested_slots)d "
+                        "free gpu slots, it only has %(free_slots)d."),
+                      locals())
+            return False
+        return True
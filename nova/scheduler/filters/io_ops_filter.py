@@ -35,10 +35,18 @@ class IoOpsFilter(filters.BaseHostFilter):
         """Use information about current vm and task states collected from
         compute node statistics to decide whether to filter.
         """
-        num_io_ops = host_state.num_io_ops
+        return any(self.filter_all([host_state], filter_properties))
+
+    def filter_all(self, host_states, filter_properties):
+        """Only yield hosts below the I/O operations limit, reading the
+        limit once for all of them.
+        """
         max_io_ops = FLAGS.max_io_ops_per_host
-        passes = num_io_ops < max_io_ops
-        if not passes:
-            LOG.debug(_("%(host_state)s fails I/O ops check: Max IOs per host "
-                        "is set to %(max_io_ops)s"), locals())
-        return passes
+        host_states = list(host_states)
+        io_ops = [host_state.num_io_ops for host_state in host_states]
+        for host_state, num_io_ops in zip(host_states, io_ops):
+            if num_io_ops < max_io_ops:
+                yield host_state
+            else:
+                LOG.debug(_("%(host_state)s fails I/O ops check: Max IOs per "
+                            "host is set to %(max_io_ops)s"), locals())
@@ -34,20 +34,37 @@ class RamFilter(filters.BaseHostFilter):
 
     def host_passes(self, host_state, filter_properties):
         """Only return hosts with sufficient available RAM."""
+        return any(self.filter_all([host_state], filter_properties))
+
+    def filter_all(self, host_states, filter_properties):
+        """Only yield hosts with sufficient available RAM.
+
+        The request and the allocation ratio are read once, then the ram
+        of all the hosts is checked in one pass over plain lists.
+        """
         instance_type = filter_properties.get('instance_type')
         requested_ram = instance_type['memory_mb']
-        free_ram_mb = host_state.free_ram_mb
-        total_usable_ram_mb = host_state.total_usable_ram_mb
-
-        memory_mb_limit = total_usable_ram_mb * FLAGS.ram_allocation_ratio
-        used_ram_mb = total_usable_ram_mb - free_ram_mb
-        usable_ram = memory_mb_limit - used_ram_mb
-        if not usable_ram >= requested_ram:
-            LOG.debug(_("%(host_state)s does not have %(requested_ram)s MB "
-                    "usable ram, it only has %(usable_ram)s MB usable ram."),
-                    locals())
-            return False
-
-        # save oversubscription limit for compute node to test against:
-        host_state.limits['memory_mb'] = memory_mb_limit
-        return True
+        ram_allocation_ratio = FLAGS.ram_allocation_ratio
+
+        host_states = list(host_states)
+        free_ram = [host_state.free_ram_mb for host_state in host_states]
+        total_ram = [host_state.total_usable_ram_mb
+                     for host_state in host_states]
+        limits = [total_ram_mb * ram_allocation_ratio
+                  for total_ram_mb in total_ram]
+        # usable ram is the limit less the ram in use:
+        usable = [limit - total_ram_mb + free_ram_mb for
+                  limit, total_ram_mb, free_ram_mb in
+                  zip(limits, total_ram, free_ram)]
+
+        for host_state, memory_mb_limit, usable_ram in zip(host_states,
+                                                           limits, usable):
+            if not usable_ram >= requested_ram:
+                LOG.debug(_("%(host_state)s does not have %(requested_ram)s "
+                        "MB usable ram, it only has %(usable_ram)s MB usable "
+                        "ram."), locals())
+                continue
+
+            # save oversubscription limit for compute node to test against:
+            host_state.limits['memory_mb'] = memory_mb_limit
+            yield host_state
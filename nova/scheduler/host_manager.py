@@ -17,6 +17,7 @@
 Manage hosts in the current zone.
 """
 
+import datetime
 import UserDict
 
 from nova.compute import task_states
@@ -47,6 +48,25 @@ host_manager_opts = [
                   ],
                 help='Which filter class names to use for filtering hosts '
                       'when not specified in the request.'),
+    cfg.IntOpt('scheduler_host_state_full_refresh_interval',
+               default=300,
+               help='Seconds between full reloads of the host states from '
+                    'the compute nodes.  In between, only the compute '
+                    'nodes updated since the previous request are read.  '
+                    '0 reloads all of them on every request.'),
+    cfg.IntOpt('scheduler_host_state_refresh_margin',
+               default=30,
+               help='Seconds by which the update times of the compute '
+                    'nodes, stamped by the compute hosts, may lag behind '
+                    'the clock of the scheduler.  Compute nodes updated '
+                    'within this margin of the previous request are read '
+                    'again, and resources consumed within it are not '
+                    'assumed to be accounted for by them yet.'),
+    cfg.IntOpt('scheduler_host_state_consumed_max_age',
+               default=600,
+               help='Seconds after which resources consumed by a request '
+                    'are no longer added to the host states, whether or '
+                    'not the compute node reported the instance.'),
     ]
 
 FLAGS = flags.FLAGS
@@ -87,6 +107,36 @@ class ReadOnlyDict(UserDict.IterableUserDict):
             raise TypeError
 
 
+def _get_requested(key, instance_type, instance_properties):
+    """Like the gpu compute driver, take the larger of the instance
+    metadata and the extra spec for key, whose value carries an operator
+    (e.g. '= 2').
+    """
+    in_meta = 0
+    in_extra = 0
+    metadata = (instance_properties or {}).get('metadata') or {}
+    if key in metadata:
+        in_meta = int(metadata[key])
+    extra_specs = (instance_type or {}).get('extra_specs') or {}
+    if key in extra_specs:
+        in_extra = int(extra_specs[key].split()[-1])
+    return max(in_meta, in_extra)
+
+
+def get_requested_gpus(instance_type, instance_properties):
+    """Return how many whole gpus an instance asks for."""
+    return _get_requested('gpus', instance_type, instance_properties)
+
+
+def get_requested_gpu_slots(instance_type, instance_properties):
+    """Return how many slots of a shared gpu an instance asks for.  The
+    gpu compute driver ignores them when whole gpus are asked for.
+    """
+    if get_requested_gpus(instance_type, instance_properties):
+        return 0
+    return _get_requested('gpu_slots', instance_type, instance_properties)
+
+
 class HostState(object):
     """Mutable and immutable information tracked for a host.
     This is an attempt to remove the ad-hoc data structures
@@ -98,10 +148,7 @@ class HostState(object):
         self.topic = topic
 
         # Read-only capability dicts
-
-        if capabilities is None:
-            capabilities = {}
-        self.capabilities = ReadOnlyDict(capabilities.get(topic, None))
+        self.update_capabilities(capabilities)
         if service is None:
             service = {}
         self.service = ReadOnlyDict(service)
@@ -113,11 +160,10 @@ class HostState(object):
         self.free_disk_mb = 0
         self.vcpus_total = 0
         self.vcpus_used = 0
-        # Valid vm types on this host: 'pv', 'hvm' or 'all'
-        if 'allowed_vm_type' in self.capabilities:
-            self.allowed_vm_type = self.capabilities['allowed_vm_type']
-        else:
-            self.allowed_vm_type = 'all'
+        self.gpus_total = 0
+        self.gpus_used = 0
+        self.gpu_slots_total = 0
+        self.gpu_slots_used = 0
 
         # Additional host information from the compute node stats:
         self.vm_states = {}
@@ -130,8 +176,27 @@ class HostState(object):
         # Resource oversubscription values for the compute host:
         self.limits = {}
 
+        # When the compute node info was last updated, the uuids of the
+        # instances it counts, and the instances consumed here since, as
+        # (time, instance, instance_type)
+        self.updated = None
+        self.instance_uuids = set()
+        self.consumed = []
+
+    def update_capabilities(self, capabilities):
+        """Update the capabilities this host advertised for our topic."""
+        if capabilities is None:
+            capabilities = {}
+        self.capabilities = ReadOnlyDict(capabilities.get(self.topic, None))
+        # Valid vm types on this host: 'pv', 'hvm' or 'all'
+        if 'allowed_vm_type' in self.capabilities:
+            self.allowed_vm_type = self.capabilities['allowed_vm_type']
+        else:
+            self.allowed_vm_type = 'all'
+
     def update_from_compute_node(self, compute):
         """Update information about a host from its compute_node info."""
+        self.updated = compute.get('updated_at') or compute.get('created_at')
         all_ram_mb = compute['memory_mb']
 
         # Assume virtual size is all consumed by instances if use qcow2 disk.
@@ -154,6 +219,8 @@ class HostState(object):
 
         # Track number of instances on host
         self.num_instances = int(statmap.get('num_instances', 0))
+        self.instance_uuids = set(k[9:] for k in statmap.keys() if
+                k.startswith("instance_"))
 
         # Track number of instances by project_id
         project_id_keys = [k for k in statmap.keys() if
@@ -183,14 +250,87 @@ class HostState(object):
 
         self.num_io_ops = int(statmap.get('io_workload', 0))
 
-    def consume_from_instance(self, instance):
+        # Track gpus; fall back on the free count from the capabilities
+        # of hosts whose compute node does not report them yet
+        if 'gpus' in statmap:
+            self.gpus_total = int(statmap['gpus'])
+            self.gpus_used = int(statmap.get('gpus_used', 0))
+        elif 'gpus' in self.capabilities:
+            self.gpus_total = int(self.capabilities['gpus'])
+            self.gpus_used = 0
+        # and the slots of the shared gpus, one per gpu if not reported
+        if 'gpu_slots' in statmap:
+            self.gpu_slots_total = int(statmap['gpu_slots'])
+            self.gpu_slots_used = int(statmap.get('gpu_slots_used', 0))
+        elif 'gpu_slots' in self.capabilities:
+            self.gpu_slots_total = int(self.capabilities['gpu_slots'])
+            self.gpu_slots_used = 0
+        else:
+            self.gpu_slots_total = self.gpus_total
+            self.gpu_slots_used = self.gpus_used
+
+    @property
+    def gpu_slots_per_device(self):
+        if not self.gpus_total:
+            return 1
+        return max(1, self.gpu_slots_total // self.gpus_total)
+
+    @property
+    def free_gpus(self):
+        # the gpus the consumed slots went to are not known here, at
+        # most the free slots make up whole gpus
+        return min(self.gpus_total - self.gpus_used,
+                   self.free_gpu_slots // self.gpu_slots_per_device)
+
+    @property
+    def free_gpu_slots(self):
+        return self.gpu_slots_total - self.gpu_slots_used
+
+    def consume_from_instance(self, instance, instance_type=None):
         """Incrementally update host state from an instance"""
+        self.consumed.append((timeutils.utcnow(), instance, instance_type))
+        self._consume(instance, instance_type)
+
+    def consume_unconfirmed(self, host_state, now):
+        """Consume again what was consumed on an older state of this host.
+
+        Instances the compute node info of this state reports, or that
+        were consumed before it was updated by more than
+        scheduler_host_state_refresh_margin seconds, are accounted for
+        in it already.  Instances consumed more than
+        scheduler_host_state_consumed_max_age seconds before now are
+        dropped, should the compute node never report them.
+        """
+        expired = now - datetime.timedelta(
+                seconds=FLAGS.scheduler_host_state_consumed_max_age)
+        if self.updated is not None:
+            confirmed = self.updated - datetime.timedelta(
+                    seconds=FLAGS.scheduler_host_state_refresh_margin)
+        for consumed in host_state.consumed:
+            at, instance, instance_type = consumed
+            if at <= expired:
+                continue
+            if self.updated is not None and at <= confirmed:
+                continue
+            # an instance resized on its own host is reported already
+            if (instance.get('uuid') in self.instance_uuids and
+                    instance.get('host') != self.host):
+                continue
+            self.consumed.append(consumed)
+            self._consume(instance, instance_type)
+
+    def _consume(self, instance, instance_type):
         disk_mb = (instance['root_gb'] + instance['ephemeral_gb']) * 1024
         ram_mb = instance['memory_mb']
         vcpus = instance['vcpus']
         self.free_ram_mb -= ram_mb
         self.free_disk_mb -= disk_mb
         self.vcpus_used += vcpus
+        gpus = get_requested_gpus(instance_type, instance)
+        self.gpu_slots_used += (gpus * self.gpu_slots_per_device +
+                                get_requested_gpu_slots(instance_type,
+                                                        instance))
+        self.gpus_used += gpus
 
         # Track number of instances on host
         self.num_instances += 1
@@ -257,9 +397,11 @@ class HostState(object):
         return True
 
     def __repr__(self):
-        return ("%s ram:%s disk:%s io_ops:%s instances:%s vm_type:%s" %
+        return ("%s ram:%s disk:%s io_ops:%s instances:%s vm_type:%s "
+                "gpus:%s" %
                 (self.host, self.free_ram_mb, self.free_disk_mb,
-                 self.num_io_ops, self.num_instances, self.allowed_vm_type))
+                 self.num_io_ops, self.num_instances, self.allowed_vm_type,
+                 self.free_gpus))
 
 
 class HostManager(object):
@@ -270,6 +412,9 @@ class HostManager(object):
 
     def __init__(self):
         self.service_states = {}  # { <host> : { <service> : { cap k : v }}}
+        self.host_state_map = {}
+        self.last_refresh = None
+        self.last_full_refresh = None
         self.filter_classes = filters.get_filter_classes(
                 FLAGS.scheduler_available_filters)
 
@@ -291,9 +436,9 @@ class HostManager(object):
                 if cls.__name__ == filter_name:
                     found_class = True
                     filter_instance = cls()
-                    # Get the filter function
+                    # Get the batched filter function
                     filter_func = getattr(filter_instance,
-                            'host_passes', None)
+                            'filter_all', None)
                     if filter_func:
                         good_filters.append(filter_func)
                     break
@@ -305,12 +450,33 @@ class HostManager(object):
         return good_filters
 
     def filter_hosts(self, hosts, filter_properties, filters=None):
-        """Filter hosts and return only ones passing all filters"""
-        filtered_hosts = []
+        """Filter hosts and return only ones passing all filters.
+
+        Each filter is run over all remaining hosts at once rather than
+        all filters over each host, so that filters can work out the
+        request side of their check once per request.
+        """
         filter_fns = self._choose_host_filters(filters)
-        for host in hosts:
-            if host.passes_filters(filter_fns, filter_properties):
-                filtered_hosts.append(host)
+
+        ignore_hosts = filter_properties.get('ignore_hosts', [])
+        if ignore_hosts:
+            hosts = [host for host in hosts
+                     if host.host not in ignore_hosts]
+
+        force_hosts = filter_properties.get('force_hosts', [])
+        if force_hosts:
+            return [host for host in hosts if host.host in force_hosts]
+
+        filtered_hosts = list(hosts)
+        for filter_fn in filter_fns:
+            filtered_hosts = list(filter_fn(filtered_hosts,
+                                            filter_properties))
+            LOG.debug(_('Host filter function %(func)s returned '
+                        '%(count)d hosts'),
+                      {'func': repr(filter_fn),
+                       'count': len(filtered_hosts)})
+            if not filtered_hosts:
+                break
         return filtered_hosts
 
     def update_service_capabilities(self, service_name, host, capabilities):
@@ -324,6 +490,10 @@ class HostManager(object):
         service_caps[service_name] = capab_copy
         self.service_states[host] = service_caps
 
+        host_state = self.host_state_map.get(host)
+        if host_state and host_state.topic == service_name:
+            host_state.update_capabilities(service_caps)
+
     def get_all_host_states(self, context, topic):
         """Returns a dict of all the hosts the HostManager
         knows about. Also, each of the consumable resources in HostState
@@ -332,30 +502,73 @@ class HostManager(object):
         For example:
         {'192.168.1.100': HostState(), ...}
 
-        Note: this can be very slow with a lot of instances.
-        InstanceType table isn't required since a copy is stored
-        with the instance (in case the InstanceType changed since the
-        instance was created)."""
+        The host states are kept between requests.  Every
+        scheduler_host_state_full_refresh_interval seconds they are all
+        rebuilt from the compute nodes, in between only the hosts whose
+        compute node was updated since the last request are.  Resources
+        consumed by earlier requests stay consumed until the compute
+        node reports the instances, or they expire.  InstanceType table
+        isn't required since a copy is stored with the instance (in case
+        the InstanceType changed since the instance was created)."""
 
         if topic != 'compute':
             raise NotImplementedError(_(
                 "host_manager only implemented for 'compute'"))
 
+        now = timeutils.utcnow()
+        interval = FLAGS.scheduler_host_state_full_refresh_interval
+        if (not interval or self.last_full_refresh is None or
+                timeutils.is_older_than(self.last_full_refresh, interval)):
+            compute_nodes = db.compute_node_get_all(context)
+            self._update_host_states(topic, compute_nodes, now, full=True)
+            self.last_full_refresh = now
+        else:
+            # the compute hosts stamp their updates with their own clock,
+            # and may commit them late:
+            margin = FLAGS.scheduler_host_state_refresh_margin
+            compute_nodes = db.compute_node_get_all(context,
+                    updated_since=self.last_refresh -
+                                  datetime.timedelta(seconds=margin))
+            self._update_host_states(topic, compute_nodes, now)
+            self._update_services(context, topic)
+        self.last_refresh = now
+
+        return dict(self.host_state_map)
+
+    def _update_host_states(self, topic, compute_nodes, now, full=False):
+        """Rebuild the host states of the given compute nodes."""
         host_state_map = {}
-
-        # Get resource usage across the available compute nodes:
-        compute_nodes = db.compute_node_get_all(context)
         for compute in compute_nodes:
             service = compute['service']
             if not service:
                 LOG.warn(_("No service for compute ID %s") % compute['id'])
                 continue
             host = service['host']
+            if compute.get('deleted'):
+                self.host_state_map.pop(host, None)
+                continue
             capabilities = self.service_states.get(host, None)
             host_state = self.host_state_cls(host, topic,
                     capabilities=capabilities,
                     service=dict(service.iteritems()))
             host_state.update_from_compute_node(compute)
+            old_host_state = self.host_state_map.get(host)
+            if old_host_state:
+                host_state.consume_unconfirmed(old_host_state, now)
             host_state_map[host] = host_state
 
-        return host_state_map
+        if full:
+            self.host_state_map = host_state_map
+        else:
+            self.host_state_map.update(host_state_map)
+
+    def _update_services(self, context, topic):
+        """Refresh the service of the known hosts.
+
+        Services report in far more often than their compute node is
+        updated, and filters use their heartbeat to tell if a host is up.
+        """
+        for service in db.service_get_all(context):
+            host_state = self.host_state_map.get(service['host'])
+            if host_state and service['topic'] == topic:
+                host_state.service = ReadOnlyDict(dict(service.iteritems()))
@@ -22,6 +22,9 @@ The cost-function and weights are tabulated, and the host with the least cost
 is then selected for provisioning.
 """
 
+import heapq
+import itertools
+
 from nova import flags
 from nova.openstack.common import cfg
 from nova.openstack.common import log as logging
@@ -43,6 +46,11 @@ least_cost_opts = [
                help='How much weight to give the fill-first cost function. '
                     'A negative value will reverse behavior: '
                     'e.g. spread-first'),
+    cfg.FloatOpt('compute_gpu_fill_first_cost_fn_weight',
+               default=1.0,
+               help='How much weight to give the gpu fill-first cost '
+                    'function. A negative value will reverse behavior: '
+                    'e.g. spread-first'),
     ]
 
 FLAGS = flags.FLAGS
@@ -89,6 +97,18 @@ def compute_fill_first_cost_fn(host_state, weighing_properties):
     return host_state.free_ram_mb
 
 
+def compute_gpu_fill_first_cost_fn(host_state, weighing_properties):
+    """More free gpu slots = higher weight. So servers with less free
+    gpus, or slots of shared gpus, will be preferred, which packs the
+    instances sharing a gpu and also keeps gpu hosts free of instances
+    that do not need a gpu.
+
+    Note: with a negative weight this function runs in reverse, so
+    systems with the most free gpus will be preferred.
+    """
+    return host_state.free_gpu_slots
+
+
 def weighted_sum(weighted_fns, host_states, weighing_properties):
     """Use the weighted-sum method to compute a score for an array of objects.
 
@@ -115,3 +135,53 @@ def weighted_sum(weighted_fns, host_states, weighing_properties):
             min_score, best_host = score, host_state
 
     return WeightedHost(min_score, host_state=best_host)
+
+
+class WeightedHostQueue(object):
+    """Host states ordered by their weighted sum, least cost first.
+
+    Every host is weighed once when the queue is built.  Consuming from
+    a host only changes the weight of that host, so the scheduler puts
+    it back with push() (or drops it with remove()) instead of weighing
+    all the hosts again for every instance of a request.
+    """
+
+    def __init__(self, weighted_fns, host_states, weighing_properties):
+        self.weighted_fns = weighted_fns
+        self.weighing_properties = weighing_properties
+        self._heap = []
+        self._entries = {}
+        # Ties go to the host seen first, like weighted_sum()
+        self._order = {}
+        self._counter = itertools.count()
+        for host_state in host_states:
+            self.push(host_state)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def push(self, host_state):
+        """Weigh host_state and queue it, replacing any older entry."""
+        self.remove(host_state)
+        score = sum(weight * fn(host_state, self.weighing_properties)
+                    for weight, fn in self.weighted_fns)
+        order = self._order.setdefault(host_state.host, self._counter.next())
+        entry = [score, order, host_state]
+        self._entries[host_state.host] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, host_state):
+        """Drop host_state from the queue, if it is queued."""
+        entry = self._entries.pop(host_state.host, None)
+        if entry is not None:
+            # Left in the heap, skipped once it comes up
+            entry[-1] = None
+
+    def best(self):
+        """Return the least cost host as a WeightedHost, or None."""
+        while self._heap and self._heap[0][-1] is None:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        score, _order, host_state = self._heap[0]
+        return WeightedHost(score, host_state=host_state)
@@ -258,3 +258,7 @@ class SchedulerManager(manager.Manager):
     @manager.periodic_task
     def _expire_reservations(self, context):
         QUOTAS.expire(context)
+
+    @manager.periodic_task
+    def _refresh_quota_usages(self, context):
+        QUOTAS.refresh(context)
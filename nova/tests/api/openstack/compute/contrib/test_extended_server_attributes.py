@@ -45,8 +45,8 @@ def fake_compute_get_all(*args, **kwargs):
     ]
 
 
-def fake_cn_get(context, host):
-    return {"hypervisor_hostname": host}
+def fake_cn_get_by_hosts(context, hosts):
+    return dict((host, {"hypervisor_hostname": host}) for host in hosts)
 
 
 class ExtendedServerAttributesTest(test.TestCase):
@@ -58,7 +58,7 @@ class ExtendedServerAttributesTest(test.TestCase):
         fakes.stub_out_nw_api(self.stubs)
         self.stubs.Set(compute.api.API, 'get', fake_compute_get)
         self.stubs.Set(compute.api.API, 'get_all', fake_compute_get_all)
-        self.stubs.Set(db, 'compute_node_get_by_host', fake_cn_get)
+        self.stubs.Set(db, 'compute_node_get_by_hosts', fake_cn_get_by_hosts)
 
     def _make_request(self, url):
         req = webob.Request.blank(url)
@@ -98,6 +98,21 @@ class ExtendedServerAttributesTest(test.TestCase):
                                     host='host-%s' % (i + 1),
                                     instance_name='instance-%s' % (i + 1))
 
+    def test_detail_one_query(self):
+        calls = []
+
+        def fake_cn_get_by_hosts_once(context, hosts):
+            calls.append(sorted(hosts))
+            return fake_cn_get_by_hosts(context, hosts)
+
+        self.stubs.Set(db, 'compute_node_get_by_hosts',
+                       fake_cn_get_by_hosts_once)
+        url = '/v2/fake/servers/detail'
+        res = self._make_request(url)
+
+        self.assertEqual(res.status_int, 200)
+        self.assertEqual(calls, [['host-1', 'host-2']])
+
     def test_no_instance_passthrough_404(self):
 
         def fake_compute_get(*args, **kwargs):
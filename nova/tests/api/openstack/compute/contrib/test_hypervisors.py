@@ -79,7 +79,7 @@ TEST_SERVERS = [dict(name="inst1", uuid="uuid1", host="compute1"),
                 dict(name="inst4", uuid="uuid4", host="compute2")]
 
 
-def fake_compute_node_get_all(context):
+def fake_compute_node_get_all(context, use_slave=False):
     return TEST_HYPERS
 
 
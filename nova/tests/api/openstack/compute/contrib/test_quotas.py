@@ -129,6 +129,20 @@ class QuotaSetsTest(test.TestCase):
 
         self.assertEqual(res_dict, body)
 
+    def test_quotas_update_invalidates_cache(self):
+        calls = []
+
+        def fake_invalidate(context, project_id=None, quota_class=None):
+            calls.append((project_id, quota_class))
+
+        self.stubs.Set(quotas.QUOTAS, 'invalidate', fake_invalidate)
+        body = {'quota_set': {'instances': 50}}
+        req = fakes.HTTPRequest.blank('/v2/fake4/os-quota-sets/update_me',
+                                      use_admin_context=True)
+        self.controller.update(req, 'update_me', body)
+
+        self.assertEqual(calls, [('update_me', None)])
+
     def test_quotas_update_as_user(self):
         body = {'quota_set': {'instances': 50, 'cores': 50,
                               'ram': 51200, 'volumes': 10,
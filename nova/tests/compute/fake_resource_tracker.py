@@ -27,6 +27,9 @@ class FakeResourceTracker(resource_tracker.ResourceTracker):
     def _update(self, context, values, prune_stats=False):
         self.compute_node.update(values)
 
+    def _write(self, context, values, generation):
+        pass
+
     def _get_service(self, context):
         return {
             "id": 1,
@@ -58,6 +58,7 @@ from nova.tests.db.fakes import FakeModel
 from nova.tests import fake_network
 from nova.tests.image import fake as fake_image
 from nova import utils
+from nova.virt import event as virtevent
 import nova.volume
 
 
@@ -1250,9 +1251,20 @@ class ComputeTestCase(BaseTestCase):
         self.assertTrue(payload['launched_at'])
         image_ref_url = utils.generate_image_url(FAKE_IMAGE_REF)
         self.assertEquals(payload['image_ref_url'], image_ref_url)
+        phases = [span['phase'] for span in payload['build_timing']]
+        for phase in ('build', 'network', 'block_device', 'spawn'):
+            self.assertTrue(phase in phases)
         self.compute.terminate_instance(self.context,
                 instance=jsonutils.to_primitive(inst_ref))
 
+    def test_get_build_timings(self):
+        instance = jsonutils.to_primitive(self._create_fake_instance())
+        self.compute.run_instance(self.context, instance=instance)
+        timings = self.compute.get_build_timings(self.context)
+        self.assertTrue(timings['build']['count'] >= 1)
+        self.assertTrue(timings['spawn']['mean'] >= 0)
+        self.compute.terminate_instance(self.context, instance=instance)
+
     def test_terminate_usage_notification(self):
         """Ensure terminate_instance generates correct usage notification"""
         old_time = datetime.datetime(2012, 4, 1)
@@ -2256,6 +2268,114 @@ class ComputeTestCase(BaseTestCase):
         self.assertEqual(len(instances), 1)
         self.assertEqual(task_states.STOPPING, instances[0]['task_state'])
 
+    def _test_sync_power_states(self):
+        running = self._create_fake_instance(
+                {'power_state': power_state.RUNNING,
+                 'vm_state': vm_states.ACTIVE,
+                 'host': self.compute.host})
+        paused = self._create_fake_instance(
+                {'power_state': power_state.RUNNING,
+                 'vm_state': vm_states.PAUSED,
+                 'host': self.compute.host})
+        self.compute.driver.instances = {}
+        for instance, state in ((running, power_state.RUNNING),
+                                (paused, power_state.PAUSED)):
+            self.compute.driver.instances[instance['name']] = \
+                    nova.virt.fake.FakeInstance(instance['name'], state)
+
+        self.compute._sync_power_states(context.get_admin_context())
+        self.mox.VerifyAll()
+        self.mox.UnsetStubs()
+
+        self.assertEqual(power_state.RUNNING, db.instance_get_by_uuid(
+                self.context, running['uuid'])['power_state'])
+        self.assertEqual(power_state.PAUSED, db.instance_get_by_uuid(
+                self.context, paused['uuid'])['power_state'])
+
+    def test_sync_power_states(self):
+        """The hypervisor is asked once and the changes written at once"""
+        self.stubs.Set(nova.virt.fake.FakeDriver, 'get_info',
+                       lambda *args: self.fail("get_info called"))
+        self.mox.StubOutWithMock(db, 'instance_get_by_uuid')
+        self.mox.StubOutWithMock(db, 'instance_update_and_get_original')
+        self.mox.ReplayAll()
+        self._test_sync_power_states()
+
+    def test_sync_power_states_notifies_changes(self):
+        changes = []
+
+        def fake_send_update(context, old_instance, new_instance):
+            changes.append((old_instance['power_state'],
+                            new_instance['power_state']))
+        self.stubs.Set(nova.notifications, 'send_update', fake_send_update)
+        self._test_sync_power_states()
+        self.assertEqual([(power_state.RUNNING, power_state.PAUSED)],
+                         changes)
+
+    def test_sync_power_states_with_lifecycle_events(self):
+        """Polling is a rare safety net when the driver reports events"""
+        def fake_get_info_all(*args):
+            self.fail("polled the hypervisor")
+        self.stubs.Set(nova.virt.fake.FakeDriver, 'get_info_all',
+                       fake_get_info_all)
+        self.compute._lifecycle_events = True
+        self.compute._last_power_state_sync = time.time()
+        self.compute._sync_power_states(context.get_admin_context())
+
+    def test_handle_lifecycle_event(self):
+        instance = self._create_fake_instance(
+                {'power_state': power_state.RUNNING,
+                 'vm_state': vm_states.ACTIVE,
+                 'host': self.compute.host})
+        self.stubs.Set(nova.virt.fake.FakeDriver, 'get_info',
+                       lambda *args: {'state': power_state.SHUTDOWN})
+        event = virtevent.LifecycleEvent(instance['uuid'],
+                                         virtevent.EVENT_LIFECYCLE_STOPPED)
+        self.compute.handle_events(event)
+
+        instance = db.instance_get_by_uuid(self.context, instance['uuid'])
+        self.assertEqual(power_state.SHUTDOWN, instance['power_state'])
+        # the instance shut down by itself, so it gets stopped:
+        self.assertEqual(task_states.STOPPING, instance['task_state'])
+
+    def test_handle_lifecycle_event_late(self):
+        """A stop event arriving after the instance came back up is
+        ignored"""
+        instance = self._create_fake_instance(
+                {'power_state': power_state.RUNNING,
+                 'vm_state': vm_states.ACTIVE,
+                 'host': self.compute.host})
+        self.stubs.Set(nova.virt.fake.FakeDriver, 'get_info',
+                       lambda *args: {'state': power_state.RUNNING})
+        event = virtevent.LifecycleEvent(instance['uuid'],
+                                         virtevent.EVENT_LIFECYCLE_STOPPED)
+        self.compute.handle_events(event)
+
+        instance = db.instance_get_by_uuid(self.context, instance['uuid'])
+        self.assertEqual(power_state.RUNNING, instance['power_state'])
+        self.assertEqual(None, instance['task_state'])
+
+    def test_handle_lifecycle_event_pending_task(self):
+        instance = self._create_fake_instance(
+                {'power_state': power_state.RUNNING,
+                 'vm_state': vm_states.ACTIVE,
+                 'task_state': task_states.REBOOTING,
+                 'host': self.compute.host})
+        event = virtevent.LifecycleEvent(instance['uuid'],
+                                         virtevent.EVENT_LIFECYCLE_STOPPED)
+        self.compute.handle_events(event)
+
+        instance = db.instance_get_by_uuid(self.context, instance['uuid'])
+        self.assertEqual(power_state.RUNNING, instance['power_state'])
+
+    def test_sync_power_states_one_by_one(self):
+        """Drivers without get_info_all() are asked per instance"""
+        def fake_get_info_all(*args):
+            raise NotImplementedError()
+        self.stubs.Set(nova.virt.fake.FakeDriver, 'get_info_all',
+                       fake_get_info_all)
+        self._test_sync_power_states()
+
     def test_add_instance_fault(self):
         exc_info = None
         instance_uuid = str(utils.gen_uuid())
@@ -17,6 +17,7 @@
 
 """Tests for compute resource tracking"""
 
+import datetime
 import uuid
 
 from nova.compute import resource_tracker
@@ -79,7 +80,8 @@ class BaseTestCase(test.TestCase):
         super(BaseTestCase, self).setUp()
 
         self.flags(reserved_host_disk_mb=0,
-                   reserved_host_memory_mb=0)
+                   reserved_host_memory_mb=0,
+                   compute_node_flush_interval=0)
 
         self.context = FakeContext()
 
@@ -259,6 +261,7 @@ class ResourceTestCase(BaseTestCase):
     def _fake_compute_node_update(self, ctx, compute_node_id, values,
             prune_stats=False):
         self.updated = True
+        self.update_count = getattr(self, 'update_count', 0) + 1
         values['stats'] = [{"key": "num_instances", "value": "1"}]
 
         self.compute.update(values)
@@ -608,3 +611,151 @@ class ResourceTestCase(BaseTestCase):
         instance['vm_state'] = vm_states.DELETED
         self.tracker.update_usage(self.context, instance)
         self.assertEqual(1, self.tracker.compute_node['vcpus_used'])
+
+    def testGpuStats(self):
+        driver = self.tracker.driver
+        self.stubs.Set(driver, 'get_available_resource',
+                lambda: dict(FakeVirtDriver.get_available_resource(driver),
+                             gpus=4, gpus_used=1, gpu_slots=16,
+                             gpu_slots_used=6))
+        self.tracker.update_available_resource(self.context)
+        self.assertEqual(4, self.tracker.stats['gpus'])
+        self.assertEqual(1, self.tracker.stats['gpus_used'])
+        self.assertEqual(16, self.tracker.stats['gpu_slots'])
+        self.assertEqual(6, self.tracker.stats['gpu_slots_used'])
+        self.assertFalse('gpus' in self.tracker.compute_node)
+
+    def _fake_spawn_after(self, seconds, func, *args, **kwargs):
+        timer = (seconds, func, args, kwargs)
+        self.timers.append(timer)
+        return timer
+
+    def testWriteBehindClaims(self):
+        self.flags(compute_node_flush_interval=5)
+        self.timers = []
+        self.stubs.Set(resource_tracker.greenthread, 'spawn_after',
+                self._fake_spawn_after)
+        self.update_count = 0
+
+        instance = self._fake_instance(memory_mb=1, root_gb=1, ephemeral_gb=0)
+        claim = self.tracker.begin_resource_claim(self.context, instance)
+        instance2 = self._fake_instance(memory_mb=2, root_gb=1,
+                                        ephemeral_gb=0)
+        self.tracker.begin_resource_claim(self.context, instance2)
+        self.tracker.abort_resource_claim(self.context, claim)
+
+        # decided in memory, not written yet:
+        self.assertEqual(2, self.tracker.compute_node['memory_mb_used'])
+        self.assertTrue(self.tracker.dirty)
+        self.assertEqual(0, self.update_count)
+        self.assertEqual(0, self.compute['memory_mb_used'])
+
+        # the changes are coalesced into one write, within the interval:
+        self.assertEqual(1, len(self.timers))
+        seconds, func, args, kwargs = self.timers[0]
+        self.assertEqual(5, seconds)
+        func(*args, **kwargs)
+        self.assertEqual(1, self.update_count)
+        self.assertEqual(2, self.compute['memory_mb_used'])
+        self.assertEqual(1, self.compute['local_gb_used'])
+        self.assertFalse(self.tracker.dirty)
+
+        # nothing left to write:
+        self.tracker.flush(self.context)
+        self.assertEqual(1, self.update_count)
+
+    def testFlushKeepsChangesOnFailure(self):
+        self.flags(compute_node_flush_interval=5)
+        self.timers = []
+        self.stubs.Set(resource_tracker.greenthread, 'spawn_after',
+                self._fake_spawn_after)
+        instance = self._fake_instance(memory_mb=1, root_gb=1, ephemeral_gb=0)
+        self.tracker.begin_resource_claim(self.context, instance)
+
+        def fail(*args, **kwargs):
+            raise test.TestingException()
+        self.stubs.Set(db, 'compute_node_update', fail)
+        self.tracker.flush(self.context)
+        self.assertTrue(self.tracker.dirty)
+
+    def testFlushDropsOutdatedSnapshot(self):
+        self.flags(compute_node_flush_interval=5)
+        self.timers = []
+        self.stubs.Set(resource_tracker.greenthread, 'spawn_after',
+                self._fake_spawn_after)
+        instance = self._fake_instance(memory_mb=1, root_gb=1, ephemeral_gb=0)
+        self.tracker.begin_resource_claim(self.context, instance)
+
+        # the hypervisor view changes and gets written by an update while
+        # the flush holds its snapshot, before the flush writes it:
+        take_changes = self.tracker._take_changes
+
+        def fake_take_changes():
+            changes = take_changes()
+            if changes is not None:
+                self.tracker.driver.memory_mb = 10
+                self.tracker.update_available_resource(self.context)
+            return changes
+        self.stubs.Set(self.tracker, '_take_changes', fake_take_changes)
+
+        self.update_count = 0
+        self.tracker.flush(self.context)
+        self.assertEqual(1, self.update_count)
+        self.assertEqual(10, self.compute['memory_mb'])
+        self.assertEqual(1, self.compute['memory_mb_used'])
+        self.assertFalse(self.tracker.dirty)
+
+    def testUpdateWithoutAudit(self):
+        instance = self._fake_instance(memory_mb=2, root_gb=1, ephemeral_gb=0)
+        with self.tracker.resource_claim(self.context, instance):
+            pass
+
+        def fail(*args, **kwargs):
+            self.fail("instances fetched before the audit is due")
+        self.stubs.Set(db, 'instance_get_all_by_filters', fail)
+
+        # the hypervisor grows, usage stays what the tracker counted:
+        self.tracker.driver.memory_mb = 10
+        self.update_count = 0
+        self.tracker.update_available_resource(self.context)
+        self.assertEqual(1, self.update_count)
+        self.assertEqual(10, self.compute['memory_mb'])
+        self.assertEqual(2, self.compute['memory_mb_used'])
+        self.assertEqual(8, self.compute['free_ram_mb'])
+
+        # nothing changed, nothing written:
+        self.tracker.update_available_resource(self.context)
+        self.assertEqual(1, self.update_count)
+
+    def testAuditRecountsInstances(self):
+        self.flags(resource_audit_interval=60)
+        instance = self._fake_instance(memory_mb=2, root_gb=1, ephemeral_gb=0)
+        self._instances.remove(instance)
+        self.tracker.begin_resource_claim(self.context, instance)
+        self.assertEqual(2, self.tracker.compute_node['memory_mb_used'])
+
+        # the instance went away without the tracker being told:
+        self.tracker.last_audit = timeutils.utcnow() - datetime.timedelta(
+                seconds=61)
+        self.tracker.update_available_resource(self.context)
+        self.assertEqual(0, self.tracker.compute_node['memory_mb_used'])
+        self.assertEqual({}, self.tracker.tracked_instances)
+
+    def testResizeUsage(self):
+        instance = self._fake_instance(memory_mb=2, root_gb=1, ephemeral_gb=0)
+        with self.tracker.resource_claim(self.context, instance):
+            pass
+        self.assertEqual(2, self.tracker.compute_node['memory_mb_used'])
+
+        instance['memory_mb'] = 4
+        instance['ephemeral_gb'] = 2
+        self.tracker.update_usage(self.context, instance)
+        self.assertEqual(4, self.tracker.compute_node['memory_mb_used'])
+        self.assertEqual(3, self.tracker.compute_node['local_gb_used'])
+        self.assertEqual({'memory_mb': 4, 'local_gb': 3},
+                         self.tracker.tracked_instances[instance['uuid']])
+
+        instance['vm_state'] = vm_states.DELETED
+        self.tracker.update_usage(self.context, instance)
+        self.assertEqual(0, self.tracker.compute_node['memory_mb_used'])
+        self.assertEqual(0, self.tracker.compute_node['local_gb_used'])
@@ -146,6 +146,10 @@ class ComputeRpcAPITestCase(test.TestCase):
                 instance=self.fake_instance, migration_id='id', host='host',
                 reservations=list('fake_res'))
 
+    def test_get_build_timings(self):
+        self._test_compute_api('get_build_timings', 'call', host='host',
+                version='2.3')
+
     def test_get_console_output(self):
         self._test_compute_api('get_console_output', 'call',
                 instance=self.fake_instance, tail_length='tl')
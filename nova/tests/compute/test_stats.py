@@ -116,6 +116,7 @@ class StatsTestCase(test.TestCase):
         self.assertEqual(2, self.stats["num_vm_" + vm_states.BUILDING])
 
         self.assertEqual(6, self.stats.num_vcpus_used)
+        self.assertEqual(1, self.stats["instance_12-34-56-78-90"])
 
     def test_calculate_workload(self):
         self.stats._increment("num_task_None")
@@ -171,6 +172,7 @@ class StatsTestCase(test.TestCase):
         self.assertEqual(0, self.stats.num_os_type("Linux"))
         self.assertEqual(0, self.stats["num_vm_" + vm_states.BUILDING])
         self.assertEqual(0, self.stats.num_vcpus_used)
+        self.assertFalse("instance_" + instance["uuid"] in self.stats)
 
     def test_io_workload(self):
         vms = [vm_states.ACTIVE, vm_states.BUILDING, vm_states.PAUSED]
@@ -0,0 +1,86 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 University of Southern California
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests for the timing of instance builds"""
+
+from nova.compute import timing
+from nova import test
+
+
+class HistogramTestCase(test.TestCase):
+    def test_summary(self):
+        histogram = timing.Histogram()
+        for seconds in (0.05, 0.3, 0.4, 3, 700):
+            histogram.add(seconds)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 5)
+        self.assertAlmostEqual(summary['mean'], 140.75)
+        self.assertEqual(summary['max'], 700)
+        self.assertEqual(summary['p50'], 0.5)
+        self.assertEqual(summary['p90'], 700)
+        self.assertEqual(summary['buckets'][0], [0.1, 1])
+        self.assertEqual(summary['buckets'][2], [0.5, 2])
+        self.assertEqual(summary['buckets'][-1], [None, 1])
+
+    def test_empty(self):
+        summary = timing.Histogram().summary()
+        self.assertEqual(summary['count'], 0)
+        self.assertEqual(summary['mean'], 0.0)
+
+
+class TimingTestCase(test.TestCase):
+    def setUp(self):
+        super(TimingTestCase, self).setUp()
+        timing.reset()
+
+    def tearDown(self):
+        timing.reset()
+        super(TimingTestCase, self).tearDown()
+
+    def test_build_spans(self):
+        timing.start()
+        with timing.span('network'):
+            pass
+        with timing.span('spawn'):
+            with timing.span('create_image'):
+                pass
+        spans = timing.stop()
+
+        self.assertEqual(sorted(span['phase'] for span in spans),
+                         ['build', 'create_image', 'network', 'spawn'])
+        self.assertFalse(any(span['failed'] for span in spans))
+        self.assertEqual(timing.summary()['spawn']['count'], 1)
+        self.assertEqual(timing.summary()['build']['count'], 1)
+
+    def test_failed_span(self):
+        timing.start()
+
+        def fail():
+            with timing.span('spawn'):
+                raise test.TestingException()
+
+        self.assertRaises(test.TestingException, fail)
+        spans = timing.stop()
+        self.assertTrue([span for span in spans
+                         if span['phase'] == 'spawn' and span['failed']])
+        self.assertFalse('spawn' in timing.summary())
+
+    def test_span_outside_build(self):
+        with timing.span('image_fetch'):
+            pass
+        self.assertEqual(timing.stop(), [])
+        self.assertEqual(timing.summary()['image_fetch']['count'], 1)
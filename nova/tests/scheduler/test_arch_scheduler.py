@@ -0,0 +1,160 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 University of Southern California
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Tests For Architecture Scheduler.
+"""
+
+import mox
+
+from nova import context
+from nova import db
+from nova import exception
+from nova.scheduler import arch
+from nova import test
+from nova.tests.scheduler import test_scheduler
+
+
+def _capabilities(cpu_arch, xpu_arch=None, **kwargs):
+    capabilities = {'vcpus': 8, 'vcpus_used': 2,
+                    'host_memory_free': 4096,
+                    'disk_total': 100, 'disk_used': 10,
+                    'cpu_info': {'arch': cpu_arch,
+                                 'features': ['sse2', 'ssse3'],
+                                 'topology': {'cores': 4, 'threads': 2}},
+                    'cpu_arch': cpu_arch}
+    if xpu_arch:
+        capabilities['xpu_arch'] = xpu_arch
+    capabilities.update(kwargs)
+    return capabilities
+
+
+class HostCapabilitiesTestCase(test.TestCase):
+    """Test case for the parsed host capabilities."""
+
+    def test_flatten(self):
+        caps = arch.HostCapabilities('host1', _capabilities('x86_64',
+                                                            gpus='2'))
+        self.assertEqual(caps.cpu_arch, 'x86_64')
+        self.assertEqual(caps.xpu_arch, None)
+        self.assertEqual(caps.values['gpus'], 2)
+        self.assertEqual(caps.values['cores'], 4)
+        self.assertEqual(caps.items['features'],
+                         frozenset(['sse2', 'ssse3']))
+
+    def test_json_cpu_info(self):
+        caps = arch.HostCapabilities('host1',
+                {'cpu_info': '{"vendor": "Intel", "topology": {"cores": 6}}'})
+        self.assertEqual(caps.values['vendor'], 'Intel')
+        self.assertEqual(caps.values['cores'], 6)
+
+    def test_satisfies(self):
+        caps = arch.HostCapabilities('host1', _capabilities('x86_64',
+                                                            gpus='2'))
+        wanted = arch.parse_extra_specs({'gpus': '1',
+                                         'features': 'ssse3,sse2',
+                                         'cores': '>= 4'})
+        for key in wanted:
+            self.assertTrue(caps.satisfies(key, wanted[key]))
+
+        wanted = arch.parse_extra_specs({'gpus': '3',
+                                         'features': 'avx',
+                                         'cores': '>= 8',
+                                         'missing': 'value'})
+        for key in wanted:
+            self.assertFalse(caps.satisfies(key, wanted[key]))
+
+
+class ArchitectureSchedulerTestCase(test_scheduler.SchedulerTestCase):
+    """Test case for Architecture Scheduler."""
+
+    driver_cls = arch.ArchitectureScheduler
+
+    def setUp(self):
+        super(ArchitectureSchedulerTestCase, self).setUp()
+        self.context = context.RequestContext('fake', 'fake', True)
+        self.driver.update_service_capabilities('compute', 'host1',
+                _capabilities('x86_64'))
+        self.driver.update_service_capabilities('compute', 'host2',
+                _capabilities('x86_64', 'fermi', gpus=2))
+        self.driver.update_service_capabilities('compute', 'host3',
+                _capabilities('tilepro64'))
+
+    def _request_spec(self, extra_specs, vcpus=1):
+        return {'instance_type': {'id': 1, 'vcpus': vcpus,
+                                  'memory_mb': 512, 'root_gb': 10,
+                                  'extra_specs': extra_specs}}
+
+    def _hosts_up_with_arch(self, request_spec):
+        self.mox.StubOutWithMock(self.driver, 'hosts_up')
+        self.driver.hosts_up(self.context, 'compute').AndReturn(
+                ['host1', 'host2', 'host3'])
+        self.mox.ReplayAll()
+        hosts = self.driver.hosts_up_with_arch(self.context, 'compute',
+                                               request_spec)
+        self.mox.VerifyAll()
+        self.mox.UnsetStubs()
+        return sorted(hosts)
+
+    def test_index(self):
+        self.assertEqual(self.driver.cpu_arch_index['x86_64'],
+                         set(['host1', 'host2']))
+        self.assertEqual(self.driver.xpu_arch_index['fermi'],
+                         set(['host2']))
+
+        # host2 comes back with another architecture
+        self.driver.update_service_capabilities('compute', 'host2',
+                _capabilities('tilepro64'))
+        self.assertEqual(self.driver.cpu_arch_index['x86_64'],
+                         set(['host1']))
+        self.assertEqual(self.driver.cpu_arch_index['tilepro64'],
+                         set(['host2', 'host3']))
+        self.assertEqual(self.driver.xpu_arch_index['fermi'], set())
+
+    def test_hosts_up_with_arch(self):
+        hosts = self._hosts_up_with_arch(
+                self._request_spec({'cpu_arch': 'x86_64'}))
+        self.assertEqual(hosts, ['host1', 'host2'])
+
+        hosts = self._hosts_up_with_arch(
+                self._request_spec({'cpu_arch': 'x86_64',
+                                    'xpu_arch': 'fermi',
+                                    'gpus': '= 2'}))
+        self.assertEqual(hosts, ['host2'])
+
+        hosts = self._hosts_up_with_arch(self._request_spec({}, vcpus=6))
+        self.assertEqual(hosts, ['host1', 'host2', 'host3'])
+
+        hosts = self._hosts_up_with_arch(self._request_spec({}, vcpus=7))
+        self.assertEqual(hosts, [])
+
+    def test_extra_specs_from_db(self):
+        request_spec = self._request_spec(None)
+        del request_spec['instance_type']['extra_specs']
+        self.mox.StubOutWithMock(db, 'instance_type_extra_specs_get')
+        db.instance_type_extra_specs_get(self.context, 1).AndReturn(
+                {'cpu_arch': 'tilepro64'})
+        hosts = self._hosts_up_with_arch(request_spec)
+        self.assertEqual(hosts, ['host3'])
+
+    def test_schedule_no_host(self):
+        request_spec = self._request_spec({'cpu_arch': 'armv7l'})
+        self.mox.StubOutWithMock(self.driver, 'hosts_up')
+        self.driver.hosts_up(mox.IgnoreArg(), 'compute').AndReturn(
+                ['host1', 'host2', 'host3'])
+        self.mox.ReplayAll()
+        self.assertRaises(exception.NoValidHost, self.driver._schedule,
+                          self.context, 'compute', request_spec, {})
@@ -157,21 +157,12 @@ class FilterSchedulerTestCase(test_scheduler.SchedulerTestCase):
         """Make sure there's nothing glaringly wrong with _schedule()
         by doing a happy day pass through."""
 
-        self.next_weight = 1.0
-
-        def _fake_weighted_sum(functions, hosts, options):
-            self.next_weight += 2.0
-            host_state = hosts[0]
-            return least_cost.WeightedHost(self.next_weight,
-                    host_state=host_state)
-
         sched = fakes.FakeFilterScheduler()
         fake_context = context.RequestContext('user', 'project',
                 is_admin=True)
 
         self.stubs.Set(sched.host_manager, 'filter_hosts',
                 fake_filter_hosts)
-        self.stubs.Set(least_cost, 'weighted_sum', _fake_weighted_sum)
         fakes.mox_host_manager_db_calls(self.mox, fake_context)
 
         request_spec = {'num_instances': 10,
@@ -191,6 +182,38 @@ class FilterSchedulerTestCase(test_scheduler.SchedulerTestCase):
         for weighted_host in weighted_hosts:
             self.assertTrue(weighted_host.host_state is not None)
 
+    def test_schedule_reweighs_consumed_host(self):
+        """Make sure only the consumed host is weighed again, and that
+        it is dropped once it no longer passes the filters."""
+
+        sched = fakes.FakeFilterScheduler()
+        fake_context = context.RequestContext('user', 'project',
+                is_admin=True)
+        self.flags(scheduler_default_filters=['RamFilter'],
+                   ram_allocation_ratio=1.0,
+                   least_cost_functions=['nova.scheduler.least_cost.'
+                                         'compute_fill_first_cost_fn'],
+                   compute_fill_first_cost_fn_weight=-1.0)
+        fakes.mox_host_manager_db_calls(self.mox, fake_context)
+
+        # free ram: host1 512, host2 1024, host3 3072, host4 8192
+        request_spec = {'num_instances': 4,
+                        'instance_type': {'memory_mb': 3072, 'root_gb': 0,
+                                          'ephemeral_gb': 0,
+                                          'vcpus': 1},
+                        'instance_properties': {'project_id': 1,
+                                                'root_gb': 0,
+                                                'memory_mb': 3072,
+                                                'ephemeral_gb': 0,
+                                                'vcpus': 1,
+                                                'os_type': 'Linux'}}
+        self.mox.ReplayAll()
+        weighted_hosts = sched._schedule(fake_context, 'compute',
+                request_spec, {})
+        hosts = [weighted_host.host_state.host
+                 for weighted_host in weighted_hosts]
+        self.assertEqual(hosts, ['host4', 'host4', 'host3'])
+
     def test_schedule_prep_resize_doesnt_update_host(self):
         fake_context = context.RequestContext('user', 'project',
                 is_admin=True)
@@ -24,7 +24,11 @@ from nova import exception
 from nova import flags
 from nova.openstack.common import jsonutils
 from nova.scheduler import filters
+from nova.scheduler.filters import core_filter
+from nova.scheduler.filters import disk_filter
 from nova.scheduler.filters import extra_specs_ops
+from nova.scheduler.filters import io_ops_filter
+from nova.scheduler.filters import ram_filter
 from nova.scheduler.filters.trusted_filter import AttestationService
 from nova import test
 from nova.tests.scheduler import fakes
@@ -56,6 +60,31 @@ def stub_out_https_backend(stubs):
     stubs.Set(AttestationService, '_do_request', fake_do_request)
 
 
+class CountingFlags(object):
+    """Count the flags read through it."""
+    def __init__(self):
+        self.reads = 0
+
+    def __getattr__(self, name):
+        self.reads += 1
+        return getattr(flags.FLAGS, name)
+
+
+class CountingDict(dict):
+    """Count the keys read from it."""
+    def __init__(self, *args, **kwargs):
+        super(CountingDict, self).__init__(*args, **kwargs)
+        self.reads = 0
+
+    def __getitem__(self, key):
+        self.reads += 1
+        return super(CountingDict, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        self.reads += 1
+        return super(CountingDict, self).get(key, default)
+
+
 class TestFilter(filters.BaseHostFilter):
     pass
 
@@ -539,6 +568,60 @@ class HostFiltersTestCase(test.TestCase):
         self.assertTrue(filt_cls.host_passes(host, filter_properties))
         self.assertEqual(2048 * 2.0, host.limits['memory_mb'])
 
+    def test_gpu_filter_passes(self):
+        filt_cls = self.class_map['GpuFilter']()
+        filter_properties = {'instance_type': {
+                                'extra_specs': {'gpus': '= 2'}}}
+        host = fakes.FakeHostState('host1', 'compute',
+                {'gpus_total': 4, 'gpus_used': 2,
+                 'gpu_slots_total': 4, 'gpu_slots_used': 2})
+        self.assertTrue(filt_cls.host_passes(host, filter_properties))
+
+    def test_gpu_filter_fails_on_shared_gpus(self):
+        filt_cls = self.class_map['GpuFilter']()
+        filter_properties = {'instance_type': {
+                                'extra_specs': {'gpus': '= 2'}}}
+        # one of the two unassigned gpus holds slots of shared instances
+        host = fakes.FakeHostState('host1', 'compute',
+                {'gpus_total': 4, 'gpus_used': 2,
+                 'gpu_slots_total': 16, 'gpu_slots_used': 9})
+        self.assertFalse(filt_cls.host_passes(host, filter_properties))
+
+    def test_gpu_filter_fails_on_gpus(self):
+        filt_cls = self.class_map['GpuFilter']()
+        filter_properties = {'instance_type': {'extra_specs': {}},
+                             'request_spec': {'instance_properties': {
+                                'metadata': {'gpus': '3'}}}}
+        host = fakes.FakeHostState('host1', 'compute',
+                {'gpus_total': 4, 'gpus_used': 2,
+                 'gpu_slots_total': 4, 'gpu_slots_used': 2})
+        self.assertFalse(filt_cls.host_passes(host, filter_properties))
+
+    def test_gpu_filter_passes_on_gpu_slots(self):
+        filt_cls = self.class_map['GpuFilter']()
+        filter_properties = {'instance_type': {
+                                'extra_specs': {'gpu_slots': '= 2'}}}
+        host = fakes.FakeHostState('host1', 'compute',
+                {'gpus_total': 2, 'gpus_used': 2,
+                 'gpu_slots_total': 8, 'gpu_slots_used': 5})
+        self.assertTrue(filt_cls.host_passes(host, filter_properties))
+
+    def test_gpu_filter_fails_on_gpu_slots(self):
+        filt_cls = self.class_map['GpuFilter']()
+        filter_properties = {'instance_type': {'extra_specs': {}},
+                             'request_spec': {'instance_properties': {
+                                'metadata': {'gpu_slots': '2'}}}}
+        host = fakes.FakeHostState('host1', 'compute',
+                {'gpus_total': 2, 'gpus_used': 2,
+                 'gpu_slots_total': 8, 'gpu_slots_used': 7})
+        self.assertFalse(filt_cls.host_passes(host, filter_properties))
+
+    def test_gpu_filter_passes_without_gpus(self):
+        filt_cls = self.class_map['GpuFilter']()
+        filter_properties = {'instance_type': {'memory_mb': 1024}}
+        host = fakes.FakeHostState('host1', 'compute', {})
+        self.assertTrue(filt_cls.host_passes(host, filter_properties))
+
     def test_disk_filter_passes(self):
         self._stub_service_is_up(True)
         filt_cls = self.class_map['DiskFilter']()
@@ -1222,6 +1305,77 @@ class HostFiltersTestCase(test.TestCase):
         host = fakes.FakeHostState('host1', 'compute', {})
         self.assertTrue(filt_cls.host_passes(host, filter_properties))
 
+    def test_ram_filter_all(self):
+        filt_cls = self.class_map['RamFilter']()
+        self.flags(ram_allocation_ratio=1.0)
+        filter_properties = {'instance_type': {'memory_mb': 1024}}
+        host1 = fakes.FakeHostState('host1', 'compute',
+                {'free_ram_mb': 1023, 'total_usable_ram_mb': 1024})
+        host2 = fakes.FakeHostState('host2', 'compute',
+                {'free_ram_mb': 2048, 'total_usable_ram_mb': 4096})
+        hosts = filt_cls.filter_all([host1, host2], filter_properties)
+        self.assertEqual([host2], list(hosts))
+        self.assertEqual(4096, host2.limits['memory_mb'])
+        self.assertFalse('memory_mb' in host1.limits)
+
+    def test_disk_filter_all(self):
+        filt_cls = self.class_map['DiskFilter']()
+        self.flags(disk_allocation_ratio=1.0)
+        filter_properties = {'instance_type': {'root_gb': 1,
+                                               'ephemeral_gb': 1}}
+        host1 = fakes.FakeHostState('host1', 'compute',
+                {'free_disk_mb': 1024, 'total_usable_disk_gb': 12})
+        host2 = fakes.FakeHostState('host2', 'compute',
+                {'free_disk_mb': 11 * 1024, 'total_usable_disk_gb': 12})
+        hosts = filt_cls.filter_all([host1, host2], filter_properties)
+        self.assertEqual([host2], list(hosts))
+        self.assertEqual(12, host2.limits['disk_gb'])
+
+    def test_core_filter_all(self):
+        filt_cls = self.class_map['CoreFilter']()
+        filter_properties = {'instance_type': {'vcpus': 1}}
+        self.flags(cpu_allocation_ratio=2)
+        host1 = fakes.FakeHostState('host1', 'compute',
+                {'vcpus_total': 4, 'vcpus_used': 8})
+        host2 = fakes.FakeHostState('host2', 'compute',
+                {'vcpus_total': 4, 'vcpus_used': 7})
+        host3 = fakes.FakeHostState('host3', 'compute', {})
+        hosts = filt_cls.filter_all([host1, host2, host3], filter_properties)
+        self.assertEqual([host2, host3], list(hosts))
+
+    def test_io_ops_filter_all(self):
+        filt_cls = self.class_map['IoOpsFilter']()
+        self.flags(max_io_ops_per_host=8)
+        host1 = fakes.FakeHostState('host1', 'compute', {'num_io_ops': 8})
+        host2 = fakes.FakeHostState('host2', 'compute', {'num_io_ops': 7})
+        hosts = filt_cls.filter_all([host1, host2], {})
+        self.assertEqual([host2], list(hosts))
+
+    def test_filter_all_reads_request_once(self):
+        """The request and the flags are read once for all the hosts"""
+        hosts = [fakes.FakeHostState('host%d' % i, 'compute',
+                        {'free_ram_mb': 1024, 'total_usable_ram_mb': 1024,
+                         'free_disk_mb': 4096, 'total_usable_disk_gb': 4,
+                         'vcpus_total': 4, 'vcpus_used': 0,
+                         'num_io_ops': 0})
+                 for i in xrange(10)]
+        for module, filter_name, reads in (
+                (ram_filter, 'RamFilter', 2),
+                (disk_filter, 'DiskFilter', 3),
+                (core_filter, 'CoreFilter', 2),
+                (io_ops_filter, 'IoOpsFilter', 0)):
+            counting_flags = CountingFlags()
+            self.stubs.Set(module, 'FLAGS', counting_flags)
+            instance_type = CountingDict(memory_mb=1024, root_gb=1,
+                                         ephemeral_gb=1, vcpus=1)
+            filter_properties = CountingDict(instance_type=instance_type)
+            filt_cls = self.class_map[filter_name]()
+            passed = list(filt_cls.filter_all(hosts, filter_properties))
+            self.assertEqual(hosts, passed)
+            self.assertEqual(1, counting_flags.reads)
+            self.assertEqual(reads, filter_properties.reads +
+                                    instance_type.reads)
+
     def test_core_filter_fails(self):
         filt_cls = self.class_map['CoreFilter']()
         filter_properties = {'instance_type': {'vcpus': 1}}
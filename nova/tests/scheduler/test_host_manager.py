@@ -16,23 +16,27 @@
 Tests For HostManager
 """
 
+import datetime
+
+import mox
 
 from nova.compute import task_states
 from nova.compute import vm_states
 from nova import db
 from nova import exception
 from nova.openstack.common import timeutils
+from nova.scheduler import filters
 from nova.scheduler import host_manager
 from nova import test
 from nova.tests.scheduler import fakes
 
 
-class ComputeFilterClass1(object):
+class ComputeFilterClass1(filters.BaseHostFilter):
     def host_passes(self, *args, **kwargs):
         pass
 
 
-class ComputeFilterClass2(object):
+class ComputeFilterClass2(filters.BaseHostFilter):
     def host_passes(self, *args, **kwargs):
         pass
 
@@ -60,33 +64,82 @@ class HostManagerTestCase(test.TestCase):
         filter_fns = self.host_manager._choose_host_filters(None)
         self.assertEqual(len(filter_fns), 1)
         self.assertEqual(filter_fns[0].__func__,
-                ComputeFilterClass2.host_passes.__func__)
+                ComputeFilterClass2.filter_all.__func__)
 
     def test_filter_hosts(self):
         topic = 'fake_topic'
 
-        filters = ['fake-filter1', 'fake-filter2']
         fake_host1 = host_manager.HostState('host1', topic)
         fake_host2 = host_manager.HostState('host2', topic)
-        hosts = [fake_host1, fake_host2]
+        fake_host3 = host_manager.HostState('host3', topic)
+        hosts = [fake_host1, fake_host2, fake_host3]
         filter_properties = {'fake_prop': 'fake_val'}
 
+        cls1 = ComputeFilterClass1()
+        cls2 = ComputeFilterClass2()
         self.mox.StubOutWithMock(self.host_manager,
                 '_choose_host_filters')
-        self.mox.StubOutWithMock(fake_host1, 'passes_filters')
-        self.mox.StubOutWithMock(fake_host2, 'passes_filters')
+        self.mox.StubOutWithMock(cls1, 'filter_all')
+        self.mox.StubOutWithMock(cls2, 'filter_all')
+        filter_fns = [cls1.filter_all, cls2.filter_all]
 
-        self.host_manager._choose_host_filters(None).AndReturn(filters)
-        fake_host1.passes_filters(filters, filter_properties).AndReturn(
-                False)
-        fake_host2.passes_filters(filters, filter_properties).AndReturn(
-                True)
+        self.host_manager._choose_host_filters(None).AndReturn(filter_fns)
+        cls1.filter_all(hosts, filter_properties).AndReturn(
+                iter([fake_host2, fake_host3]))
+        cls2.filter_all([fake_host2, fake_host3],
+                filter_properties).AndReturn(iter([fake_host2]))
 
         self.mox.ReplayAll()
         filtered_hosts = self.host_manager.filter_hosts(hosts,
                 filter_properties, filters=None)
-        self.assertEqual(len(filtered_hosts), 1)
-        self.assertEqual(filtered_hosts[0], fake_host2)
+        self.assertEqual(filtered_hosts, [fake_host2])
+
+    def test_filter_hosts_stops_when_none_left(self):
+        fake_host1 = host_manager.HostState('host1', 'compute')
+        filter_properties = {}
+
+        cls1 = ComputeFilterClass1()
+        cls2 = ComputeFilterClass2()
+        self.mox.StubOutWithMock(self.host_manager,
+                '_choose_host_filters')
+        self.mox.StubOutWithMock(cls1, 'filter_all')
+        self.mox.StubOutWithMock(cls2, 'filter_all')
+        filter_fns = [cls1.filter_all, cls2.filter_all]
+
+        self.host_manager._choose_host_filters(None).AndReturn(filter_fns)
+        cls1.filter_all([fake_host1], filter_properties).AndReturn(iter([]))
+        # cls2.filter_all() not called, no host left to filter
+
+        self.mox.ReplayAll()
+        filtered_hosts = self.host_manager.filter_hosts([fake_host1],
+                filter_properties)
+        self.assertEqual(filtered_hosts, [])
+
+    def test_filter_hosts_ignore_and_force(self):
+        fake_host1 = host_manager.HostState('host1', 'compute')
+        fake_host2 = host_manager.HostState('host2', 'compute')
+        hosts = [fake_host1, fake_host2]
+
+        cls1 = ComputeFilterClass1()
+        self.mox.StubOutWithMock(self.host_manager,
+                '_choose_host_filters')
+        self.mox.StubOutWithMock(cls1, 'filter_all')
+
+        ignore_properties = {'ignore_hosts': ['host1']}
+        self.host_manager._choose_host_filters(None).AndReturn(
+                [cls1.filter_all])
+        cls1.filter_all([fake_host2], ignore_properties).AndReturn(
+                iter([fake_host2]))
+        force_properties = {'force_hosts': ['host1']}
+        self.host_manager._choose_host_filters(None).AndReturn(
+                [cls1.filter_all])
+        # cls1.filter_all() not called for forced hosts
+
+        self.mox.ReplayAll()
+        self.assertEqual(self.host_manager.filter_hosts(hosts,
+                ignore_properties), [fake_host2])
+        self.assertEqual(self.host_manager.filter_hosts(hosts,
+                force_properties), [fake_host1])
 
     def test_update_service_capabilities(self):
         service_states = self.host_manager.service_states
@@ -158,6 +211,172 @@ class HostManagerTestCase(test.TestCase):
         # 8191GB
         self.assertEqual(host_states['host4'].free_disk_mb, 8388608)
 
+    def test_get_all_host_states_incremental(self):
+        context = 'fake_context'
+        topic = 'compute'
+        self.flags(scheduler_host_state_full_refresh_interval=300)
+        self.mox.StubOutWithMock(db, 'compute_node_get_all')
+        self.mox.StubOutWithMock(db, 'service_get_all')
+
+        db.compute_node_get_all(context).AndReturn(fakes.COMPUTE_NODES[:4])
+        host1 = dict(fakes.COMPUTE_NODES[0], free_ram_mb=256)
+        host2 = dict(fakes.COMPUTE_NODES[1], deleted=True)
+        db.compute_node_get_all(context,
+                updated_since=mox.IgnoreArg()).AndReturn([host1, host2])
+        db.service_get_all(context).AndReturn([
+                dict(host='host3', topic='compute', disabled=True)])
+
+        self.mox.ReplayAll()
+        host_states = self.host_manager.get_all_host_states(context, topic)
+        self.assertEqual(len(host_states), 4)
+        host3_state = host_states['host3']
+        host_states = self.host_manager.get_all_host_states(context, topic)
+
+        self.assertEqual(sorted(host_states.keys()),
+                         ['host1', 'host3', 'host4'])
+        self.assertEqual(host_states['host1'].free_ram_mb, 256)
+        self.assertTrue(host_states['host3'] is host3_state)
+        self.assertTrue(host_states['host3'].service['disabled'])
+
+    def test_get_all_host_states_refresh_margin(self):
+        """Compute nodes updated just before the last request are read
+        again"""
+        context = 'fake_context'
+        topic = 'compute'
+        self.flags(scheduler_host_state_full_refresh_interval=300,
+                   scheduler_host_state_refresh_margin=10)
+        self.mox.StubOutWithMock(db, 'compute_node_get_all')
+        self.mox.StubOutWithMock(db, 'service_get_all')
+        self.mox.StubOutWithMock(timeutils, 'utcnow')
+
+        now = datetime.datetime(2012, 11, 1, 12, 0, 0)
+        timeutils.utcnow().AndReturn(now)
+        db.compute_node_get_all(context).AndReturn(fakes.COMPUTE_NODES[:4])
+        timeutils.utcnow().AndReturn(now + datetime.timedelta(seconds=5))
+        timeutils.utcnow().AndReturn(now + datetime.timedelta(seconds=5))
+        db.compute_node_get_all(context,
+                updated_since=now - datetime.timedelta(seconds=10)).\
+                AndReturn([])
+        db.service_get_all(context).AndReturn([])
+
+        self.mox.ReplayAll()
+        self.host_manager.get_all_host_states(context, topic)
+        self.host_manager.get_all_host_states(context, topic)
+
+    def test_get_all_host_states_keeps_unconfirmed(self):
+        context = 'fake_context'
+        topic = 'compute'
+        self.flags(scheduler_host_state_full_refresh_interval=0,
+                   scheduler_host_state_refresh_margin=10)
+        self.mox.StubOutWithMock(db, 'compute_node_get_all')
+        self.mox.StubOutWithMock(timeutils, 'utcnow')
+
+        now = datetime.datetime(2012, 11, 1, 12, 0, 0)
+        host1 = dict(fakes.COMPUTE_NODES[0], updated_at=now)
+        instance = dict(root_gb=0, ephemeral_gb=0, memory_mb=128, vcpus=1)
+
+        timeutils.utcnow().AndReturn(now)
+        db.compute_node_get_all(context).AndReturn([host1])
+        # consumed after the compute node was updated
+        timeutils.utcnow().AndReturn(now + datetime.timedelta(seconds=1))
+        timeutils.utcnow().AndReturn(now + datetime.timedelta(seconds=2))
+        # updated within the margin, not assumed to account for it yet
+        db.compute_node_get_all(context).AndReturn(
+                [dict(host1, updated_at=now + datetime.timedelta(seconds=5))])
+        timeutils.utcnow().AndReturn(now + datetime.timedelta(seconds=20))
+        db.compute_node_get_all(context).AndReturn(
+                [dict(host1, updated_at=now + datetime.timedelta(seconds=15),
+                      free_ram_mb=384)])
+
+        self.mox.ReplayAll()
+        host_states = self.host_manager.get_all_host_states(context, topic)
+        host_states['host1'].consume_from_instance(instance)
+        self.assertEqual(host_states['host1'].free_ram_mb, 384)
+
+        host_states = self.host_manager.get_all_host_states(context, topic)
+        self.assertEqual(host_states['host1'].free_ram_mb, 384)
+
+        host_states = self.host_manager.get_all_host_states(context, topic)
+        self.assertEqual(host_states['host1'].free_ram_mb, 384)
+        self.assertEqual(host_states['host1'].consumed, [])
+
+    def test_get_all_host_states_drops_confirmed(self):
+        """An instance the compute node reports is counted once, even
+        within the margin"""
+        context = 'fake_context'
+        topic = 'compute'
+        self.flags(scheduler_host_state_full_refresh_interval=0,
+                   scheduler_host_state_refresh_margin=30)
+        self.mox.StubOutWithMock(db, 'compute_node_get_all')
+        self.mox.StubOutWithMock(timeutils, 'utcnow')
+
+        now = datetime.datetime(2012, 11, 1, 12, 0, 0)
+        host1 = dict(fakes.COMPUTE_NODES[0], updated_at=now)
+        instance = dict(root_gb=0, ephemeral_gb=0, memory_mb=128, vcpus=1,
+                        uuid='fake-uuid')
+
+        timeutils.utcnow().AndReturn(now)
+        db.compute_node_get_all(context).AndReturn([host1])
+        timeutils.utcnow().AndReturn(now + datetime.timedelta(seconds=1))
+        # the claim is written two seconds later
+        timeutils.utcnow().AndReturn(now + datetime.timedelta(seconds=4))
+        db.compute_node_get_all(context).AndReturn(
+                [dict(host1, updated_at=now + datetime.timedelta(seconds=3),
+                      free_ram_mb=384,
+                      stats=[dict(key='instance_fake-uuid', value='1')])])
+
+        self.mox.ReplayAll()
+        host_states = self.host_manager.get_all_host_states(context, topic)
+        host_states['host1'].consume_from_instance(instance)
+        self.assertEqual(host_states['host1'].free_ram_mb, 384)
+
+        host_states = self.host_manager.get_all_host_states(context, topic)
+        self.assertEqual(host_states['host1'].free_ram_mb, 384)
+        self.assertEqual(host_states['host1'].consumed, [])
+
+    def test_get_all_host_states_drops_expired(self):
+        """Instances the compute node never reports stop being counted"""
+        context = 'fake_context'
+        topic = 'compute'
+        self.flags(scheduler_host_state_full_refresh_interval=300,
+                   scheduler_host_state_refresh_margin=30,
+                   scheduler_host_state_consumed_max_age=60)
+        self.mox.StubOutWithMock(db, 'compute_node_get_all')
+        self.mox.StubOutWithMock(db, 'service_get_all')
+        self.mox.StubOutWithMock(timeutils, 'utcnow')
+
+        now = datetime.datetime(2012, 11, 1, 12, 0, 0)
+        host1 = dict(fakes.COMPUTE_NODES[0], updated_at=now)
+        instance = dict(root_gb=0, ephemeral_gb=0, memory_mb=128, vcpus=1,
+                        uuid='fake-uuid')
+
+        timeutils.utcnow().AndReturn(now)
+        db.compute_node_get_all(context).AndReturn([host1])
+        timeutils.utcnow().AndReturn(now + datetime.timedelta(seconds=1))
+        # the build failed, the idle compute node writes nothing new
+        # until the next full refresh
+        timeutils.utcnow().AndReturn(now + datetime.timedelta(seconds=30))
+        timeutils.utcnow().AndReturn(now + datetime.timedelta(seconds=30))
+        db.compute_node_get_all(context,
+                updated_since=now - datetime.timedelta(seconds=30)).\
+                AndReturn([])
+        db.service_get_all(context).AndReturn([])
+        timeutils.utcnow().AndReturn(now + datetime.timedelta(seconds=400))
+        timeutils.utcnow().AndReturn(now + datetime.timedelta(seconds=400))
+        db.compute_node_get_all(context).AndReturn([host1])
+
+        self.mox.ReplayAll()
+        host_states = self.host_manager.get_all_host_states(context, topic)
+        host_states['host1'].consume_from_instance(instance)
+        self.assertEqual(host_states['host1'].free_ram_mb, 384)
+
+        host_states = self.host_manager.get_all_host_states(context, topic)
+        self.assertEqual(host_states['host1'].free_ram_mb, 384)
+
+        host_states = self.host_manager.get_all_host_states(context, topic)
+        self.assertEqual(host_states['host1'].free_ram_mb, 512)
+        self.assertEqual(host_states['host1'].consumed, [])
+
 
 class HostStateTestCase(test.TestCase):
     """Test case for HostState class"""
@@ -301,3 +520,69 @@ class HostStateTestCase(test.TestCase):
         self.assertEqual(1, host.task_states[None])
         self.assertEqual(2, host.num_instances_by_os_type['Linux'])
         self.assertEqual(1, host.num_io_ops)
+
+    def test_gpu_consumption_from_compute_node(self):
+        stats = [dict(key='gpus', value='4'), dict(key='gpus_used', value='1')]
+        compute = dict(stats=stats, memory_mb=0, free_disk_gb=0, local_gb=0,
+                       local_gb_used=0, free_ram_mb=0, vcpus=0, vcpus_used=0)
+
+        host = host_manager.HostState("fakehost", "faketopic")
+        host.update_from_compute_node(compute)
+        self.assertEqual(3, host.free_gpus)
+
+        instance = dict(root_gb=0, ephemeral_gb=0, memory_mb=0, vcpus=0,
+                        project_id='12345', vm_state=vm_states.BUILDING,
+                        task_state=None, os_type='Linux',
+                        metadata={'gpus': '1'})
+        host.consume_from_instance(instance,
+                                   {'extra_specs': {'gpus': '= 2'}})
+        self.assertEqual(1, host.free_gpus)
+
+    def test_gpu_slot_consumption_from_compute_node(self):
+        stats = [dict(key='gpus', value='2'), dict(key='gpus_used', value='1'),
+                 dict(key='gpu_slots', value='8'),
+                 dict(key='gpu_slots_used', value='5')]
+        compute = dict(stats=stats, memory_mb=0, free_disk_gb=0, local_gb=0,
+                       local_gb_used=0, free_ram_mb=0, vcpus=0, vcpus_used=0)
+
+        host = host_manager.HostState("fakehost", "faketopic")
+        host.update_from_compute_node(compute)
+        self.assertEqual(3, host.free_gpu_slots)
+
+        instance = dict(root_gb=0, ephemeral_gb=0, memory_mb=0, vcpus=0,
+                        project_id='12345', vm_state=vm_states.BUILDING,
+                        task_state=None, os_type='Linux',
+                        metadata={'gpu_slots': '2'})
+        host.consume_from_instance(instance, {'extra_specs': {}})
+        self.assertEqual(1, host.free_gpu_slots)
+
+    def test_gpus_and_gpu_slots_consumed_together(self):
+        stats = [dict(key='gpus', value='2'), dict(key='gpus_used', value='0'),
+                 dict(key='gpu_slots', value='8'),
+                 dict(key='gpu_slots_used', value='0')]
+        compute = dict(stats=stats, memory_mb=0, free_disk_gb=0, local_gb=0,
+                       local_gb_used=0, free_ram_mb=0, vcpus=0, vcpus_used=0)
+        host = host_manager.HostState("fakehost", "faketopic")
+        host.update_from_compute_node(compute)
+        instance = dict(root_gb=0, ephemeral_gb=0, memory_mb=0, vcpus=0,
+                        project_id='12345', vm_state=vm_states.BUILDING,
+                        task_state=None, os_type='Linux')
+
+        # a shared slot may take a whole gpu
+        host.consume_from_instance(dict(instance,
+                                        metadata={'gpu_slots': '1'}))
+        self.assertEqual(7, host.free_gpu_slots)
+        self.assertEqual(1, host.free_gpus)
+
+        # a whole gpu takes all of its slots
+        host.consume_from_instance(dict(instance, metadata={'gpus': '1'}))
+        self.assertEqual(3, host.free_gpu_slots)
+        self.assertEqual(0, host.free_gpus)
+
+    def test_gpus_from_capabilities(self):
+        compute = dict(stats=[], memory_mb=0, free_disk_gb=0, local_gb=0,
+                       local_gb_used=0, free_ram_mb=0, vcpus=0, vcpus_used=0)
+        host = host_manager.HostState("fakehost", "compute",
+                                      capabilities={'compute': {'gpus': 2}})
+        host.update_from_compute_node(compute)
+        self.assertEqual(2, host.free_gpus)
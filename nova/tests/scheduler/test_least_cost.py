@@ -88,6 +88,71 @@ class LeastCostTestCase(test.TestCase):
         self.assertEqual(weighted_host.weight, 10512)
         self.assertEqual(weighted_host.host_state.host, 'host1')
 
+    def test_weighted_host_queue(self):
+        fn_tuples = [(1.0, offset), (1.0, scale)]
+        hostinfo_list = self._get_all_hosts()
+
+        # same weights as test_weighted_sum_happy_day:
+        # [11536, 13072, 19216, 34576]
+        queue = least_cost.WeightedHostQueue(fn_tuples, hostinfo_list, {})
+        self.assertEqual(len(queue), 4)
+        weighted_host = queue.best()
+        self.assertEqual(weighted_host.weight, 11536)
+        self.assertEqual(weighted_host.host_state.host, 'host1')
+
+        # host1 gains 1024MB of free ram: 10000 + 1536 * 3 = 14608
+        host1 = weighted_host.host_state
+        host1.free_ram_mb += 1024
+        queue.push(host1)
+        self.assertEqual(len(queue), 4)
+        weighted_host = queue.best()
+        self.assertEqual(weighted_host.weight, 13072)
+        self.assertEqual(weighted_host.host_state.host, 'host2')
+
+        queue.remove(weighted_host.host_state)
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue.best().host_state.host, 'host1')
+
+    def test_weighted_host_queue_empty(self):
+        queue = least_cost.WeightedHostQueue([(1.0, offset)], [], {})
+        self.assertEqual(queue.best(), None)
+
+    def test_compute_gpu_fill_first_cost_fn(self):
+        host1 = fakes.FakeHostState('host1', 'compute',
+                                    {'gpus_total': 4, 'gpus_used': 3,
+                                     'gpu_slots_total': 4,
+                                     'gpu_slots_used': 3})
+        host2 = fakes.FakeHostState('host2', 'compute',
+                                    {'gpus_total': 4, 'gpus_used': 0,
+                                     'gpu_slots_total': 4,
+                                     'gpu_slots_used': 0})
+        fn_tuples = [(1.0, least_cost.compute_gpu_fill_first_cost_fn)]
+
+        weighted_host = least_cost.weighted_sum(fn_tuples, [host1, host2],
+                                                {})
+        self.assertEqual(weighted_host.host_state.host, 'host1')
+
+        # spread-first
+        fn_tuples = [(-1.0, least_cost.compute_gpu_fill_first_cost_fn)]
+        weighted_host = least_cost.weighted_sum(fn_tuples, [host1, host2],
+                                                {})
+        self.assertEqual(weighted_host.host_state.host, 'host2')
+
+    def test_compute_gpu_fill_first_cost_fn_packs_slots(self):
+        host1 = fakes.FakeHostState('host1', 'compute',
+                                    {'gpus_total': 2, 'gpus_used': 0,
+                                     'gpu_slots_total': 8,
+                                     'gpu_slots_used': 1})
+        host2 = fakes.FakeHostState('host2', 'compute',
+                                    {'gpus_total': 2, 'gpus_used': 0,
+                                     'gpu_slots_total': 8,
+                                     'gpu_slots_used': 3})
+        fn_tuples = [(1.0, least_cost.compute_gpu_fill_first_cost_fn)]
+
+        weighted_host = least_cost.weighted_sum(fn_tuples, [host1, host2],
+                                                {})
+        self.assertEqual(weighted_host.host_state.host, 'host2')
+
 
 class TestWeightedHost(test.TestCase):
     def test_dict_conversion_without_host_state(self):
@@ -20,9 +20,17 @@
 """Unit tests for the DB API"""
 
 import datetime
+import os
+import shutil
+import tempfile
+
+import sqlalchemy
 
 from nova import context
 from nova import db
+from nova.db.sqlalchemy import api as sqlalchemy_api
+from nova.db.sqlalchemy import models
+from nova.db.sqlalchemy import session as sql_session
 from nova import exception
 from nova import flags
 from nova.openstack.common import timeutils
@@ -45,6 +53,46 @@ class DbApiTestCase(test.TestCase):
         args.update(kwargs)
         return db.instance_create(self.context, args)
 
+    def test_use_tpool(self):
+        self.flags(db_use_tpool=True)
+        calls = []
+
+        def fake_execute(fn, *args, **kwargs):
+            calls.append(fn)
+            return fn(*args, **kwargs)
+
+        self.stubs.Set(db.api.tpool, 'execute', fake_execute)
+        instance = self.create_instances_with_args()
+        result = db.instance_get_by_uuid(self.context, instance['uuid'])
+        self.assertEqual(result['id'], instance['id'])
+        backend = db.api.IMPL._backend
+        self.assertEqual(calls, [backend.instance_create,
+                                 backend.instance_get_by_uuid])
+
+        self.flags(db_use_tpool=False)
+        db.instance_get_by_uuid(self.context, instance['uuid'])
+        self.assertEqual(len(calls), 2)
+
+    def test_slow_call_logged(self):
+        self.flags(db_slow_call_time=2)
+        times = iter([10, 13, 20, 21])
+        self.stubs.Set(db.api.time, 'time', lambda: times.next())
+        warnings = []
+        self.stubs.Set(db.api.LOG, 'warn',
+                       lambda msg, values: warnings.append(values['name']))
+
+        class FakeBackend(object):
+            def slow_call(self):
+                return 'slow'
+
+            def fast_call(self):
+                return 'fast'
+
+        wrapper = db.api.DbapiWrapper(FakeBackend())
+        self.assertEqual(wrapper.slow_call(), 'slow')
+        self.assertEqual(wrapper.fast_call(), 'fast')
+        self.assertEqual(warnings, ['slow_call'])
+
     def test_ec2_ids_not_found_are_printable(self):
         def check_exc_format(method):
             try:
@@ -86,6 +134,38 @@ class DbApiTestCase(test.TestCase):
                                                 {'display_name': '%test%'})
         self.assertEqual(2, len(result))
 
+    def test_instance_get_all_by_filters_regex_literal(self):
+        for name in ('test1', 'test_1', 'mytest', 'te%t', 'tast'):
+            self.create_instances_with_args(display_name=name)
+
+        def names(regex):
+            result = db.instance_get_all_by_filters(self.context,
+                                                    {'display_name': regex})
+            return sorted(instance['display_name'] for instance in result)
+
+        self.assertEqual(names('^test'), ['test1', 'test_1'])
+        self.assertEqual(names('^test1$'), ['test1'])
+        self.assertEqual(names('test$'), ['mytest'])
+        self.assertEqual(names('test'), ['mytest', 'test1', 'test_1'])
+        self.assertEqual(names('^te%t'), ['te%t'])
+        self.assertEqual(names('^test\\_'), ['test_1'])
+        # real regular expressions are still matched with REGEXP
+        self.assertEqual(names('^t.st$'), ['tast'])
+        self.assertEqual(names('^test\\d'), ['test1'])
+
+    def test_regex_clause(self):
+        display_name = models.Instance.display_name
+        self.assertEqual(str(sqlalchemy_api.regex_clause(display_name,
+                                                         '^abc')),
+                         'instances.display_name LIKE :display_name_1 '
+                         'ESCAPE \'!\'')
+        self.assertEqual(str(sqlalchemy_api.regex_clause(display_name,
+                                                         '^abc$')),
+                         'instances.display_name = :display_name_1')
+        for regex in ('a.c', '^ab+', 'a|b', '[ab]', 'a\\w'):
+            self.assertEqual(sqlalchemy_api.regex_clause(display_name,
+                                                         regex), None)
+
     def test_instance_get_all_by_filters_metadata(self):
         self.create_instances_with_args(metadata={'foo': 'bar'})
         self.create_instances_with_args()
@@ -143,6 +223,60 @@ class DbApiTestCase(test.TestCase):
                           self.context, {'display_name': '%test%'},
                           marker=str(utils.gen_uuid()))
 
+    def test_instance_get_all_by_filters_paginate_keyset(self):
+        created_at = datetime.datetime(2012, 10, 1, 12, 0, 0)
+        uuids = []
+        for minutes in (0, 1, 1, 1, 2):
+            instance = self.create_instances_with_args(
+                    created_at=created_at + datetime.timedelta(
+                            minutes=minutes))
+            uuids.append(instance['uuid'])
+
+        # pages are sorted by created_at, then id, and each page starts
+        # right after the marker, also within the same created_at
+        for sort_dir, expected in (('asc', uuids),
+                                   ('desc', list(reversed(uuids)))):
+            seen = []
+            marker = None
+            while True:
+                result = db.instance_get_all_by_filters(self.context, {},
+                                                        sort_key='created_at',
+                                                        sort_dir=sort_dir,
+                                                        limit=2,
+                                                        marker=marker)
+                if not result:
+                    break
+                seen.extend(instance['uuid'] for instance in result)
+                marker = result[-1]['uuid']
+            self.assertEqual(seen, expected)
+
+    def test_instance_get_all_by_filters_related_loaded(self):
+        instance = self.create_instances_with_args(metadata={'foo': 'bar'})
+        db.instance_info_cache_update(self.context, instance['uuid'],
+                                      {'network_info': '[]'})
+        group = db.security_group_create(self.context,
+                                         {'name': 'group1',
+                                          'project_id': self.project_id})
+        db.instance_add_security_group(self.context, instance['uuid'],
+                                       group['id'])
+        self.create_instances_with_args()
+
+        result = db.instance_get_all_by_filters(self.context, {},
+                                                sort_dir='asc')
+        # detached from their session, the instances cannot lazy load
+        # the relations that were not loaded with them
+        sqlalchemy.orm.object_session(result[0]).expunge_all()
+        self.assertEqual(2, len(result))
+        self.assertEqual(result[0]['info_cache']['network_info'], '[]')
+        self.assertEqual([group['name']
+                          for group in result[0]['security_groups']],
+                         ['group1'])
+        self.assertEqual([(item['key'], item['value'])
+                          for item in result[0]['metadata']],
+                         [('foo', 'bar')])
+        self.assertEqual(result[1]['security_groups'], [])
+        self.assertEqual(result[1]['metadata'], [])
+
     def test_migration_get_unconfirmed_by_dest_compute(self):
         ctxt = context.get_admin_context()
 
@@ -279,6 +413,18 @@ class DbApiTestCase(test.TestCase):
         self.assertEquals("building", old_ref["vm_state"])
         self.assertEquals("needscoffee", new_ref["vm_state"])
 
+    def test_instance_update_power_states(self):
+        ctxt = context.get_admin_context()
+        instances = [db.instance_create(ctxt, {'power_state': 1})
+                     for i in xrange(3)]
+
+        db.instance_update_power_states(ctxt, {instances[0]['uuid']: 4,
+                                               instances[1]['uuid']: 0})
+        power_states = [db.instance_get_by_uuid(ctxt,
+                                                i['uuid'])['power_state']
+                        for i in instances]
+        self.assertEqual([4, 0, 1], power_states)
+
     def test_instance_fault_create(self):
         """Ensure we can create an instance fault"""
         ctxt = context.get_admin_context()
@@ -899,6 +1045,61 @@ class AggregateDBApiTestCase(test.TestCase):
                           ctxt, result.id, _get_fake_aggr_hosts()[0])
 
 
+class SlaveSessionTestCase(test.TestCase):
+    """Tests for reading from a slave database, a second sqlite file."""
+
+    def setUp(self):
+        super(SlaveSessionTestCase, self).setUp()
+        self.ctxt = context.get_admin_context()
+        self.tempdir = tempfile.mkdtemp()
+        self.flags(sql_slave_connection='sqlite:///%s' %
+                   os.path.join(self.tempdir, 'slave.sqlite'))
+        for name in ('_SLAVE_ENGINE', '_SLAVE_MAKER', '_SLAVE_LAG'):
+            self.stubs.Set(sql_session, name, None)
+        engine = sql_session.get_engine(slave_engine=True)
+        models.BASE.metadata.create_all(engine)
+
+        self.instance = db.instance_create(self.ctxt, {'host': 'master'})
+        session = sql_session.get_maker(engine)()
+        with session.begin():
+            instance = models.Instance()
+            instance.update({'uuid': str(utils.gen_uuid()), 'host': 'slave'})
+            session.add(instance)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super(SlaveSessionTestCase, self).tearDown()
+
+    def _hosts(self, use_slave):
+        return [instance['host'] for instance in
+                db.instance_get_all_by_filters(self.ctxt, {},
+                                               use_slave=use_slave)]
+
+    def test_use_slave(self):
+        self.assertEqual(self._hosts(False), ['master'])
+        self.assertEqual(self._hosts(True), ['slave'])
+
+    def test_no_slave(self):
+        self.flags(sql_slave_connection='')
+        self.assertEqual(self._hosts(True), ['master'])
+
+    def test_slave_lag(self):
+        self.flags(sql_slave_max_lag=10)
+        lags = [20, 5]
+        self.stubs.Set(sql_session, 'get_slave_lag',
+                       lambda engine: lags.pop(0))
+        self.stubs.Set(sql_session.time, 'time', lambda: 1000)
+        self.assertEqual(self._hosts(True), ['master'])
+        # the lag is only checked again once it may have changed enough
+        self.assertEqual(self._hosts(True), ['master'])
+
+        self.stubs.Set(sql_session.time, 'time', lambda: 1011)
+        self.assertEqual(self._hosts(True), ['slave'])
+        self.stubs.Set(sql_session.time, 'time', lambda: 1017)
+        self.assertEqual(self._hosts(True), ['master'])
+        self.assertEqual(lags, [])
+
+
 class CapacityTestCase(test.TestCase):
     def setUp(self):
         super(CapacityTestCase, self).setUp()
@@ -961,6 +1162,45 @@ class CapacityTestCase(test.TestCase):
         self.assertEqual(2, int(stats['num_proj_12345']))
         self.assertEqual(3, int(stats['num_vm_building']))
 
+    def test_compute_node_get_by_hosts(self):
+        self.compute_node_dict['hypervisor_hostname'] = 'node1'
+        item = self._create_helper('host1')
+
+        nodes = db.compute_node_get_by_hosts(self.ctxt, ['host1', 'host2'])
+        self.assertEqual(nodes.keys(), ['host1'])
+        self.assertEqual(nodes['host1']['id'], item['id'])
+        self.assertEqual(nodes['host1']['hypervisor_hostname'], 'node1')
+        self.assertEqual(db.compute_node_get_by_hosts(self.ctxt, []), {})
+
+    def test_compute_node_get_all_updated_since(self):
+        before = timeutils.utcnow() - datetime.timedelta(seconds=1)
+        item = self._create_helper('host1')
+        nodes = db.compute_node_get_all(self.ctxt, updated_since=before)
+        self.assertEqual([item['id']], [node['id'] for node in nodes])
+
+        later = timeutils.utcnow() + datetime.timedelta(seconds=1)
+        nodes = db.compute_node_get_all(self.ctxt, updated_since=later)
+        self.assertEqual([], nodes)
+
+        db.compute_node_update(self.ctxt, item['id'],
+                               {'stats': {'num_instances': 4}})
+        nodes = db.compute_node_get_all(self.ctxt, updated_since=before)
+        self.assertEqual(1, len(nodes))
+
+    def test_compute_node_get_all_by_arch(self):
+        self.compute_node_dict.update(cpu_arch='x86_64', xpu_arch='fermi')
+        self._create_helper('host1')
+        service = db.service_create(self.ctxt, dict(host='host2',
+                binary='binary2', topic='compute', report_count=1,
+                disabled=False))
+        self.compute_node_dict.update(cpu_arch='tilepro64', xpu_arch=None,
+                                      service_id=service['id'], stats={})
+        self._create_helper('host2')
+
+        nodes = db.compute_node_get_all_by_arch(self.ctxt, 'x86_64', 'fermi')
+        self.assertEqual(1, len(nodes))
+        self.assertEqual('x86_64', nodes[0]['cpu_arch'])
+
     def test_compute_node_update(self):
         item = self._create_helper('host1')
 
@@ -1263,3 +1503,88 @@ class SMVolumeDBApiTestCase(test.TestCase):
                           db.sm_flavor_get,
                           ctxt,
                           "fake")
+
+
+class ArchiveTestCase(test.TestCase):
+
+    def setUp(self):
+        super(ArchiveTestCase, self).setUp()
+        self.context = context.get_admin_context()
+        self.engine = sql_session.get_engine()
+        self.meta = sqlalchemy.MetaData(bind=self.engine)
+        self.instance_metadata = sqlalchemy.Table('instance_metadata',
+                self.meta, autoload=True)
+        self.shadow_instance_metadata = sqlalchemy.Table(
+                'shadow_instance_metadata', self.meta, autoload=True)
+
+    def _count(self, table):
+        query = sqlalchemy.select([sqlalchemy.func.count()]).\
+                select_from(table)
+        return self.engine.execute(query).scalar()
+
+    def _create_instance(self, metadata):
+        return db.instance_create(self.context, {'metadata': metadata})
+
+    def test_archive_deleted_rows(self):
+        instance = self._create_instance({'a': '1', 'b': '2', 'c': '3'})
+        self._create_instance({'d': '4'})
+        db.instance_metadata_delete(self.context, instance['uuid'], 'a')
+        db.instance_metadata_delete(self.context, instance['uuid'], 'b')
+
+        rows = db.archive_deleted_rows_for_table(self.context,
+                                                 'instance_metadata', 10)
+        self.assertEqual(rows, 2)
+        self.assertEqual(self._count(self.instance_metadata), 2)
+        self.assertEqual(self._count(self.shadow_instance_metadata), 2)
+        # live rows are still there
+        self.assertEqual(db.instance_metadata_get(self.context,
+                                                  instance['uuid']),
+                         {'c': '3'})
+
+        rows = db.archive_deleted_rows_for_table(self.context,
+                                                 'instance_metadata', 10)
+        self.assertEqual(rows, 0)
+
+    def test_archive_deleted_rows_max_rows(self):
+        instance = self._create_instance({'a': '1', 'b': '2', 'c': '3'})
+        db.instance_destroy(self.context, instance['uuid'])
+        for key in ('a', 'b', 'c'):
+            db.instance_metadata_delete(self.context, instance['uuid'], key)
+
+        while True:
+            rows = db.archive_deleted_rows(self.context, 2)
+            self.assertTrue(rows <= 2)
+            if not rows:
+                break
+
+        self.assertEqual(self._count(self.instance_metadata), 0)
+        self.assertEqual(self._count(self.shadow_instance_metadata), 3)
+        self.assertRaises(exception.InstanceNotFound,
+                          db.instance_get_by_uuid,
+                          self.context.elevated(read_deleted='yes'),
+                          instance['uuid'])
+
+    def test_archive_deleted_rows_referred_to(self):
+        """Deleted rows still referred to do not hold up the others"""
+        self.engine.execute("PRAGMA foreign_keys = ON")
+        self.addCleanup(self.engine.execute, "PRAGMA foreign_keys = OFF")
+        instances = sqlalchemy.Table('instances', self.meta, autoload=True)
+        shadow_instances = sqlalchemy.Table('shadow_instances', self.meta,
+                                            autoload=True)
+        # the system metadata stays when the instance is destroyed
+        instance = db.instance_create(self.context,
+                                      {'system_metadata': {'a': '1'}})
+        db.instance_destroy(self.context, instance['uuid'])
+        instance = self._create_instance({})
+        db.instance_destroy(self.context, instance['uuid'])
+
+        while db.archive_deleted_rows(self.context, 10):
+            pass
+
+        self.assertEqual(self._count(instances), 1)
+        self.assertEqual(self._count(shadow_instances), 1)
+
+    def test_archive_deleted_rows_no_shadow_table(self):
+        self.assertEqual(db.archive_deleted_rows_for_table(self.context,
+                                                           'no_such_table',
+                                                           10), 0)
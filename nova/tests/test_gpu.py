@@ -18,6 +18,7 @@
 import errno
 import os
 import shutil
+import tempfile
 
 from nova.compute import instance_types
 from nova import context
@@ -27,8 +28,10 @@ from nova import flags
 from nova.openstack.common import importutils
 from nova.openstack.common import log as logging
 from nova import test
+from nova.tests import fake_utils
 from nova import utils
 from nova.virt.gpu import driver as gpulibvirt_driver
+from nova.virt.gpu import topology as gpu_topology
 from nova.virt.gpu import utils as gpu_utils
 
 from nova.virt.libvirt import driver as libvirt_driver
@@ -38,6 +41,7 @@ try:
 except ImportError:
     import nova.tests.fakelibvirt as libvirt
 libvirt_driver.libvirt = libvirt
+gpulibvirt_driver.libvirt = libvirt
 
 
 FLAGS = flags.FLAGS
@@ -61,6 +65,11 @@ class GPULibvirtDriverTestCase(test.TestCase):
 
         self.flags(**COMMON_FLAGS)
         self.flags(fake_call=True)
+        self.journal_dir = tempfile.mkdtemp()
+        self.flags(gpu_allocation_file=os.path.join(self.journal_dir,
+                                                    'gpu_allocations.json'),
+                   gpu_pci_sysfs_path=os.path.join(self.journal_dir, 'pci'))
+        fake_utils.stub_out_utils_execute(self.stubs)
         self.user_id = 'fake'
         self.project_id = 'fake'
         self.context = context.get_admin_context()
@@ -80,6 +89,7 @@ class GPULibvirtDriverTestCase(test.TestCase):
                   context.get_admin_context(), flavor_id,extra_specs)
 
     def tearDown(self):
+        shutil.rmtree(self.journal_dir)
         super(GPULibvirtDriverTestCase, self).tearDown()
        
     inst_meta = {'gpus': 1} 
@@ -131,3 +141,226 @@ class GPULibvirtDriverTestCase(test.TestCase):
         shutil.rmtree(self.root_fs)
         assert false, "Cannot detect over-allocation"
 
+    def testAssignGPUFailureReleasesGPUs(self):
+        def fake_execute(*cmd, **kwargs):
+            if cmd[0] == 'tee':
+                raise exception.ProcessExecutionError()
+
+        self.stubs.Set(utils, 'execute', fake_execute)
+        self.assertRaises(exception.ProcessExecutionError,
+                          gpu_utils.assign_gpus, self.context,
+                          self.test_instance, self.root_fs)
+        self.assertEquals(1, gpu_utils.get_gpu_total())
+        self.assertEquals([], gpu_utils.gpu_allocations.get_assigned('fake'))
+
+    def testAllowDevicesBatched(self):
+        calls = []
+
+        def fake_execute(*cmd, **kwargs):
+            calls.append((cmd, kwargs['process_input']))
+
+        self.stubs.Set(utils, 'execute', fake_execute)
+        gpu_utils.allow_gpus(self.test_instance, [0])
+        self.assertEquals(1, len(calls))
+        cmd, data = calls[0]
+        self.assertEquals(('dd', 'of=/test/cgroup/fake/devices.allow',
+                           'ibs=28', 'obs=14'), cmd)
+        self.assertEquals('c 195:255 rwm\nc 195:0 rwm\n\n\n', data)
+
+    def testAllocationSurvivesRestart(self):
+        gpu_utils.assign_gpus(self.context, self.test_instance,
+                              self.root_fs)
+        self.assertEquals(0, gpu_utils.get_gpu_total())
+
+        # a restarted nova-compute reads the journal back
+        gpu_utils.init_host_gpu()
+        self.assertEquals(0, gpu_utils.get_gpu_total())
+        self.assertEquals([0], gpu_utils.gpu_allocations.get_assigned('fake'))
+
+        gpu_utils.deassign_gpus(self.test_instance)
+        gpu_utils.init_host_gpu()
+        self.assertEquals(1, gpu_utils.get_gpu_total())
+
+    def testRebuildFromRunningInstances(self):
+        gpu_utils.assign_gpus(self.context, self.test_instance,
+                              self.root_fs)
+
+        # the instance is gone, another one found holding gpu 0
+        gpu_utils.init_host_gpu({'other': [0]})
+        self.assertEquals(0, gpu_utils.get_gpu_total())
+        self.assertEquals([], gpu_utils.gpu_allocations.get_assigned('fake'))
+        self.assertEquals([0],
+                          gpu_utils.gpu_allocations.get_assigned('other'))
+
+        gpu_utils.init_host_gpu({})
+        self.assertEquals(1, gpu_utils.get_gpu_total())
+
+    def testSharedGPUSlots(self):
+        table = gpu_utils.GPUAllocationTable(FLAGS.gpu_allocation_file,
+                                             range(2), slots_per_device=4)
+        self.assertEquals(8, table.free_slots())
+        dev = table.allocate_slots('a', 1)
+        self.assertEquals(dev, table.allocate_slots('b', 3))
+        self.assertEquals(1, table.free_count())
+        self.assertEquals(4, table.free_slots())
+        # packed best fit: a full device is left for whole allocations
+        other = table.allocate_slots('c', 2)
+        self.assertNotEquals(dev, other)
+        self.assertEquals(other, table.allocate_slots('d', 1))
+        self.assertRaises(exception.InsufficientFreeGPUs,
+                          table.allocate, 'e', 1)
+        self.assertRaises(exception.InsufficientFreeGPUs,
+                          table.allocate_slots, 'e', 5)
+
+        table.release('c')
+        table.release('d')
+        self.assertEquals(1, table.free_count())
+        self.assertEquals(4, table.free_slots())
+
+    def testSharedGPUSlotsJournal(self):
+        table = gpu_utils.GPUAllocationTable(FLAGS.gpu_allocation_file,
+                                             range(1), slots_per_device=4)
+        table.allocate_slots('a', 1)
+        table.allocate_slots('b', 2)
+
+        table = gpu_utils.GPUAllocationTable(FLAGS.gpu_allocation_file,
+                                             range(1), slots_per_device=4)
+        table.load()
+        self.assertEquals(1, table.free_slots())
+        self.assertEquals([0], table.get_assigned('b'))
+        table.rebuild({'b': [0]})
+        self.assertEquals(2, table.free_slots())
+
+    def testRebuildSharedGPUSlots(self):
+        table = gpu_utils.GPUAllocationTable(FLAGS.gpu_allocation_file,
+                                             range(2), slots_per_device=4)
+        dev = table.allocate_slots('a', 1)
+        other = [1 - dev[0]]
+
+        # b and c share the gpu of a, but are missing from the journal
+        table = gpu_utils.GPUAllocationTable(FLAGS.gpu_allocation_file,
+                                             range(2), slots_per_device=4)
+        table.load()
+        table.rebuild({'a': dev, 'b': dev, 'c': dev, 'd': other},
+                      {'b': 2})
+        self.assertEquals(dev, table.get_assigned('b'))
+        self.assertEquals(dev, table.get_assigned('c'))
+        self.assertEquals(other, table.get_assigned('d'))
+        self.assertEquals(0, table.free_slots())
+        self.assertEquals(0, table.free_count())
+
+        table.release('c')
+        table.release('a')
+        self.assertEquals(2, table.free_slots())
+        table.release('b')
+        self.assertEquals(1, table.free_count())
+
+    def testRebuildWholeGPUHeldBySharers(self):
+        table = gpu_utils.GPUAllocationTable(FLAGS.gpu_allocation_file,
+                                             range(2), slots_per_device=4)
+        dev = table.allocate_slots('a', 1)
+        other = [1 - dev[0]]
+        table.rebuild({'a': dev, 'b': [0, 1]})
+        self.assertEquals(other, table.get_assigned('b'))
+        self.assertEquals(dev, table.get_assigned('a'))
+        self.assertEquals(3, table.free_slots())
+
+    def testAssignGPUSlots(self):
+        self.flags(gpu_slots_per_device=4)
+        gpu_utils.init_host_gpu()
+        inst = dict(self.test_instance, metadata={'gpu_slots': 1})
+        calls = []
+
+        def fake_execute(*cmd, **kwargs):
+            calls.append((cmd, kwargs['process_input']))
+
+        self.stubs.Set(utils, 'execute', fake_execute)
+        gpu_utils.assign_gpus(self.context, inst, self.root_fs)
+        self.assertEquals(0, gpu_utils.get_gpu_total())
+        self.assertEquals(3, gpu_utils.update_status({})['gpu_slots'])
+        self.assertEquals((('tee', self.root_fs + '/etc/environment'),
+                           'CUDA_DEVICE_ORDER=PCI_BUS_ID\n'
+                           'CUDA_VISIBLE_DEVICES=0\nNOVA_GPU_SLOTS=1\n'),
+                          calls[-1])
+        self.assertEquals(4, gpu_utils.get_gpu_slots_count())
+        gpu_utils.deassign_gpus(inst)
+        self.assertEquals(1, gpu_utils.get_gpu_total())
+
+    def testGetVisibleGPUs(self):
+        os.makedirs(os.path.join(self.journal_dir, 'etc'))
+        with open(os.path.join(self.journal_dir, 'etc', 'environment'),
+                  'w') as f:
+            f.write('PATH=/bin\nCUDA_DEVICE_ORDER=PCI_BUS_ID\n'
+                    'CUDA_VISIBLE_DEVICES=2, 0\n'
+                    'NOVA_GPU_SLOTS=3\n')
+        self.assertEquals([2, 0],
+                          gpu_utils.get_visible_gpus(self.journal_dir))
+        self.assertEquals(3, gpu_utils.get_gpu_slots(self.journal_dir))
+        self.assertEquals([], gpu_utils.get_visible_gpus(self.root_fs))
+        self.assertEquals(0, gpu_utils.get_gpu_slots(self.root_fs))
+
+
+class GPUTopologyTestCase(test.TestCase):
+    """Test for nova.virt.gpu.topology."""
+
+    # two gpus behind a switch on each socket
+    gpus = [('0000:05:00.0', 'pci0000:00/0000:00:03.0/0000:04:08.0', 0),
+            ('0000:06:00.0', 'pci0000:00/0000:00:03.0/0000:04:10.0', 0),
+            ('0000:85:00.0', 'pci0000:80/0000:80:03.0/0000:84:08.0', 1),
+            ('0000:86:00.0', 'pci0000:80/0000:80:03.0/0000:84:10.0', 1)]
+
+    def setUp(self):
+        super(GPUTopologyTestCase, self).setUp()
+        self.sysfs = tempfile.mkdtemp()
+        pci_path = os.path.join(self.sysfs, 'bus', 'pci', 'devices')
+        node_path = os.path.join(self.sysfs, 'node')
+        os.makedirs(pci_path)
+        for address, bridges, node in self.gpus:
+            for function, pci_class in (('0', '0x030200'), ('1', '0x040300')):
+                address = address[:-1] + function
+                dev_path = os.path.join(self.sysfs, 'devices', bridges,
+                                        address)
+                os.makedirs(dev_path)
+                for name, value in (('vendor', '0x10de'),
+                                    ('class', pci_class),
+                                    ('numa_node', str(node))):
+                    with open(os.path.join(dev_path, name), 'w') as f:
+                        f.write(value + '\n')
+                os.symlink(dev_path, os.path.join(pci_path, address))
+        for node, cpus in ((0, '0-7'), (1, '8-15')):
+            os.makedirs(os.path.join(node_path, 'node%d' % node))
+            with open(os.path.join(node_path, 'node%d' % node,
+                                   'cpulist'), 'w') as f:
+                f.write(cpus + '\n')
+        self.flags(gpu_pci_sysfs_path=pci_path,
+                   gpu_node_sysfs_path=node_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.sysfs)
+        super(GPUTopologyTestCase, self).tearDown()
+
+    def test_from_sysfs(self):
+        topo = gpu_topology.GPUTopology.from_sysfs(4)
+        self.assertEquals(4, len(topo.devices))
+        self.assertEquals('0000:85:00.0', topo.devices[2].address)
+        self.assertEquals({0: '0-7', 1: '8-15'}, topo.node_cpus)
+        self.assertEquals(gpu_topology.SAME_SWITCH, topo.distance(0, 1))
+        self.assertEquals(gpu_topology.CROSS_NUMA_NODE, topo.distance(1, 2))
+
+    def test_from_sysfs_missing_gpus(self):
+        self.assertEquals(None, gpu_topology.GPUTopology.from_sysfs(8))
+
+    def test_select_same_node(self):
+        topo = gpu_topology.GPUTopology.from_sysfs(4)
+        self.assertEquals([2, 3], sorted(topo.select([0, 2, 3], 2)))
+        self.assertEquals([0, 1], sorted(topo.select([0, 1, 3], 2)))
+        self.assertEquals(1, topo.get_numa_node([2, 3]))
+        self.assertEquals(None, topo.get_numa_node([1, 2]))
+
+    def test_allocate_with_topology(self):
+        topo = gpu_topology.GPUTopology.from_sysfs(4)
+        table = gpu_utils.GPUAllocationTable(
+            os.path.join(self.sysfs, 'gpu_allocations.json'), range(4), topo)
+        self.assertEquals([3], table.allocate('a', 1))
+        self.assertEquals([0, 1], sorted(table.allocate('b', 2)))
+        self.assertEquals(1, table.free_count())
@@ -47,6 +47,7 @@ import nova.tests.image.fake
 from nova import utils
 from nova.virt.disk import api as disk
 from nova.virt import driver
+from nova.virt import event as virtevent
 from nova.virt import firewall as base_firewall
 from nova.virt import images
 from nova.virt.libvirt import config
@@ -992,6 +993,60 @@ class LibvirtConnTestCase(test.TestCase):
         # None should be listed, since we fake deleted the last one
         self.assertEquals(len(instances), 0)
 
+    def test_lifecycle_events(self):
+        class FakeDomain(object):
+            def UUIDString(self):
+                return 'fake-uuid'
+
+        conn = libvirt_driver.LibvirtDriver(False)
+        events = []
+        conn.register_event_listener(events.append)
+        conn._init_events_pipe()
+
+        # called by libvirt in the native thread:
+        conn._event_lifecycle_callback(None, FakeDomain(),
+                libvirt_driver.VIR_DOMAIN_EVENT_STOPPED, 0, conn)
+        conn._event_lifecycle_callback(None, FakeDomain(), 0, 0, conn)
+        conn._event_lifecycle_callback(None, FakeDomain(),
+                libvirt_driver.VIR_DOMAIN_EVENT_STARTED, 0, conn)
+
+        conn._dispatch_events()
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0].uuid, 'fake-uuid')
+        self.assertEqual(events[0].transition,
+                         virtevent.EVENT_LIFECYCLE_STOPPED)
+        self.assertEqual(events[0].power_state, power_state.SHUTDOWN)
+        self.assertEqual(events[1].power_state, power_state.RUNNING)
+
+    def test_get_info_all(self):
+        self.mox.StubOutWithMock(libvirt_driver.LibvirtDriver, '_conn')
+        libvirt_driver.LibvirtDriver._conn.listAllDomains(0).AndReturn(
+                [FakeVirtDomain(), FakeVirtDomain()])
+
+        self.mox.ReplayAll()
+        conn = libvirt_driver.LibvirtDriver(False)
+        infos = conn.get_info_all()
+        self.assertEquals(len(infos), 2)
+        for info in infos.values():
+            self.assertEquals(info['state'], power_state.RUNNING)
+
+    def test_get_info_all_without_list_all_domains(self):
+        self.mox.StubOutWithMock(libvirt_driver.LibvirtDriver, '_conn')
+        libvirt_driver.LibvirtDriver._conn.listAllDomains(0).AndRaise(
+                libvirt.libvirtError("not supported"))
+        libvirt_driver.LibvirtDriver._conn.lookupByID = self.fake_lookup
+        libvirt_driver.LibvirtDriver._conn.numOfDomains = lambda: 2
+        libvirt_driver.LibvirtDriver._conn.listDomainsID = lambda: [0, 1]
+        libvirt_driver.LibvirtDriver._conn.listDefinedDomains = (
+                lambda: ['stopped'])
+        libvirt_driver.LibvirtDriver._conn.lookupByName = self.fake_lookup
+
+        self.mox.ReplayAll()
+        conn = libvirt_driver.LibvirtDriver(False)
+        infos = conn.get_info_all()
+        # the running domain besides ID 0 and the defined one
+        self.assertEquals(len(infos), 2)
+
     def test_get_all_block_devices(self):
         xml = [
             # NOTE(vish): id 0 is skipped
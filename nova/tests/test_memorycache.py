@@ -0,0 +1,112 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 University of Southern California
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from nova.common import memorycache
+from nova.openstack.common import timeutils
+from nova import test
+
+
+class MemorycacheTestCase(test.TestCase):
+    def setUp(self):
+        super(MemorycacheTestCase, self).setUp()
+        self.client = memorycache.Client()
+        timeutils.set_time_override()
+
+    def tearDown(self):
+        timeutils.clear_time_override()
+        super(MemorycacheTestCase, self).tearDown()
+
+    def test_get_set(self):
+        self.assertEqual(self.client.get('foo'), None)
+        self.assertTrue(self.client.set('foo', 'bar'))
+        self.assertEqual(self.client.get('foo'), 'bar')
+        self.assertEqual(self.client.get_stats(),
+                         {'hits': 1, 'misses': 1, 'evictions': 0,
+                          'expirations': 0, 'keys': 1})
+
+    def test_add_incr_delete(self):
+        self.assertTrue(self.client.add('foo', '1'))
+        self.assertFalse(self.client.add('foo', '2'))
+        self.assertEqual(self.client.incr('foo'), 2)
+        self.assertEqual(self.client.incr('foo', 3), 5)
+        self.assertEqual(self.client.get('foo'), '5')
+        self.assertEqual(self.client.incr('bar'), None)
+        self.assertTrue(self.client.delete('foo'))
+        self.assertFalse(self.client.delete('foo'))
+        self.assertEqual(self.client.get('foo'), None)
+
+    def test_expire_on_get(self):
+        self.client.set('foo', 'bar', time=10)
+        timeutils.advance_time_seconds(9)
+        self.assertEqual(self.client.get('foo'), 'bar')
+        timeutils.advance_time_seconds(1)
+        self.assertEqual(self.client.get('foo'), None)
+        self.assertEqual(self.client.get_stats()['expirations'], 1)
+
+    def test_expire_on_set(self):
+        self.client.set('foo', 'bar', time=10)
+        self.client.set('baz', 'qux', time=20)
+        self.client.set('forever', 'value')
+        timeutils.advance_time_seconds(10)
+        self.client.set('other', 'value')
+        self.assertEqual(sorted(self.client.cache.keys()),
+                         ['baz', 'forever', 'other'])
+
+    def test_set_again_keeps_new_timeout(self):
+        self.client.set('foo', 'bar', time=10)
+        timeutils.advance_time_seconds(5)
+        self.client.set('foo', 'baz', time=10)
+        timeutils.advance_time_seconds(5)
+        self.client.set('other', 'value')
+        self.assertEqual(self.client.get('foo'), 'baz')
+
+    def test_incr_keeps_timeout(self):
+        self.client.set('foo', '1', time=10)
+        self.client.incr('foo')
+        timeutils.advance_time_seconds(10)
+        self.assertEqual(self.client.get('foo'), None)
+
+    def test_least_recently_used_evicted(self):
+        self.flags(memorycache_max_keys=2)
+        self.client.set('a', 1)
+        self.client.set('b', 2)
+        self.client.get('a')
+        self.client.set('c', 3)
+        self.assertEqual(self.client.get('b'), None)
+        self.assertEqual(self.client.get('a'), 1)
+        self.assertEqual(self.client.get('c'), 3)
+        self.assertEqual(self.client.get_stats()['evictions'], 1)
+
+    def test_deleted_key_not_evicted(self):
+        self.flags(memorycache_max_keys=2)
+        self.client.set('a', 1)
+        self.client.set('b', 2)
+        self.assertTrue(self.client.delete('a'))
+        self.assertFalse(self.client.delete('a'))
+        self.client.set('c', 3)
+        self.client.set('d', 4)
+        self.assertEqual(sorted(self.client.cache.keys()), ['c', 'd'])
+        self.assertEqual(self.client.get_stats()['evictions'], 1)
+
+    def test_timeouts_rebuilt(self):
+        for i in range(100):
+            self.client.set('foo', i, time=10)
+        self.assertTrue(len(self.client.timeouts) <= 66)
+        timeutils.advance_time_seconds(10)
+        self.client.set('other', 'value')
+        self.assertEqual(self.client.get('foo'), None)
+        self.assertEqual(self.client.timeouts, [])
@@ -331,6 +331,16 @@ class FakeDriver(object):
     def expire(self, context):
         self.called.append(('expire', context))
 
+    def refresh(self, context, resources):
+        self.called.append(('refresh', context, resources))
+
+    def invalidate(self, context, project_id=None, quota_class=None):
+        self.called.append(('invalidate', context, project_id, quota_class))
+
+    def get_cache_stats(self, context):
+        self.called.append(('get_cache_stats', context))
+        return dict(hits=1, misses=2, size=1)
+
 
 class BaseResourceTestCase(test.TestCase):
     def test_no_flag(self):
@@ -705,6 +715,31 @@ class QuotaEngineTestCase(test.TestCase):
                 ('expire', context),
                 ])
 
+    def test_refresh(self):
+        context = FakeContext(None, None)
+        driver = FakeDriver()
+        quota_obj = self._make_quota_obj(driver)
+        quota_obj.refresh(context)
+
+        self.assertEqual(driver.called, [
+                ('refresh', context, quota_obj._resources),
+                ])
+
+    def test_invalidate(self):
+        context = FakeContext(None, None)
+        driver = FakeDriver()
+        quota_obj = self._make_quota_obj(driver)
+        quota_obj.invalidate(context, project_id='test_project')
+        quota_obj.invalidate(context, quota_class='test_class')
+        result = quota_obj.get_cache_stats(context)
+
+        self.assertEqual(driver.called, [
+                ('invalidate', context, 'test_project', None),
+                ('invalidate', context, None, 'test_class'),
+                ('get_cache_stats', context),
+                ])
+        self.assertEqual(result, dict(hits=1, misses=2, size=1))
+
     def test_resources(self):
         quota_obj = self._make_quota_obj(None)
 
@@ -925,6 +960,62 @@ class DbQuotaDriverTestCase(test.TestCase):
                     ),
                 ))
 
+    def test_get_project_quotas_cached(self):
+        self._stub_get_by_project()
+        context = FakeContext('test_project', 'test_class')
+        for i in range(2):
+            self.driver.get_project_quotas(context, quota.QUOTAS._resources,
+                                           'test_project', usages=False)
+
+        self.assertEqual(self.calls, [
+                'quota_get_all_by_project',
+                'quota_class_get_all_by_name',
+                ])
+        self.assertEqual(self.driver.get_cache_stats(context),
+                         dict(hits=2, misses=2, size=2))
+
+        # the limits are read again once invalidated or expired
+        self.driver.invalidate(context, project_id='test_project')
+        self.driver.get_project_quotas(context, quota.QUOTAS._resources,
+                                       'test_project', usages=False)
+        self.assertEqual(self.calls[2:], ['quota_get_all_by_project'])
+
+        timeutils.advance_time_seconds(60)
+        self.driver.get_project_quotas(context, quota.QUOTAS._resources,
+                                       'test_project', usages=False)
+        self.assertEqual(self.calls[3:], [
+                'quota_get_all_by_project',
+                'quota_class_get_all_by_name',
+                ])
+
+    def test_get_project_quotas_not_cached(self):
+        self._stub_get_by_project()
+        self.flags(quota_cache_ttl=0)
+        context = FakeContext('test_project', 'test_class')
+        for i in range(2):
+            self.driver.get_project_quotas(context, quota.QUOTAS._resources,
+                                           'test_project', usages=False)
+
+        self.assertEqual(self.calls, [
+                'quota_get_all_by_project',
+                'quota_class_get_all_by_name',
+                ] * 2)
+
+        # limits of other projects and classes are not cached, for the
+        # database to check the context may read them
+        self.flags(quota_cache_ttl=60)
+        context = FakeContext('other_project', 'other_class')
+        for i in range(2):
+            self.driver.get_project_quotas(context, quota.QUOTAS._resources,
+                                           'test_project', 'test_class',
+                                           usages=False)
+        self.assertEqual(self.calls[4:], [
+                'quota_get_all_by_project',
+                'quota_class_get_all_by_name',
+                ] * 2)
+        self.assertEqual(self.driver.get_cache_stats(context),
+                         dict(hits=0, misses=4, size=0))
+
     def test_get_project_quotas_alt_context_no_class(self):
         self._stub_get_by_project()
         result = self.driver.get_project_quotas(
@@ -1385,6 +1476,62 @@ class DbQuotaDriverTestCase(test.TestCase):
                 ])
         self.assertEqual(result, ['resv-1', 'resv-2', 'resv-3'])
 
+    def test_reserve_by_update(self):
+        def fake_quota_reserve_by_update(context, resources, quotas, deltas,
+                                         expire, until_refresh):
+            self.calls.append(('quota_reserve_by_update', expire,
+                               until_refresh))
+            return ['resv-1']
+        self.stubs.Set(db, 'quota_reserve_by_update',
+                       fake_quota_reserve_by_update)
+        self._stub_get_project_quotas()
+        self._stub_quota_reserve()
+        self.flags(quota_reserve_by_update=True, until_refresh=500)
+        expire = timeutils.utcnow() + datetime.timedelta(seconds=120)
+        result = self.driver.reserve(FakeContext('test_project', 'test_class'),
+                                     quota.QUOTAS._resources,
+                                     dict(instances=2), expire=expire)
+
+        self.assertEqual(self.calls, [
+                'get_project_quotas',
+                ('quota_reserve_by_update', expire, 500),
+                ])
+        self.assertEqual(result, ['resv-1'])
+
+    def _stub_quota_usage_refresh(self):
+        def fake_get_stale_projects(context, max_age):
+            self.calls.append(('quota_usage_get_stale_projects', max_age))
+            return ['project1', 'project2']
+
+        def fake_quota_usage_refresh(context, resources, project_id,
+                                     until_refresh):
+            self.calls.append(('quota_usage_refresh', project_id,
+                               until_refresh))
+
+        self.stubs.Set(db, 'quota_usage_get_stale_projects',
+                       fake_get_stale_projects)
+        self.stubs.Set(db, 'quota_usage_refresh', fake_quota_usage_refresh)
+
+    def test_refresh(self):
+        self._stub_quota_usage_refresh()
+        self.flags(quota_reserve_by_update=True, until_refresh=5,
+                   max_age=3600)
+        self.driver.refresh(FakeContext('test_project', 'test_class'),
+                            quota.QUOTAS._resources)
+
+        self.assertEqual(self.calls, [
+                ('quota_usage_get_stale_projects', 3600),
+                ('quota_usage_refresh', 'project1', 5),
+                ('quota_usage_refresh', 'project2', 5),
+                ])
+
+    def test_refresh_on_reserve(self):
+        self._stub_quota_usage_refresh()
+        self.driver.refresh(FakeContext('test_project', 'test_class'),
+                            quota.QUOTAS._resources)
+
+        self.assertEqual(self.calls, [])
+
 
 class FakeSession(object):
     def begin(self):
@@ -1940,3 +2087,104 @@ class QuotaReserveSqlAlchemyTestCase(test.TestCase):
                      project_id='test_project',
                      delta=-2 * 1024),
                 ])
+
+
+class QuotaReserveByUpdateTestCase(test.TestCase):
+    """Test case for the conditional update reservations, against the
+    database."""
+
+    def setUp(self):
+        super(QuotaReserveByUpdateTestCase, self).setUp()
+        self.context = context.RequestContext('fake_user', 'fake_project')
+        self.admin_context = context.get_admin_context()
+
+        self.in_use = dict(instances=1, cores=2)
+        self.sync_called = []
+
+        def sync(context, project_id, session):
+            self.sync_called.append(project_id)
+            return self.in_use.copy()
+
+        self.resources = dict(
+                instances=quota.ReservableResource('instances', sync),
+                cores=quota.ReservableResource('cores', sync))
+        self.quotas = dict(instances=5, cores=10)
+        self.expire = timeutils.utcnow() + datetime.timedelta(seconds=3600)
+
+    def _reserve(self, **deltas):
+        return db.quota_reserve_by_update(self.context, self.resources,
+                                          self.quotas, deltas, self.expire,
+                                          0)
+
+    def _usages(self):
+        usages = db.quota_usage_get_all_by_project(self.context,
+                                                   'fake_project')
+        del usages['project_id']
+        return usages
+
+    def test_reserve(self):
+        reservations = self._reserve(instances=2, cores=4)
+        self.assertEqual(len(reservations), 2)
+        # the usages are synced once, when they are created
+        self.assertEqual(self.sync_called, ['fake_project'])
+        self.assertEqual(self._usages(),
+                         dict(instances=dict(in_use=1, reserved=2),
+                              cores=dict(in_use=2, reserved=4)))
+
+        self._reserve(instances=2, cores=4)
+        self.assertEqual(self.sync_called, ['fake_project'])
+        self.assertEqual(self._usages(),
+                         dict(instances=dict(in_use=1, reserved=4),
+                              cores=dict(in_use=2, reserved=8)))
+
+        db.reservation_commit(self.context, reservations)
+        self.assertEqual(self._usages(),
+                         dict(instances=dict(in_use=3, reserved=2),
+                              cores=dict(in_use=6, reserved=4)))
+
+    def test_reserve_over_quota(self):
+        self._reserve(instances=2, cores=4)
+        self.assertRaises(exception.OverQuota, self._reserve,
+                          instances=1, cores=5)
+        # the instances reserved before cores went over quota are
+        # rolled back
+        self.assertEqual(self._usages(),
+                         dict(instances=dict(in_use=1, reserved=2),
+                              cores=dict(in_use=2, reserved=4)))
+
+    def test_reserve_unlimited(self):
+        self.quotas['cores'] = -1
+        self._reserve(instances=1, cores=100)
+        self.assertEqual(self._usages()['cores'],
+                         dict(in_use=2, reserved=100))
+
+    def test_reserve_reduction(self):
+        reservations = self._reserve(instances=-1, cores=-2)
+        self.assertEqual(self._usages(),
+                         dict(instances=dict(in_use=1, reserved=0),
+                              cores=dict(in_use=2, reserved=0)))
+        db.reservation_commit(self.context, reservations)
+        self.assertEqual(self._usages(),
+                         dict(instances=dict(in_use=0, reserved=0),
+                              cores=dict(in_use=0, reserved=0)))
+
+    def test_refresh(self):
+        db.quota_reserve_by_update(self.context, self.resources,
+                                   self.quotas, dict(instances=1), self.expire,
+                                   2)
+        self.assertEqual(db.quota_usage_get_stale_projects(
+                self.admin_context, 0), [])
+
+        # until_refresh counts down with each reservation
+        self._reserve(instances=1)
+        self.assertEqual(db.quota_usage_get_stale_projects(
+                self.admin_context, 0), ['fake_project'])
+
+        self.in_use = dict(instances=3, cores=6)
+        db.quota_usage_refresh(self.admin_context, self.resources,
+                               'fake_project', 2)
+        self.assertEqual(self._usages(),
+                         dict(instances=dict(in_use=3, reserved=2),
+                              cores=dict(in_use=6, reserved=0)))
+        self.assertEqual(db.quota_usage_get_stale_projects(
+                self.admin_context, 0), [])
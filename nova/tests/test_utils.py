@@ -579,6 +579,36 @@ class TestFileLocks(test.TestCase):
         self.assertTrue(self.completed)
 
 
+class ConcurrencyLimitTestCase(test.TestCase):
+    def _run(self, limit):
+        self.running = 0
+        self.most_running = 0
+
+        def stage(wait):
+            with utils.concurrency_limit('test_stage', limit):
+                self.running += 1
+                self.most_running = max(self.most_running, self.running)
+                wait.wait()
+                self.running -= 1
+
+        waits = [eventlet.event.Event() for i in xrange(5)]
+        pool = greenpool.GreenPool()
+        for wait in waits:
+            pool.spawn_n(stage, wait)
+        eventlet.sleep(0)
+        for wait in waits:
+            wait.send()
+            eventlet.sleep(0)
+        pool.waitall()
+        return self.most_running
+
+    def test_limit(self):
+        self.assertEqual(self._run(2), 2)
+
+    def test_no_limit(self):
+        self.assertEqual(self._run(0), 5)
+
+
 class AuditPeriodTest(test.TestCase):
 
     def setUp(self):
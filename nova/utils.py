@@ -667,6 +667,7 @@ else:
     InterProcessLock = _PosixLock
 
 _semaphores = weakref.WeakValueDictionary()
+_stage_semaphores = {}
 
 
 def synchronized(name, external=False, lock_path=None):
@@ -764,6 +765,27 @@ def synchronized(name, external=False, lock_path=None):
     return wrap
 
 
+@contextlib.contextmanager
+def concurrency_limit(name, limit):
+    """Let at most limit greenthreads run the with block for name at once.
+
+    Unlike synchronized(), more than one thread can be inside the block,
+    which is what the stages of building an instance want: the builds on
+    a host overlap, without all of them downloading images or writing
+    disks at the same time.  A limit of 0 or None does not limit anything.
+    """
+    if not limit:
+        yield
+        return
+
+    key = (name, limit)
+    sem = _stage_semaphores.get(key)
+    if sem is None:
+        sem = _stage_semaphores[key] = semaphore.Semaphore(limit)
+    with sem:
+        yield
+
+
 def delete_if_exists(pathname):
     """delete a file, but ignore file not found error"""
 
@@ -258,9 +258,19 @@ class BareMetalDom(object):
         """
         domain = self.find_domain(instance_name)
         if domain != []:
-            return [domain['status'], domain['memory_kb'],
-                    domain['memory_kb'],
-                    domain['vcpus'],
-                    100]
+            return self._domain_info(domain)
         else:
             return [power_state.NOSTATE, '', '', '', '']
+
+    def get_all_domain_info(self):
+        """
+        Returns the informaiton of all the domains, by instance name.
+        """
+        return dict((domain['name'], self._domain_info(domain))
+                    for domain in self.domains)
+
+    def _domain_info(self, domain):
+        return [domain['status'], domain['memory_kb'],
+                domain['memory_kb'],
+                domain['vcpus'],
+                100]
@@ -524,6 +524,16 @@ class BareMetalDriver(driver.ComputeDriver):
 
         """
         _domain_info = self._conn.get_domain_info(instance['name'])
+        return self._info_dict(_domain_info)
+
+    def get_info_all(self):
+        """Retrieve information from baremetal for all the domains."""
+        infos = self._conn.get_all_domain_info()
+        return dict((name, self._info_dict(info))
+                    for name, info in infos.iteritems())
+
+    @staticmethod
+    def _info_dict(_domain_info):
         state, max_mem, mem, num_cpu, cpu_time = _domain_info
         return {'state': state,
                 'max_mem': max_mem,
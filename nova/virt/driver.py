@@ -108,6 +108,16 @@ class ComputeDriver(object):
         # TODO(Vek): Need to pass context in for access to auth_token
         raise NotImplementedError()
 
+    def get_info_all(self):
+        """Get the current status of all the instances of the hypervisor
+        at once.
+
+        Returns a dict of instance name to the dict get_info() returns.
+        Drivers that can only look instances up one at a time leave this
+        unimplemented.
+        """
+        raise NotImplementedError()
+
     def get_num_instances(self):
         """Return the total number of virtual machines.
 
@@ -679,3 +689,25 @@ class ComputeDriver(object):
             }
         """
         raise NotImplementedError()
+
+    def register_event_listener(self, callback):
+        """Register a callback to receive the events of the hypervisor,
+        see nova.virt.event.
+
+        Returns whether the driver emits instance lifecycle events.  When
+        it does not, power state changes are only seen by polling.
+        """
+        self._compute_event_callback = callback
+        return False
+
+    def emit_event(self, event):
+        """Hand an event to the registered callback, if any."""
+        callback = getattr(self, '_compute_event_callback', None)
+        if not callback:
+            LOG.debug(_("Discarding event %s"), str(event))
+            return
+        try:
+            LOG.debug(_("Emitting event %s"), str(event))
+            callback(event)
+        except Exception:
+            LOG.exception(_("Exception dispatching event %s"), str(event))
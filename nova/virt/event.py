@@ -0,0 +1,74 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 University of Southern California
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Events a virt driver reports to the compute manager as they happen on the
+hypervisor, instead of the manager having to poll for them.
+"""
+
+from nova.compute import power_state
+
+EVENT_LIFECYCLE_STARTED = 0
+EVENT_LIFECYCLE_STOPPED = 1
+EVENT_LIFECYCLE_PAUSED = 2
+EVENT_LIFECYCLE_RESUMED = 3
+
+# power state an instance is in after a lifecycle transition
+LIFECYCLE_POWER_STATE = {
+    EVENT_LIFECYCLE_STARTED: power_state.RUNNING,
+    EVENT_LIFECYCLE_STOPPED: power_state.SHUTDOWN,
+    EVENT_LIFECYCLE_PAUSED: power_state.PAUSED,
+    EVENT_LIFECYCLE_RESUMED: power_state.RUNNING,
+}
+
+_NAMES = {
+    EVENT_LIFECYCLE_STARTED: 'Started',
+    EVENT_LIFECYCLE_STOPPED: 'Stopped',
+    EVENT_LIFECYCLE_PAUSED: 'Paused',
+    EVENT_LIFECYCLE_RESUMED: 'Resumed',
+}
+
+
+class Event(object):
+    """Something that happened on the hypervisor."""
+
+    def __init__(self, timestamp=None):
+        self.timestamp = timestamp
+
+
+class InstanceEvent(Event):
+    """Something that happened to an instance, given by its uuid."""
+
+    def __init__(self, uuid, timestamp=None):
+        super(InstanceEvent, self).__init__(timestamp)
+        self.uuid = uuid
+
+
+class LifecycleEvent(InstanceEvent):
+    """An instance started, stopped, paused or resumed."""
+
+    def __init__(self, uuid, transition, timestamp=None):
+        super(LifecycleEvent, self).__init__(uuid, timestamp)
+        self.transition = transition
+
+    @property
+    def power_state(self):
+        return LIFECYCLE_POWER_STATE[self.transition]
+
+    def __str__(self):
+        return "<LifecycleEvent %s: %s>" % (
+                self.uuid, _NAMES.get(self.transition, self.transition))
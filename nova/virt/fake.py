@@ -183,6 +183,14 @@ class FakeDriver(driver.ComputeDriver):
                 'num_cpu': 2,
                 'cpu_time': 0}
 
+    def get_info_all(self):
+        return dict((name, {'state': i.state,
+                            'max_mem': 0,
+                            'mem': 0,
+                            'num_cpu': 2,
+                            'cpu_time': 0})
+                    for name, i in self.instances.iteritems())
+
     def get_diagnostics(self, instance_name):
         return 'FAKE_DIAGNOSTICS'
 
@@ -21,6 +21,7 @@ GPU support under a connection to a hypervisor through libvirt.
 
 import os
 
+from nova.compute import timing
 from nova.compute import vm_states
 from nova import db
 from nova import exception
@@ -38,14 +39,7 @@ libvirt = None
 
 LOG = logging.getLogger(__name__)
 
-gpu_opts = [
-    cfg.StrOpt('user',
-               default='/root',
-               help='home directory of login user')
-]
-
 FLAGS = flags.FLAGS
-FLAGS.register_opts(gpu_opts)
 
 lxc_mounts = {}
 
@@ -60,6 +54,40 @@ class GPULibvirtDriver(driver.LibvirtDriver):
 
         gpu_utils.init_host_gpu()
 
+    def init_host(self, host):
+        super(GPULibvirtDriver, self).init_host(host)
+        gpu_utils.init_host_gpu(*self._get_running_gpus())
+
+    def _get_running_gpus(self):
+        """Map each running container to the gpus it was started with,
+        and those sharing a gpu to the slots they hold of it."""
+        running = {}
+        slots = {}
+        for instance_name in self.list_instances():
+            try:
+                virt_dom = self._lookup_by_name(instance_name)
+            except exception.NotFound:
+                continue
+            lxc_container_root = self.get_lxc_container_root(virt_dom)
+            running[instance_name] = \
+                gpu_utils.get_visible_gpus(lxc_container_root)
+            gpu_slots = gpu_utils.get_gpu_slots(lxc_container_root)
+            if gpu_slots:
+                slots[instance_name] = gpu_slots
+        return running, slots
+
+    def get_available_resource(self):
+        dic = super(GPULibvirtDriver, self).get_available_resource()
+        dic['gpus'] = gpu_utils.get_gpu_count()
+        dic['gpus_used'] = dic['gpus'] - gpu_utils.get_gpu_total()
+        dic['gpu_slots'] = gpu_utils.get_gpu_slots_count()
+        dic['gpu_slots_used'] = (dic['gpu_slots'] -
+                                 gpu_utils.get_gpu_slots_total())
+        for key in ('cpu_arch', 'xpu_arch'):
+            if key in gpu_utils.extra_specs:
+                dic[key] = gpu_utils.extra_specs[key]
+        return dic
+
     @property
     def host_state(self):
         if not self._host_state:
@@ -86,9 +114,10 @@ class GPULibvirtDriver(driver.LibvirtDriver):
                   image_meta, injected_files, admin_password,
                   network_info, block_device_info)
         try:
-            gpu_utils.assign_gpus(context, instance,
-                                  self.get_lxc_container_root(
-                                   self._lookup_by_name(instance['name'])))
+            with timing.span('gpu_assign'):
+                gpu_utils.assign_gpus(context, instance,
+                                      self.get_lxc_container_root(
+                                       self._lookup_by_name(instance['name'])))
         except Exception as Exn:
             LOG.error(_("Error in GPU assignment, overcommitted."))
             self.destroy(instance, network_info, block_device_info)
@@ -265,14 +294,8 @@ class GPULibvirtDriver(driver.LibvirtDriver):
         LOG.info(_('attach_volume: major_num(%(major_num)d) ' \
                    'minor_num(%(minor_num)d)') % locals())
 
-        # allow the device
-        dev_whitelist = os.path.join("/cgroup/devices/libvirt/lxc/",
-                                     instance_name,
-                                     'devices.allow')
         # Allow the disk
-        perm = "b %d:%d rwm" % (major_num, minor_num)
-        utils.execute('tee', dev_whitelist, process_input=perm,
-                      run_as_root=True)
+        gpu_utils.allow_devices(instance_name, [('b', major_num, minor_num)])
 
         utils.execute('lxc-attach', '-n', '%s' % init_pid, '--',
                       '/bin/mknod', '-m', '777', '/%s' % lxc_container_device,
@@ -0,0 +1,174 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2011 University of Southern California
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+"""
+PCIe/NUMA topology of the gpu devices of a host, read from sysfs.
+
+GPUs behind the same PCIe switch or root port can talk peer to peer at
+full speed, GPUs on different sockets cannot.  The topology is used to
+hand out the tightest connected set of free gpus to an instance.
+
+**Related Flags**
+
+:gpu_pci_sysfs_path: where the pci devices are listed in sysfs
+:gpu_node_sysfs_path: where the numa nodes are listed in sysfs
+:gpu_pci_vendor_id: pci vendor id of the gpu devices
+
+"""
+import os
+
+from nova import flags
+from nova.openstack.common import cfg
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+topology_opts = [
+    cfg.StrOpt('gpu_pci_sysfs_path',
+               default='/sys/bus/pci/devices',
+               help='Path of the pci devices in sysfs'),
+    cfg.StrOpt('gpu_node_sysfs_path',
+               default='/sys/devices/system/node',
+               help='Path of the numa nodes in sysfs'),
+    cfg.StrOpt('gpu_pci_vendor_id',
+               default='0x10de',
+               help='PCI vendor id of the GPU devices'),
+    ]
+
+FLAGS = flags.FLAGS
+FLAGS.register_opts(topology_opts)
+
+# Distances between two gpus, smaller is better connected
+SAME_SWITCH = 0
+SAME_HOST_BRIDGE = 1
+SAME_NUMA_NODE = 2
+CROSS_NUMA_NODE = 3
+
+
+def _read_sysfs(*path):
+    try:
+        with open(os.path.join(*path)) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+class GPUDevice(object):
+    """A gpu and where it hangs in the PCIe tree."""
+
+    def __init__(self, index, address, numa_node, bridges):
+        self.index = index
+        self.address = address
+        self.numa_node = numa_node
+        # upstream bridges from the host bridge down to the device
+        self.bridges = bridges
+
+
+class GPUTopology(object):
+    """Locality of the gpus of this host, keyed by gpu index."""
+
+    def __init__(self, devices, node_cpus=None):
+        self.devices = dict((dev.index, dev) for dev in devices)
+        self.node_cpus = node_cpus or {}
+
+    @classmethod
+    def from_sysfs(cls, num_gpus):
+        """Build the topology of the first num_gpus gpus of the host.
+
+        GPU indexes follow the pci address order, as the nvidia driver
+        numbers its devices, and as CUDA numbers them in the containers
+        given CUDA_DEVICE_ORDER=PCI_BUS_ID.  Returns None when sysfs does
+        not show enough gpus, in which case placement ignores locality.
+        """
+        pci_path = FLAGS.gpu_pci_sysfs_path
+        if not os.path.isdir(pci_path):
+            return None
+
+        devices = []
+        for address in sorted(os.listdir(pci_path)):
+            dev_path = os.path.join(pci_path, address)
+            if _read_sysfs(dev_path, 'vendor') != FLAGS.gpu_pci_vendor_id:
+                continue
+            # display controllers only, skip the audio functions
+            if not (_read_sysfs(dev_path, 'class') or '').startswith('0x03'):
+                continue
+            numa_node = int(_read_sysfs(dev_path, 'numa_node') or -1)
+            components = os.path.realpath(dev_path).split(os.sep)
+            roots = [i for i, c in enumerate(components)
+                     if c.startswith('pci')]
+            bridges = components[roots[0]:-1] if roots else []
+            devices.append(GPUDevice(len(devices), address, numa_node,
+                                     bridges))
+            if len(devices) == num_gpus:
+                break
+
+        if len(devices) < num_gpus:
+            LOG.warn(_("Found %(found)d of %(num_gpus)d gpus in sysfs, "
+                       "placing gpus without topology") %
+                     {'found': len(devices), 'num_gpus': num_gpus})
+            return None
+
+        node_cpus = {}
+        for dev in devices:
+            if dev.numa_node >= 0 and dev.numa_node not in node_cpus:
+                node_cpus[dev.numa_node] = _read_sysfs(
+                    FLAGS.gpu_node_sysfs_path,
+                    'node%d' % dev.numa_node, 'cpulist')
+        return cls(devices, node_cpus)
+
+    def distance(self, a, b):
+        a = self.devices[a]
+        b = self.devices[b]
+        if a.numa_node != b.numa_node:
+            return CROSS_NUMA_NODE
+        common = len(os.path.commonprefix([a.bridges, b.bridges]))
+        if common >= 2:
+            # behind the same root port, and maybe the same switch
+            return SAME_SWITCH
+        elif common == 1:
+            return SAME_HOST_BRIDGE
+        return SAME_NUMA_NODE
+
+    def select(self, free, count):
+        """Pick the count free gpus with the smallest total distance.
+
+        Every free gpu is tried as the seed of a set made of the gpus
+        closest to it, which is exact for the tree shaped PCIe layouts
+        and cheap for the handful of gpus a host has.
+        """
+        best = None
+        best_cost = None
+        for seed in free:
+            others = sorted((g for g in free if g != seed),
+                            key=lambda g: self.distance(seed, g))
+            chosen = [seed] + others[:count - 1]
+            cost = sum(self.distance(a, b)
+                       for i, a in enumerate(chosen)
+                       for b in chosen[i + 1:])
+            if best_cost is None or cost < best_cost:
+                best = chosen
+                best_cost = cost
+        return best or []
+
+    def get_numa_node(self, gpus):
+        """Return the numa node all of gpus are on, or None."""
+        nodes = set(self.devices[g].numa_node for g in gpus)
+        if len(nodes) != 1:
+            return None
+        node = nodes.pop()
+        if node < 0:
+            return None
+        return node
@@ -25,6 +25,9 @@ Utility functions
 :dev_cgroups_path:full path of cgroup device of LXC
 :gpu_dev_major_number: major number of gpu device
 :gpu_dev_minor_number: start of the minor numbers of gpu device
+:gpu_allocation_file: journal of the gpu allocations of this host
+:cpuset_cgroups_path: full path of cgroup cpuset of LXC
+:gpu_slots_per_device: number of instances that may share one gpu
 
 """
 import os
@@ -36,12 +39,14 @@ from nova import db
 from nova import exception
 from nova import flags
 from nova.openstack.common import cfg
+from nova.openstack.common import excutils
+from nova.openstack.common import jsonutils
 from nova.openstack.common import log as logging
 from nova import utils
+from nova.virt.gpu import topology
 
-# Variables for tracking gpus available and gpus assigned
-gpus_available = []
-gpus_assigned = {}
+# Allocation table of this host and the gpu count it was built with
+gpu_allocations = None
 num_gpus = None
 extra_specs = {}
 
@@ -63,27 +68,271 @@ gpu_opts = [
     cfg.StrOpt('gpu_dev_minor_number',
                default=0,
                help='Start numer of minor number of GPU devices'),
+    cfg.StrOpt('gpu_allocation_file',
+               default='$state_path/gpu_allocations.json',
+               help='File where the gpu allocations of this host are '
+                    'journaled so they survive a nova-compute restart'),
+    cfg.StrOpt('cpuset_cgroups_path',
+               default='/cgroup/cpuset/libvirt/lxc',
+               help='Path of the LXC cpuset cgroup'),
+    cfg.IntOpt('gpu_slots_per_device',
+               default=1,
+               help='Number of slots each GPU is split into.  Instances '
+                    'asking for gpu_slots are time-sliced on one GPU, '
+                    'up to this many slots per GPU'),
     ]
 
 FLAGS = flags.FLAGS
 FLAGS.register_opts(gpu_opts)
 
 
-def init_host_gpu():
+class GPUAllocationTable(object):
+    """Tracks which gpu devices of this host are held by which instance.
+
+    Allocation and release are O(1) per device.  Every change is written
+    to the journal file before it is returned to the caller, replacing
+    the previous journal with an atomic rename, so a crash never leaves
+    a half written table behind.
+
+    With a topology, allocation picks the best connected free devices
+    instead of the last freed ones.
+
+    With more than one slot per device, instances may also share a
+    device by holding some of its slots.  Shared devices are packed
+    best fit, so whole devices stay free for as long as possible.
+    """
+
+    def __init__(self, path, devices, topology=None, slots_per_device=1):
+        self.path = path
+        self.devices = list(devices)
+        self.topology = topology
+        self.slots_per_device = slots_per_device
+        self._free = list(self.devices)
+        self._owner = {}
+        self._assigned = {}
+        # slots in use on the shared devices, and who holds them
+        self._slots_used = {}
+        self._shared = {}
+
+    def free_count(self):
+        return len(self._free)
+
+    def free_slots(self):
+        partial = sum(self.slots_per_device - used
+                      for used in self._slots_used.itervalues())
+        return len(self._free) * self.slots_per_device + partial
+
+    def get_assigned(self, instance_name):
+        if instance_name in self._shared:
+            return [self._shared[instance_name][0]]
+        return list(self._assigned.get(instance_name, []))
+
+    def allocate(self, instance_name, count):
+        """Hand out count free devices to instance_name."""
+        if count > len(self._free):
+            raise exception.InsufficientFreeGPUs(instance_name=instance_name)
+        if self.topology is not None and count > 1:
+            devices = self.topology.select(self._free, count)
+            for dev in devices:
+                self._free.remove(dev)
+        else:
+            devices = [self._free.pop() for i in xrange(count)]
+        for dev in devices:
+            self._owner[dev] = instance_name
+        self._assigned.setdefault(instance_name, []).extend(devices)
+        self._save()
+        return devices
+
+    def allocate_slots(self, instance_name, slots):
+        """Hand out slots of a single device to instance_name."""
+        if slots > self.slots_per_device:
+            raise exception.InsufficientFreeGPUs(instance_name=instance_name)
+        best = None
+        best_left = None
+        for dev, used in self._slots_used.iteritems():
+            left = self.slots_per_device - used
+            if slots <= left and (best is None or left < best_left):
+                best = dev
+                best_left = left
+        if best is None:
+            if not self._free:
+                raise exception.InsufficientFreeGPUs(
+                        instance_name=instance_name)
+            best = self._free.pop()
+            self._slots_used[best] = 0
+        self._slots_used[best] += slots
+        self._shared[instance_name] = (best, slots)
+        self._save()
+        return [best]
+
+    def release(self, instance_name):
+        """Return every device held by instance_name to the free pool."""
+        devices = self._assigned.pop(instance_name, [])
+        for dev in devices:
+            del self._owner[dev]
+            self._free.append(dev)
+        if instance_name in self._shared:
+            dev, slots = self._shared.pop(instance_name)
+            self._release_slots(dev, slots)
+            devices = [dev]
+        if devices:
+            self._save()
+        return devices
+
+    def _release_slots(self, dev, slots):
+        self._slots_used[dev] -= slots
+        if self._slots_used[dev] <= 0:
+            del self._slots_used[dev]
+            self._free.append(dev)
+
+    def load(self):
+        """Read the journal, dropping devices this host no longer has."""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                journal = jsonutils.loads(f.read())
+            assigned = journal['assigned']
+        except (IOError, ValueError, KeyError) as e:
+            LOG.warn(_("Ignoring unreadable gpu allocation journal "
+                       "%(path)s: %(e)s") % {'path': self.path, 'e': e})
+            return
+        for instance_name, devices in assigned.iteritems():
+            self._claim(instance_name, devices)
+        for instance_name, (dev, slots) in \
+                journal.get('shared', {}).iteritems():
+            self._claim_slots(instance_name, dev, slots)
+
+    def rebuild(self, running, slots=None):
+        """Reconcile the table with the instances that are running.
+
+        :param running: dict of running instance name to the gpus it
+                        was started with, as found in the container
+        :param slots: dict of running instance name to the slots it
+                      holds of a shared gpu, for those that share one
+        """
+        if slots is None:
+            slots = {}
+        for instance_name in self._assigned.keys() + self._shared.keys():
+            if instance_name not in running:
+                LOG.info(_("Releasing gpus of vanished instance %s") %
+                         instance_name)
+                self.release(instance_name)
+        # the shared gpus first, so that holders of whole gpus cannot
+        # take them over
+        missing = [(instance_name, devices)
+                   for instance_name, devices in running.iteritems()
+                   if (instance_name not in self._assigned and
+                       instance_name not in self._shared)]
+        for instance_name, devices in missing:
+            if slots.get(instance_name) and devices:
+                self._claim_slots(instance_name, devices[0],
+                                  slots[instance_name])
+        for instance_name, devices in missing:
+            if slots.get(instance_name) or not devices:
+                continue
+            dev = devices[0]
+            if len(devices) == 1 and dev in self._slots_used:
+                # an older container sharing the gpu, that does not tell
+                # how many slots it holds: keep the rest of them for it
+                self._claim_slots(instance_name, dev,
+                                  self.slots_per_device -
+                                  self._slots_used[dev])
+            else:
+                self._claim(instance_name, devices)
+        self._save()
+
+    def _claim(self, instance_name, devices):
+        for dev in devices:
+            if (dev not in self.devices or dev in self._owner or
+                dev in self._slots_used):
+                LOG.warn(_("Cannot give gpu %(dev)s to %(instance_name)s, "
+                           "it is unknown or already assigned") % locals())
+                continue
+            self._free.remove(dev)
+            self._owner[dev] = instance_name
+            self._assigned.setdefault(instance_name, []).append(dev)
+
+    def _claim_slots(self, instance_name, dev, slots):
+        used = self._slots_used.get(dev, 0)
+        if (dev not in self.devices or dev in self._owner or
+            used + slots > self.slots_per_device):
+            LOG.warn(_("Cannot give %(slots)d slots of gpu %(dev)s to "
+                       "%(instance_name)s, they are unknown or already "
+                       "assigned") % locals())
+            return
+        if dev not in self._slots_used:
+            self._free.remove(dev)
+        self._slots_used[dev] = used + slots
+        self._shared[instance_name] = (dev, slots)
+
+    def _save(self):
+        utils.ensure_tree(os.path.dirname(self.path))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(jsonutils.dumps({'assigned': self._assigned,
+                                     'shared': self._shared}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+
+def _get_environment(lxc_container_root, name):
+    """Return a variable of the environment file of a container."""
+    env_file = os.path.join(lxc_container_root, 'etc', 'environment')
+    if not os.path.exists(env_file):
+        return None
+    with open(env_file) as f:
+        for line in f:
+            key, _sep, value = line.strip().partition('=')
+            if key == name and value:
+                return value
+    return None
+
+
+def get_visible_gpus(lxc_container_root):
+    """Return the gpus a container was given through CUDA_VISIBLE_DEVICES."""
+    value = _get_environment(lxc_container_root, 'CUDA_VISIBLE_DEVICES')
+    if not value:
+        return []
+    return [int(dev) for dev in value.split(',')]
+
+
+def get_gpu_slots(lxc_container_root):
+    """Return the slots of a shared gpu a container was given, 0 if it
+    holds whole gpus."""
+    return int(_get_environment(lxc_container_root, 'NOVA_GPU_SLOTS') or 0)
+
+
+@utils.synchronized('gpu_allocations')
+def init_host_gpu(running=None, slots=None):
+    """Build the allocation table of this host.
+
+    The table is loaded from the journal and, when the gpus of the
+    running instances are given, reconciled against them.
+    """
     get_instance_type_extra_specs_capabilities()
-    global gpus_available
+    global gpu_allocations
     global num_gpus
     global extra_specs
     if 'gpus' in extra_specs:
         num_gpus = extra_specs['gpus']
-        gpus_available = range(int(extra_specs['gpus']))
+        gpu_allocations = GPUAllocationTable(
+            FLAGS.gpu_allocation_file, range(int(num_gpus)),
+            topology.GPUTopology.from_sysfs(int(num_gpus)),
+            FLAGS.gpu_slots_per_device)
+        gpu_allocations.load()
+        if running is not None:
+            gpu_allocations.rebuild(running, slots)
 
 
 def update_status(data):
     global extra_specs
     for key in extra_specs.iterkeys():
         if 'gpus' == key:
-            data['gpus'] = int(len(gpus_available))
+            data['gpus'] = get_gpu_total()
+            if FLAGS.gpu_slots_per_device > 1:
+                data['gpu_slots'] = get_gpu_slots_total()
         else:
             data[key] = extra_specs[key]
     return data
@@ -101,33 +350,94 @@ def get_instance_type_extra_specs_capabilities():
 
 
 def get_gpu_total():
-    return len(gpus_available)
+    if gpu_allocations is None:
+        return 0
+    return gpu_allocations.free_count()
 
-def allow_gpus(inst):
-    global num_gpus
+
+def get_gpu_count():
+    if gpu_allocations is None:
+        return 0
+    return len(gpu_allocations.devices)
+
+
+def get_gpu_slots_total():
+    if gpu_allocations is None:
+        return 0
+    return gpu_allocations.free_slots()
+
+
+def get_gpu_slots_count():
+    if gpu_allocations is None:
+        return 0
+    return len(gpu_allocations.devices) * gpu_allocations.slots_per_device
+
+
+def allow_devices(instance_name, devices, perm='rwm'):
+    """Whitelist devices in the device cgroup of an LXC instance.
+
+    :param devices: list of (type, major, minor) tuples, type being 'b'
+                    or 'c'
+
+    The device cgroup only takes one rule per write(), so the rules are
+    padded to the same length and written by a single dd whose output
+    block size is that length: one privileged process for all of them.
+    """
+    rules = ['%s %d:%d %s' % (dev_type, int(major), int(minor), perm)
+             for dev_type, major, minor in devices]
+    if not rules:
+        return
+    width = max(len(rule) for rule in rules) + 1
+    data = ''.join(rule.ljust(width, '\n') for rule in rules)
     dev_whitelist = os.path.join(FLAGS.dev_cgroups_path,
-                                  inst['name'],
-                                  'devices.allow')
-    # Allow Nvidia Controller
-    perm = 'c %d:255 rwm\n' % FLAGS.gpu_dev_major_number
-    _PIPE = subprocess.PIPE
-    utils.execute('tee', dev_whitelist, process_input=perm,
+                                 instance_name,
+                                 'devices.allow')
+    utils.execute('dd', 'of=%s' % dev_whitelist, 'ibs=%d' % len(data),
+                  'obs=%d' % width, process_input=data,
                   run_as_root=True)
-    for i in range(int(num_gpus)):
+
+
+def allow_gpus(inst, gpus):
+    """Allow the instance to use the nvidia controller and its gpus."""
+    major = int(FLAGS.gpu_dev_major_number)
+    # Allow Nvidia Controller
+    devices = [('c', major, 255)]
+    for i in gpus:
         # Allow each gpu device
-        perm = 'c 195:%d rwm\n' % (i + FLAGS.gpu_dev_minor_number)
-        utils.execute('tee', dev_whitelist, process_input=perm,
-                      run_as_root=True)
+        devices.append(('c', major, i + int(FLAGS.gpu_dev_minor_number)))
+    allow_devices(inst['name'], devices)
+
+
+def pin_to_numa_node(inst, node):
+    """Restrict the cpus and memory of the container to a numa node."""
+    cpus = gpu_allocations.topology.node_cpus.get(node)
+    if not cpus:
+        return
+    cpuset = os.path.join(FLAGS.cpuset_cgroups_path, inst['name'])
+    utils.execute('tee', os.path.join(cpuset, 'cpuset.cpus'),
+                  process_input=cpus, run_as_root=True)
+    utils.execute('tee', os.path.join(cpuset, 'cpuset.mems'),
+                  process_input=str(node), run_as_root=True)
+
+
+def _get_requested(inst, instance_extra, key):
+    """Return how much of key the instance asks for, 0 if nothing."""
+    in_meta = 0
+    in_extra = 0
+    if key in inst['metadata']:
+        in_meta = int(inst['metadata'][key])
+        msg = _("%(key)s in metadata asked, %(in_meta)d .") % locals()
+        LOG.info(msg)
+    if key in instance_extra:
+        in_extra = int(instance_extra[key].split()[1])
+        msg = _("%(key)s in instance_extra asked, %(in_extra)d .") % locals()
+        LOG.info(msg)
+    return max(in_meta, in_extra)
 
 
 def assign_gpus(context, inst, lxc_container_root):
-    """Assigns gpus to a specific instance"""
-    global gpus_available
-    global gpus_assigned
+    """Assigns gpus, or slots of a shared gpu, to a specific instance"""
 #    ctxt = nova_context.get_admin_context()
-    gpus_in_meta = 0
-    gpus_in_extra = 0
-
     env_file = lxc_container_root + '/etc/environment'
     instance_extra = db.instance_type_extra_specs_get(context,
                                                       inst['instance_type_id'])
@@ -135,41 +445,55 @@ def assign_gpus(context, inst, lxc_container_root):
     LOG.debug(msg)
     msg = _("vcpus for this instance are %d .") % inst['vcpus']
     LOG.debug(msg)
-    if 'gpus' in inst['metadata']:
-        gpus_in_meta = int(inst['metadata']['gpus'])
-        msg = _("gpus in metadata asked, %d .") % gpus_in_meta
-        LOG.info(msg)
-    if 'gpus' in instance_extra:
-        gpus_in_extra = int(instance_extra['gpus'].split()[1])
-        msg = _("gpus in instance_extra asked, %d .") % gpus_in_extra
-        LOG.info(msg)
+    gpus_needed = _get_requested(inst, instance_extra, 'gpus')
+    slots_needed = _get_requested(inst, instance_extra, 'gpu_slots')
 
-    if gpus_in_meta > gpus_in_extra:
-        gpus_needed = gpus_in_meta
-    else:
-        gpus_needed = gpus_in_extra
-    allow_gpus(inst)
-    gpus_assigned_list = []
-    if gpus_needed > len(gpus_available):
-        raise Exception(_("Overcommit Error"))
-    for i in range(gpus_needed):
-        gpus_assigned_list.append(gpus_available.pop())
+    if gpus_needed > get_gpu_total():
+        raise exception.InsufficientFreeGPUs(instance_name=inst['name'])
     if gpus_needed:
-        gpus_assigned[inst['name']] = gpus_assigned_list
+        gpus_assigned_list = _allocate_gpus(inst['name'], gpus_needed)
+    elif slots_needed:
+        gpus_assigned_list = _allocate_gpu_slots(inst['name'], slots_needed)
+    else:
+        return
+    try:
+        allow_gpus(inst, gpus_assigned_list)
+        if gpu_allocations.topology is not None:
+            node = gpu_allocations.topology.get_numa_node(gpus_assigned_list)
+            if node is not None:
+                pin_to_numa_node(inst, node)
         gpus_visible = str(gpus_assigned_list).strip('[]')
-        flag = "CUDA_VISIBLE_DEVICES=%s\n" % gpus_visible
+        # CUDA numbers the fastest gpu first unless told otherwise, the
+        # gpus are numbered in pci bus order here
+        flag = ("CUDA_DEVICE_ORDER=PCI_BUS_ID\n"
+                "CUDA_VISIBLE_DEVICES=%s\n" % gpus_visible)
+        if not gpus_needed:
+            # for init_host to tell it shares the gpu
+            flag += "NOVA_GPU_SLOTS=%d\n" % slots_needed
         utils.execute('tee', env_file, process_input=flag,
                       run_as_root=True)
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            deassign_gpus(inst)
+
+
+@utils.synchronized('gpu_allocations')
+def _allocate_gpus(instance_name, count):
+    return gpu_allocations.allocate(instance_name, count)
+
+
+@utils.synchronized('gpu_allocations')
+def _allocate_gpu_slots(instance_name, slots):
+    if gpu_allocations is None:
+        raise exception.InsufficientFreeGPUs(instance_name=instance_name)
+    return gpu_allocations.allocate_slots(instance_name, slots)
 
 
+@utils.synchronized('gpu_allocations')
 def deassign_gpus(inst):
-    """Assigns gpus to a specific instance"""
-    global gpus_available
-    global gpus_assigned
-    if inst['name'] in gpus_assigned:
-        gpus_available.extend(gpus_assigned[inst['name']])
-        del gpus_assigned[inst['name']]
-    return
+    """Deassigns gpus from a specific instance"""
+    if gpu_allocations is not None:
+        gpu_allocations.release(inst['name'])
 
 
 '''
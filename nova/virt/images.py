@@ -23,6 +23,7 @@ Handling of VM disk images.
 
 import os
 
+from nova.compute import timing
 from nova import exception
 from nova import flags
 from nova.image import glance
@@ -74,7 +75,8 @@ def fetch(context, image_href, path, _user_id, _project_id):
 
 def fetch_to_raw(context, image_href, path, user_id, project_id):
     path_tmp = "%s.part" % path
-    fetch(context, image_href, path_tmp, user_id, project_id)
+    with timing.span('image_fetch'):
+        fetch(context, image_href, path_tmp, user_id, project_id)
 
     with utils.remove_path_on_error(path_tmp):
         data = qemu_img_info(path_tmp)
@@ -94,8 +96,9 @@ def fetch_to_raw(context, image_href, path, user_id, project_id):
             staged = "%s.converted" % path
             LOG.debug("%s was %s, converting to raw" % (image_href, fmt))
             with utils.remove_path_on_error(staged):
-                utils.execute('qemu-img', 'convert', '-O', 'raw', path_tmp,
-                              staged)
+                with timing.span('image_convert'):
+                    utils.execute('qemu-img', 'convert', '-O', 'raw',
+                                  path_tmp, staged)
 
                 data = qemu_img_info(staged)
                 if data.get('file format') != "raw":
@@ -50,7 +50,9 @@ import sys
 import tempfile
 import uuid
 
+from eventlet import greenio
 from eventlet import greenthread
+from eventlet import patcher
 from eventlet import tpool
 from lxml import etree
 from xml.dom import minidom
@@ -59,6 +61,7 @@ from nova.api.metadata import base as instance_metadata
 from nova import block_device
 from nova.compute import instance_types
 from nova.compute import power_state
+from nova.compute import timing
 from nova.compute import vm_mode
 from nova import context as nova_context
 from nova import db
@@ -74,6 +77,7 @@ from nova import utils
 from nova.virt import configdrive
 from nova.virt.disk import api as disk
 from nova.virt import driver
+from nova.virt import event as virtevent
 from nova.virt import firewall
 from nova.virt.libvirt import config
 from nova.virt.libvirt import firewall as libvirt_firewall
@@ -82,6 +86,9 @@ from nova.virt.libvirt import imagecache
 from nova.virt.libvirt import utils as libvirt_utils
 from nova.virt import netutils
 
+native_threading = patcher.original("threading")
+native_Queue = patcher.original("Queue")
+
 libvirt = None
 
 LOG = logging.getLogger(__name__)
@@ -165,6 +172,16 @@ libvirt_opts = [
                 default=True,
                 help='Use a separated OS thread pool to realize non-blocking'
                      ' libvirt calls'),
+    cfg.IntOpt('libvirt_max_concurrent_domain_creates',
+               default=4,
+               help='Number of domains that are defined and started at the '
+                    'same time, while the images of other instances are '
+                    'being fetched and created. 0 means no limit.'),
+    cfg.BoolOpt('libvirt_lifecycle_events',
+                default=True,
+                help='Report domain lifecycle events from libvirt to the '
+                     'compute manager as they happen, so that power state '
+                     'changes do not wait for the periodic poll'),
     # force_config_drive is a string option, to allow for future behaviors
     #  (e.g. use config_drive based on image properties)
     cfg.StrOpt('force_config_drive',
@@ -246,6 +263,20 @@ LIBVIRT_POWER_STATE = {
     VIR_DOMAIN_PMSUSPENDED: power_state.SUSPENDED,
 }
 
+VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+
+VIR_DOMAIN_EVENT_STARTED = 2
+VIR_DOMAIN_EVENT_SUSPENDED = 3
+VIR_DOMAIN_EVENT_RESUMED = 4
+VIR_DOMAIN_EVENT_STOPPED = 5
+
+LIBVIRT_LIFECYCLE_EVENT = {
+    VIR_DOMAIN_EVENT_STARTED: virtevent.EVENT_LIFECYCLE_STARTED,
+    VIR_DOMAIN_EVENT_SUSPENDED: virtevent.EVENT_LIFECYCLE_PAUSED,
+    VIR_DOMAIN_EVENT_RESUMED: virtevent.EVENT_LIFECYCLE_RESUMED,
+    VIR_DOMAIN_EVENT_STOPPED: virtevent.EVENT_LIFECYCLE_STOPPED,
+}
+
 MIN_LIBVIRT_VERSION = (0, 9, 6)
 # When the above version matches/exceeds this version
 # delete it & corresponding code using it
@@ -269,6 +300,10 @@ class LibvirtDriver(driver.ComputeDriver):
         self._initiator = None
         self._wrapped_conn = None
         self.read_only = read_only
+        self._events_enabled = False
+        self._event_queue = None
+        self._event_notify_recv = None
+        self._event_notify_send = None
         self.firewall_driver = firewall.load_driver(
             default=DEFAULT_FIREWALL_DRIVER,
             get_connection=self._get_connection)
@@ -327,6 +362,8 @@ class LibvirtDriver(driver.ComputeDriver):
         return True
 
     def init_host(self, host):
+        self._init_events()
+
         if not self.has_min_version(MIN_LIBVIRT_VERSION):
             major = MIN_LIBVIRT_VERSION[0]
             minor = MIN_LIBVIRT_VERSION[1]
@@ -345,6 +382,8 @@ class LibvirtDriver(driver.ComputeDriver):
                 self._wrapped_conn = tpool.proxy_call(
                     (libvirt.virDomain, libvirt.virConnect),
                     self._connect, self.uri, self.read_only)
+            if self._events_enabled:
+                self._register_lifecycle_events()
 
         return self._wrapped_conn
 
@@ -362,6 +401,93 @@ class LibvirtDriver(driver.ComputeDriver):
                 return False
             raise
 
+    def _init_events(self):
+        """Have libvirt report domain lifecycle events.
+
+        libvirt runs the event loop and the callbacks in a native thread,
+        which cannot touch eventlet.  The callbacks put the events on a
+        native queue and wake a greenthread up through a pipe, which then
+        hands them to the compute manager.
+        """
+        if not FLAGS.libvirt_lifecycle_events or self._events_enabled:
+            return
+        if not hasattr(libvirt, 'virEventRegisterDefaultImpl'):
+            LOG.warn(_("libvirt does not report events, power state "
+                       "changes will only be seen by polling"))
+            return
+
+        self._init_events_pipe()
+        libvirt.virEventRegisterDefaultImpl()
+        event_thread = native_threading.Thread(target=self._native_thread)
+        event_thread.setDaemon(True)
+        event_thread.start()
+        greenthread.spawn(self._dispatch_thread)
+
+        self._events_enabled = True
+        # the callbacks go on the connections opened from now on:
+        self._wrapped_conn = None
+
+    def _init_events_pipe(self):
+        self._event_queue = native_Queue.Queue()
+        rpipe, wpipe = os.pipe()
+        self._event_notify_send = wpipe
+        self._event_notify_recv = greenio.GreenPipe(rpipe, 'rb', 0)
+
+    def _register_lifecycle_events(self):
+        try:
+            self._wrapped_conn.domainEventRegisterAny(
+                    None, VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                    self._event_lifecycle_callback, self)
+        except Exception:
+            LOG.warn(_("URI %s does not support events, power state changes "
+                       "will only be seen by polling"), self.uri)
+
+    def _native_thread(self):
+        """Run the libvirt event loop, in a native thread."""
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    @staticmethod
+    def _event_lifecycle_callback(conn, dom, event, detail, opaque):
+        """Called by libvirt in the native thread."""
+        self = opaque
+        transition = LIBVIRT_LIFECYCLE_EVENT.get(event)
+        if transition is None:
+            # defined / undefined
+            return
+        self._queue_event(virtevent.LifecycleEvent(dom.UUIDString(),
+                                                   transition))
+
+    def _queue_event(self, event):
+        """Hand an event over from the native thread to the dispatch
+        greenthread."""
+        self._event_queue.put(event)
+        os.write(self._event_notify_send, ' ')
+
+    def _dispatch_thread(self):
+        while True:
+            self._dispatch_events()
+
+    def _dispatch_events(self):
+        """Wait for the native thread to queue events, and emit them."""
+        try:
+            self._event_notify_recv.read(1)
+        except Exception:
+            LOG.exception(_("Failed to wait for libvirt events"))
+            greenthread.sleep(1)
+            return
+
+        while True:
+            try:
+                event = self._event_queue.get(block=False)
+            except native_Queue.Empty:
+                break
+            self.emit_event(event)
+
+    def register_event_listener(self, callback):
+        super(LibvirtDriver, self).register_event_listener(callback)
+        return self._events_enabled
+
     @property
     def uri(self):
         if FLAGS.libvirt_type == 'uml':
@@ -1059,14 +1185,18 @@ class LibvirtDriver(driver.ComputeDriver):
     @exception.wrap_exception()
     def spawn(self, context, instance, image_meta, injected_files,
               admin_password, network_info=None, block_device_info=None):
-        xml = self.to_xml(instance, network_info, image_meta,
-                          block_device_info=block_device_info)
-        self._create_image(context, instance, xml, network_info=network_info,
-                           block_device_info=block_device_info,
-                           files=injected_files,
-                           admin_pass=admin_password)
-        self._create_domain_and_network(xml, instance, network_info,
-                                        block_device_info)
+        with timing.span('to_xml'):
+            xml = self.to_xml(instance, network_info, image_meta,
+                              block_device_info=block_device_info)
+        with timing.span('create_image'):
+            self._create_image(context, instance, xml,
+                               network_info=network_info,
+                               block_device_info=block_device_info,
+                               files=injected_files,
+                               admin_pass=admin_password)
+        with timing.span('create_domain'):
+            self._create_domain_and_network(xml, instance, network_info,
+                                            block_device_info)
         LOG.debug(_("Instance is running"), instance=instance)
 
         def _wait_for_boot():
@@ -1078,8 +1208,9 @@ class LibvirtDriver(driver.ComputeDriver):
                          instance=instance)
                 raise utils.LoopingCallDone()
 
-        timer = utils.LoopingCall(_wait_for_boot)
-        timer.start(interval=0.5).wait()
+        with timing.span('boot'):
+            timer = utils.LoopingCall(_wait_for_boot)
+            timer.start(interval=0.5).wait()
 
     def _flush_libvirt_console(self, pty):
         out, err = utils.execute('dd',
@@ -1402,7 +1533,8 @@ class LibvirtDriver(driver.ComputeDriver):
                 configdrive_path = basepath(fname='disk.config')
                 LOG.info(_('Creating config drive at %(path)s'),
                          {'path': configdrive_path}, instance=instance)
-                cdb.make_drive(configdrive_path)
+                with timing.span('config_drive'):
+                    cdb.make_drive(configdrive_path)
             finally:
                 cdb.cleanup()
 
@@ -1417,10 +1549,11 @@ class LibvirtDriver(driver.ComputeDriver):
                     LOG.info(_('Injecting %(injection)s into image'
                                ' %(img_id)s'), locals(), instance=instance)
             try:
-                disk.inject_data(injection_path,
-                                 key, net, metadata, admin_pass, files,
-                                 partition=target_partition,
-                                 use_cow=FLAGS.use_cow_images)
+                with timing.span('inject'):
+                    disk.inject_data(injection_path,
+                                     key, net, metadata, admin_pass, files,
+                                     partition=target_partition,
+                                     use_cow=FLAGS.use_cow_images)
 
             except Exception as e:
                 # This could be a windows image, or a vmdk format disk
@@ -1856,6 +1989,9 @@ class LibvirtDriver(driver.ComputeDriver):
 
         """
         virt_dom = self._lookup_by_name(instance['name'])
+        return self._get_domain_info(virt_dom)
+
+    def _get_domain_info(self, virt_dom):
         (state, max_mem, mem, num_cpu, cpu_time) = virt_dom.info()
         return {'state': LIBVIRT_POWER_STATE[state],
                 'max_mem': max_mem,
@@ -1863,6 +1999,43 @@ class LibvirtDriver(driver.ComputeDriver):
                 'num_cpu': num_cpu,
                 'cpu_time': cpu_time}
 
+    def _list_all_domains(self):
+        """Return every domain, running or not, in as few calls as
+        libvirt allows."""
+        try:
+            return self._conn.listAllDomains(0)
+        except (AttributeError, libvirt.libvirtError):
+            # listAllDomains needs libvirt 0.9.13
+            pass
+
+        domains = []
+        for domain_id in self.list_instance_ids():
+            if domain_id == 0:
+                continue
+            try:
+                domains.append(self._conn.lookupByID(domain_id))
+            except libvirt.libvirtError:
+                # Instance was deleted while listing... ignore it
+                pass
+        for name in self._conn.listDefinedDomains():
+            try:
+                domains.append(self._conn.lookupByName(name))
+            except libvirt.libvirtError:
+                pass
+        return domains
+
+    def get_info_all(self):
+        """Retrieve information from libvirt for all the domains, without
+        looking each instance up by name."""
+        infos = {}
+        for virt_dom in self._list_all_domains():
+            try:
+                infos[virt_dom.name()] = self._get_domain_info(virt_dom)
+            except libvirt.libvirtError:
+                # Instance was deleted while listing... ignore it
+                pass
+        return infos
+
     def _create_domain(self, xml=None, domain=None, launch_flags=0):
         """Create a domain.
 
@@ -1892,7 +2065,9 @@ class LibvirtDriver(driver.ComputeDriver):
         self.plug_vifs(instance, network_info)
         self.firewall_driver.setup_basic_filtering(instance, network_info)
         self.firewall_driver.prepare_instance_filter(instance, network_info)
-        domain = self._create_domain(xml)
+        with utils.concurrency_limit('domain_create',
+                FLAGS.libvirt_max_concurrent_domain_creates):
+            domain = self._create_domain(xml)
         self.firewall_driver.apply_instance_filter(instance, network_info)
         return domain
 
@@ -19,6 +19,7 @@ import abc
 import contextlib
 import os
 
+from nova.compute import timing
 from nova import flags
 from nova.openstack.common import cfg
 from nova.openstack.common import excutils
@@ -41,12 +42,30 @@ __imagebackend_opts = [
             default=False,
             help='Create sparse logical volumes (with virtualsize)'
                  ' if this flag is set to True.'),
+    cfg.IntOpt('libvirt_max_concurrent_image_fetches',
+            default=4,
+            help='Number of base images that are downloaded at the same'
+                 ' time. Instances waiting for an image that is already'
+                 ' being downloaded do not count. 0 means no limit.'),
+    cfg.IntOpt('libvirt_max_concurrent_disk_preps',
+            default=8,
+            help='Number of instance disks that are created from their'
+                 ' base image at the same time. 0 means no limit.'),
         ]
 
 FLAGS = flags.FLAGS
 FLAGS.register_opts(__imagebackend_opts)
 
 
+@contextlib.contextmanager
+def disk_prep():
+    """Bounds the number of instance disks created at the same time."""
+    with utils.concurrency_limit('disk_prep',
+                                 FLAGS.libvirt_max_concurrent_disk_preps):
+        with timing.span('disk_create'):
+            yield
+
+
 class Image(object):
     __metaclass__ = abc.ABCMeta
 
@@ -104,7 +123,8 @@ class Image(object):
 
         Ensures that template and image not already exists.
         Ensures that base directory exists.
-        Synchronizes on template fetching.
+        Synchronizes on template fetching, so that the instances that
+        need the same template wait for a single download.
 
         :fetch_func: Function that creates the base image
                      Should accept `target` argument.
@@ -114,7 +134,9 @@ class Image(object):
         @utils.synchronized(filename, external=True, lock_path=self.lock_path)
         def call_if_not_exists(target, *args, **kwargs):
             if not os.path.exists(target):
-                fetch_func(target=target, *args, **kwargs)
+                with utils.concurrency_limit('image_fetch',
+                        FLAGS.libvirt_max_concurrent_image_fetches):
+                    fetch_func(target=target, *args, **kwargs)
 
         if not os.path.exists(self.path):
             base_dir = os.path.join(FLAGS.instances_path, '_base')
@@ -134,11 +156,13 @@ class Raw(Image):
                                  instance, name)
 
     def create_image(self, prepare_template, base, size, *args, **kwargs):
-        @utils.synchronized(base, external=True, lock_path=self.lock_path)
+        # NOTE: the template is complete once prepare_template returns,
+        # so instances can be copied from it at the same time
         def copy_raw_image(base, target, size):
-            libvirt_utils.copy_image(base, target)
-            if size:
-                disk.extend(target, size)
+            with disk_prep():
+                libvirt_utils.copy_image(base, target)
+                if size:
+                    disk.extend(target, size)
 
         generating = 'image_id' not in kwargs
         if generating:
@@ -159,20 +183,25 @@ class Qcow2(Image):
 
     def create_image(self, prepare_template, base, size, *args, **kwargs):
         @utils.synchronized(base, external=True, lock_path=self.lock_path)
-        def copy_qcow2_image(base, target, size):
-            qcow2_base = base
-            if size:
-                size_gb = size / (1024 * 1024 * 1024)
-                qcow2_base += '_%d' % size_gb
-                if not os.path.exists(qcow2_base):
-                    with utils.remove_path_on_error(qcow2_base):
+        def copy_qcow2_base(base, qcow2_base, size):
+            if not os.path.exists(qcow2_base):
+                with utils.remove_path_on_error(qcow2_base):
+                    with disk_prep():
                         libvirt_utils.copy_image(base, qcow2_base)
                         disk.extend(qcow2_base, size)
-            libvirt_utils.create_cow_image(qcow2_base, target)
 
         prepare_template(target=base, *args, **kwargs)
+        qcow2_base = base
+        if size:
+            size_gb = size / (1024 * 1024 * 1024)
+            qcow2_base += '_%d' % size_gb
+            copy_qcow2_base(base, qcow2_base, size)
+
+        # NOTE: only the resized base is created under the lock, the
+        # overlays of the instances sharing it are created in parallel
         with utils.remove_path_on_error(self.path):
-            copy_qcow2_image(base, self.path, size)
+            with disk_prep():
+                libvirt_utils.create_cow_image(qcow2_base, self.path)
 
 
 class Lvm(Image):
@@ -217,7 +246,8 @@ class Lvm(Image):
         else:
             prepare_template(target=base, *args, **kwargs)
             with self.remove_volume_on_error(self.path):
-                create_lvm_image(base, size)
+                with disk_prep():
+                    create_lvm_image(base, size)
 
     @contextlib.contextmanager
     def remove_volume_on_error(self, path):